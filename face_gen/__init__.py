@@ -0,0 +1,84 @@
+"""Face generation using a Variational Autoencoder (VAE) trained on CelebA.
+
+Importing the package is cheap: the names below are imported from their
+submodules on first use, so e.g. `from face_gen import generate_faces` does
+not load TensorFlow, and `face_gen.build_decoder` loads it only when it is
+looked up.
+
+The command line is `python -m face_gen {train,generate,encode,...}`.
+"""
+
+import importlib
+
+_EXPORTS = {
+  # face_gen.data
+  'ZipImageReader': 'data',
+  'build_cache': 'data',
+  'CachedDataset': 'data',
+  'CacheIterator': 'data',
+  'ZipIterator': 'data',
+  'ParallelLoader': 'data',
+  # face_gen.models
+  'architecture': 'models',
+  'build_encoder': 'models',
+  'build_vae_encoder': 'models',
+  'build_decoder': 'models',
+  'build_vae': 'models',
+  'load_vae': 'models',
+  'load_decoder': 'models',
+  'make_r_loss': 'models',
+  'kl_loss': 'models',
+  'VAEModel': 'models',
+  # face_gen.callbacks
+  'LossFactorScheduler': 'callbacks',
+  'TrainingMonitor': 'callbacks',
+  'TargetLossTimer': 'callbacks',
+  'ParetoStopper': 'callbacks',
+  # face_gen.checkpoints
+  'CheckpointManager': 'checkpoints',
+  # face_gen.parallel
+  'train_parallel': 'parallel',
+  # face_gen.progressive
+  'train_progressive': 'progressive',
+  'transfer_weights': 'progressive',
+  # face_gen.evaluate
+  'evaluate_scores': 'evaluate',
+  'ValidationScorer': 'evaluate',
+  # face_gen.sweep
+  'run_sweep': 'sweep',
+  # face_gen.generate
+  'sample_latents': 'generate',
+  'generate_faces': 'generate',
+  # face_gen.latent_index
+  'encode_dataset': 'latent_index',
+  'LatentIndex': 'latent_index',
+  'IVFIndex': 'latent_index',
+  # face_gen.latent_ops
+  'lerp_paths': 'latent_ops',
+  'slerp_paths': 'latent_ops',
+  'attribute_vectors': 'latent_ops',
+  'decode_paths': 'latent_ops',
+  # face_gen.montage
+  'tile_images': 'montage',
+  'save_montage': 'montage',
+  'stream_montage': 'montage',
+  # face_gen.export
+  'export_models': 'export',
+  'load_artifact': 'export',
+  # face_gen.serve
+  'MicroBatcher': 'serve',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+  if name not in _EXPORTS:
+    raise AttributeError("module 'face_gen' has no attribute %r" % name)
+  value = getattr(importlib.import_module('face_gen.' + _EXPORTS[name]), name)
+  globals()[name] = value
+  return value
+
+
+def __dir__():
+  return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,52 @@
+"""Command line of the package.
+
+  python -m face_gen train --data-zip celeba-dataset.zip --epochs 200
+  python -m face_gen parallel train --cache data/cache_128x128/ --workers 8
+  python -m face_gen progressive --data-zip celeba-dataset.zip --sizes 32 64 128 --epochs 10 10 5
+  python -m face_gen evaluate --weights weights/VAE/weights.h5 --cache data/cache_128x128/ --scores scores.npy
+  python -m face_gen sweep --cache data/cache_128x128/ --subset 20000 --epochs 5 --output sweeps/results.csv
+  python -m face_gen generate --weights weights/VAE/weights.h5 --n 1000 --output generated/
+  python -m face_gen encode --weights weights/VAE/weights.h5 --cache data/cache_128x128/ --output latents/
+  python -m face_gen query --index latents/ --image 000001.jpg
+  python -m face_gen serve --weights weights/VAE/weights.h5 --port 8000
+
+Only the module of the command is imported, so e.g. `generate` never loads
+the training code.
+"""
+
+import importlib
+import sys
+
+# Command: (module, arguments passed before the command line arguments)
+COMMANDS = {
+  'train': ('face_gen.train', []),
+  'parallel': ('face_gen.parallel', []),
+  'progressive': ('face_gen.progressive', []),
+  'sweep': ('face_gen.sweep', []),
+  'evaluate': ('face_gen.evaluate', []),
+  'generate': ('face_gen.generate', []),
+  'encode': ('face_gen.latent_index', ['encode']),
+  'query': ('face_gen.latent_index', ['query']),
+  'morph': ('face_gen.latent_ops', ['morph']),
+  'montage': ('face_gen.montage', []),
+  'attribute': ('face_gen.latent_ops', ['attribute']),
+  'serve': ('face_gen.serve', []),
+  'export': ('face_gen.export', []),
+  'benchmark': ('face_gen.benchmark', []),
+}
+
+
+def main(argv = None):
+  argv = sys.argv[1:] if argv is None else argv
+
+  if not argv or argv[0] not in COMMANDS:
+    print('usage: python -m face_gen {%s} [-h] ...' % ','.join(COMMANDS))
+    print(__doc__)
+    return 0 if argv and argv[0] in ('-h', '--help') else 2
+
+  module, prefix = COMMANDS[argv[0]]
+  return importlib.import_module(module).main(prefix + argv[1:])
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,320 @@
+"""Throughput benchmarks for the input pipeline and the VAE.
+
+Runs on synthetic data, so no CelebA download is needed, and sweeps batch
+size, input dimension and CPU thread count. Every thread count runs in its
+own process, as TensorFlow fixes its thread pools at start-up.
+
+  python -m face_gen.benchmark run --batch-sizes 32 512 --input-dims 64 128 \\
+      --threads 1 4 --output results.json
+  python -m face_gen.benchmark compare baseline.json results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from zipfile import ZipFile
+
+import numpy as np
+from PIL import Image
+
+from face_gen.data import CACHE_INDEX, CACHE_FILENAMES, CachedDataset, CacheIterator, ZipImageReader, ZipIterator, ParallelLoader
+
+Z_DIM = 200
+# CelebA images are 178x218 before resizing
+SOURCE_SIZE = (178, 218)
+
+
+# SYNTHETIC DATA
+def _synthetic_images(rng, n, size):
+  # Smooth random images, so JPEG encoding and decoding cost about as much
+  # as for photos rather than for noise
+  for _ in range(n):
+    small = rng.randint(0, 256, size = (6, 6, 3)).astype(np.uint8)
+    yield Image.fromarray(small).resize(size, Image.BILINEAR)
+
+
+def write_synthetic_cache(cache_folder, n, image_shape, seed = 0):
+  rng = np.random.RandomState(seed)
+  if not os.path.exists(cache_folder):
+    os.makedirs(cache_folder)
+
+  shard = np.lib.format.open_memmap(os.path.join(cache_folder, 'shard_00000.npy'), mode = 'w+',
+                                    dtype = np.uint8, shape = (n,) + tuple(image_shape))
+  for i, img in enumerate(_synthetic_images(rng, n, image_shape[1::-1])):
+    shard[i] = np.asarray(img)
+  shard.flush()
+  del shard
+
+  with open(os.path.join(cache_folder, CACHE_FILENAMES), 'w') as f:
+    f.write('\n'.join('%06d.jpg' % i for i in range(n)))
+  with open(os.path.join(cache_folder, CACHE_INDEX), 'w') as f:
+    json.dump({'image_shape': list(image_shape), 'shard_sizes': [n]}, f)
+
+  return CachedDataset(cache_folder)
+
+
+def write_synthetic_zip(zip_path, n, seed = 0):
+  rng = np.random.RandomState(seed)
+  with ZipFile(zip_path, 'w') as archive:
+    for i, img in enumerate(_synthetic_images(rng, n, SOURCE_SIZE)):
+      with archive.open('img_align_celeba/%06d.jpg' % i, 'w') as f:
+        img.save(f, format = 'JPEG', quality = 95)
+  return ZipImageReader(zip_path)
+
+
+# TIMING
+def _time(fn, steps, warmup):
+  for _ in range(warmup):
+    fn()
+
+  times = []
+  for _ in range(steps):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return np.array(times)
+
+
+def _result(name, input_dim, batch_size, threads, times):
+  return {'name': name,
+          'input_dim': input_dim,
+          'batch_size': batch_size,
+          'threads': threads,
+          'images_per_sec': batch_size / float(np.median(times)),
+          'ms_per_batch': 1000 * float(np.median(times)),
+          'ms_p90': 1000 * float(np.percentile(times, 90))}
+
+
+def bench_pipeline(workdir, input_dim, batch_size, threads, steps, warmup):
+  image_shape = (input_dim, input_dim, 3)
+  n = batch_size * (steps + warmup)
+  results = []
+
+  # Random gathers from the memory-mapped cache, the slowest way to read it
+  dataset = write_synthetic_cache(os.path.join(workdir, 'cache_%d_%d' % (input_dim, batch_size)),
+                                  n, image_shape)
+  data_flow = CacheIterator(dataset, batch_size = batch_size, shuffle = True, rescale = None)
+  results.append(_result('pipeline_cache', input_dim, batch_size, threads,
+                         _time(lambda: next(data_flow), steps, warmup)))
+
+  # JPEG decoding straight from the zip file, on `threads` worker processes
+  reader = write_synthetic_zip(os.path.join(workdir, 'images_%d_%d.zip' % (input_dim, batch_size)), n)
+  with ParallelLoader(ZipIterator(reader, target_size = image_shape[:2], batch_size = batch_size,
+                                  rescale = None),
+                      workers = threads) as data_flow:
+    results.append(_result('pipeline_zip', input_dim, batch_size, threads,
+                           _time(lambda: next(data_flow), steps, warmup)))
+
+  return results
+
+
+def bench_models(input_dim, batch_sizes, threads, steps, warmup):
+  import tensorflow as tf
+  from keras.optimizers import Adam
+  from face_gen.models import architecture, build_encoder, build_vae
+
+  image_shape = (input_dim, input_dim, 3)
+  rng = np.random.RandomState(0)
+  results = []
+
+  def forward(model):
+    return tf.function(lambda x: model(x, training = False))
+
+  # The encoder of the Simple Autoencoder is built first, building the VAE
+  # clears the session
+  layers = architecture(image_shape)
+  _, _, _, encoder = build_encoder(input_dim = image_shape,
+                                   output_dim = Z_DIM,
+                                   conv_filters = layers['encoder_conv_filters'],
+                                   conv_kernel_size = layers['conv_kernel_size'],
+                                   conv_strides = layers['conv_strides'],
+                                   input_rescale = 1./255)
+  encoder_forward = forward(encoder)
+  for batch_size in batch_sizes:
+    x = tf.constant(rng.randint(0, 256, size = (batch_size,) + image_shape).astype(np.uint8))
+    results.append(_result('encoder_forward', input_dim, batch_size, threads,
+                           _time(lambda: encoder_forward(x).numpy(), steps, warmup)))
+
+  # decoder and vae_decoder share the same architecture, vae_decoder stands
+  # for both
+  vae_encoder, vae_decoder, vae_model = build_vae(image_shape, Z_DIM)
+  vae_model.compile(optimizer = Adam(learning_rate = 0.0005))
+  vae_encoder_forward = forward(vae_encoder)
+  decoder_forward = forward(vae_decoder)
+
+  for batch_size in batch_sizes:
+    x = rng.randint(0, 256, size = (batch_size,) + image_shape).astype(np.uint8)
+    z = tf.constant(rng.normal(size = (batch_size, Z_DIM)).astype(np.float32))
+    results.append(_result('vae_encoder_forward', input_dim, batch_size, threads,
+                           _time(lambda: vae_encoder_forward(tf.constant(x)).numpy(), steps, warmup)))
+    results.append(_result('decoder_forward', input_dim, batch_size, threads,
+                           _time(lambda: decoder_forward(z).numpy(), steps, warmup)))
+    results.append(_result('vae_train_step', input_dim, batch_size, threads,
+                           _time(lambda: vae_model.train_on_batch(x), steps, warmup)))
+
+  return results
+
+
+def _print_results(results):
+  for result in results:
+    print('%(name)-20s dim %(input_dim)4d  batch %(batch_size)4d  threads %(threads)3d  '
+          '%(images_per_sec)10.1f images/s  %(ms_per_batch)9.2f ms/batch' % result)
+
+
+def run_benchmarks(input_dims, batch_sizes, threads, steps = 10, warmup = 2, skip = ()):
+  """Runs every benchmark in this process, with `threads` CPU threads."""
+  results = []
+  workdir = tempfile.mkdtemp(prefix = 'face_gen_benchmark_')
+  try:
+    # The pipeline benchmarks fork the loader workers, so they all run
+    # before TensorFlow is imported and starts its threads
+    if 'pipeline' not in skip:
+      for input_dim in input_dims:
+        for batch_size in batch_sizes:
+          pipeline = bench_pipeline(workdir, input_dim, batch_size, threads, steps, warmup)
+          _print_results(pipeline)
+          results += pipeline
+
+    if 'models' not in skip:
+      import tensorflow as tf
+      tf.config.threading.set_intra_op_parallelism_threads(threads)
+      tf.config.threading.set_inter_op_parallelism_threads(threads)
+      for input_dim in input_dims:
+        models = bench_models(input_dim, batch_sizes, threads, steps, warmup)
+        _print_results(models)
+        results += models
+  finally:
+    shutil.rmtree(workdir, ignore_errors = True)
+
+  return results
+
+
+def _metadata():
+  meta = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+          'platform': platform.platform(),
+          'python': platform.python_version(),
+          'cpu_count': os.cpu_count()}
+  try:
+    import tensorflow as tf
+    meta['tensorflow'] = tf.__version__
+  except ImportError:
+    pass
+  return meta
+
+
+# COMPARISON
+def _key(result):
+  return (result['name'], result['input_dim'], result['batch_size'], result['threads'])
+
+
+def compare(baseline, current, threshold = 0.05):
+  """Returns the rows of both result files, flagging throughput regressions.
+
+  A benchmark regressed if its images/s dropped by more than `threshold`
+  (a fraction) from `baseline` to `current`. Benchmarks found in only one of
+  the files get a row too, with `before` (new ones) or `after` (missing ones)
+  and `change` set to None.
+  """
+  before = {_key(r): r for r in baseline['results']}
+  after = {_key(r): r for r in current['results']}
+  rows = []
+  for result in current['results']:
+    key = _key(result)
+    if key not in before:
+      rows.append({'key': key, 'before': None, 'after': result['images_per_sec'],
+                   'change': None, 'regression': False})
+      continue
+    change = result['images_per_sec'] / before[key]['images_per_sec'] - 1
+    rows.append({'key': key,
+                 'before': before[key]['images_per_sec'],
+                 'after': result['images_per_sec'],
+                 'change': change,
+                 'regression': change < -threshold})
+  for result in baseline['results']:
+    key = _key(result)
+    if key not in after:
+      rows.append({'key': key, 'before': result['images_per_sec'], 'after': None,
+                   'change': None, 'regression': False})
+  return rows
+
+
+# COMMAND LINE
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+  commands = parser.add_subparsers(dest = 'command')
+  commands.required = True
+
+  run = commands.add_parser('run', help = 'run the benchmarks and write the results as JSON')
+  run.add_argument('--input-dims', type = int, nargs = '+', default = [128],
+                   help = 'image sizes, multiples of 8 times a power of 2')
+  run.add_argument('--batch-sizes', type = int, nargs = '+', default = [32, 128, 512])
+  run.add_argument('--threads', type = int, nargs = '+', default = [os.cpu_count()])
+  run.add_argument('--steps', type = int, default = 10)
+  run.add_argument('--warmup', type = int, default = 2)
+  run.add_argument('--skip', nargs = '*', default = [], choices = ['pipeline', 'models'])
+  run.add_argument('--output', default = 'benchmark.json')
+  # Runs a single thread count in this process, used for the child processes
+  run.add_argument('--in-process', action = 'store_true', help = argparse.SUPPRESS)
+
+  diff = commands.add_parser('compare', help = 'compare two result files')
+  diff.add_argument('baseline')
+  diff.add_argument('current')
+  diff.add_argument('--threshold', type = float, default = 0.05,
+                    help = 'relative drop in images/s reported as a regression')
+
+  args = parser.parse_args(argv)
+
+  if args.command == 'compare':
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    with open(args.current) as f:
+      current = json.load(f)
+
+    rows = compare(baseline, current, args.threshold)
+    for row in rows:
+      if row['before'] is None:
+        print('%-20s dim %4d  batch %4d  threads %3d  %10s -> %10.1f images/s  NEW'
+              % (row['key'] + ('-', row['after'])))
+      elif row['after'] is None:
+        print('%-20s dim %4d  batch %4d  threads %3d  %10.1f -> %10s images/s  MISSING'
+              % (row['key'] + (row['before'], '-')))
+      else:
+        print('%-20s dim %4d  batch %4d  threads %3d  %10.1f -> %10.1f images/s  %+7.1f%%%s'
+              % (row['key'] + (row['before'], row['after'], 100 * row['change'],
+                               '  REGRESSION' if row['regression'] else '')))
+    return 1 if any(row['regression'] for row in rows) else 0
+
+  if args.in_process:
+    results = run_benchmarks(args.input_dims, args.batch_sizes, args.threads[0],
+                             args.steps, args.warmup, args.skip)
+  else:
+    results = []
+    for threads in args.threads:
+      with tempfile.NamedTemporaryFile(suffix = '.json', delete = False) as f:
+        child_output = f.name
+      env = dict(os.environ, OMP_NUM_THREADS = str(threads))
+      subprocess.check_call([sys.executable, '-m', 'face_gen.benchmark', 'run', '--in-process',
+                             '--input-dims'] + [str(d) for d in args.input_dims] +
+                            ['--batch-sizes'] + [str(b) for b in args.batch_sizes] +
+                            ['--threads', str(threads), '--steps', str(args.steps),
+                             '--warmup', str(args.warmup), '--output', child_output] +
+                            (['--skip'] + args.skip if args.skip else []),
+                            env = env)
+      with open(child_output) as f:
+        results += json.load(f)['results']
+      os.remove(child_output)
+
+  with open(args.output, 'w') as f:
+    json.dump({'meta': _metadata(), 'results': results}, f, indent = 2)
+  print('Results written to ' + args.output)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
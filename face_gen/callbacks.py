@@ -0,0 +1,318 @@
+"""Keras callbacks used while training the models."""
+
+import csv
+import json
+import os
+import resource
+import threading
+import time
+from collections import deque
+
+from keras import backend as K
+from keras.callbacks import Callback
+
+
+class LossFactorScheduler(Callback):
+  """Sets the `loss_factor` of a `VAEModel` at the start of every epoch.
+
+  Like `LearningRateScheduler`, `schedule` is called with the epoch index and
+  the current loss factor and returns the new loss factor.
+  """
+
+  def __init__(self, schedule, verbose = 0):
+    super(LossFactorScheduler, self).__init__()
+    self.schedule = schedule
+    self.verbose = verbose
+
+  def on_epoch_begin(self, epoch, logs = None):
+    loss_factor = float(self.schedule(epoch, float(K.get_value(self.model.loss_factor))))
+    K.set_value(self.model.loss_factor, loss_factor)
+    if self.verbose > 0:
+      print('\nEpoch %05d: LossFactorScheduler setting loss factor to %s.' % (epoch + 1, loss_factor))
+
+  def on_epoch_end(self, epoch, logs = None):
+    if logs is not None:
+      logs['loss_factor'] = float(K.get_value(self.model.loss_factor))
+
+
+class TargetLossTimer(Callback):
+  """Records the wall-clock time at which a metric first reaches `target`.
+
+  The time counts from `started` (a `time.perf_counter()` value, by default
+  the start of training), so one timer can be shared by the stages of a
+  progressive training. The metric is checked at the end of every epoch;
+  with `stop`, training stops once it is reached. `elapsed` stays None until
+  then.
+  """
+
+  def __init__(self, target, monitor = 'r_loss', started = None, stop = True, verbose = 0):
+    super(TargetLossTimer, self).__init__()
+    self.target = target
+    self.monitor = monitor
+    self.started = started
+    self.stop = stop
+    self.verbose = verbose
+    self.elapsed = None
+    self.epochs = 0
+
+  def on_train_begin(self, logs = None):
+    if self.started is None:
+      self.started = time.perf_counter()
+
+  def on_epoch_end(self, epoch, logs = None):
+    self.epochs += 1
+    value = (logs or {}).get(self.monitor)
+    if self.elapsed is not None or value is None or value > self.target:
+      return
+
+    self.elapsed = time.perf_counter() - self.started
+    if self.verbose > 0:
+      print('\nEpoch %05d: %s reached %.5g after %.1f s.' % (epoch + 1, self.monitor, value, self.elapsed))
+    if self.stop:
+      self.model.stop_training = True
+
+
+def dominates(a, b, margin = 0.):
+  # Whether the losses `a` are all lower than the losses `b` by more than a
+  # `margin` fraction
+  return all(x < (1. - margin) * y for x, y in zip(a, b))
+
+
+class ParetoStopper(Callback):
+  """Stops a trial of a sweep that is clearly losing to the other trials.
+
+  At the end of every epoch the `monitors` of the epoch are recorded in
+  `curves[key]`, a list per trial in a mapping shared by the trials (e.g. a
+  `multiprocessing.Manager().dict()`). From `min_epochs` on, the trial stops
+  when at least `min_dominating` other trials had all their monitors lower,
+  by more than `margin`, at the same epoch. As the trials trade r_loss for
+  kl_loss differently, only a trial beaten on both counts is stopped.
+  """
+
+  def __init__(self, key, curves, monitors = ('r_loss', 'kl_loss'), margin = 0.05,
+               min_epochs = 2, min_dominating = 1, verbose = 0):
+    super(ParetoStopper, self).__init__()
+    self.key = key
+    self.curves = curves
+    self.monitors = monitors
+    self.margin = margin
+    self.min_epochs = min_epochs
+    self.min_dominating = min_dominating
+    self.verbose = verbose
+    self.stopped_epoch = None
+
+  def on_epoch_end(self, epoch, logs = None):
+    values = [float((logs or {})[name]) for name in self.monitors]
+    # Assigned as a whole, a shared mapping does not see changes to its items
+    self.curves[self.key] = list(self.curves.get(self.key, [])) + [values]
+    if epoch + 1 < self.min_epochs:
+      return
+
+    dominating = [key for key, curve in self.curves.items()
+                  if key != self.key and len(curve) > epoch and dominates(curve[epoch], values, self.margin)]
+    if len(dominating) >= self.min_dominating:
+      self.stopped_epoch = epoch + 1
+      self.model.stop_training = True
+      if self.verbose > 0:
+        print('\nEpoch %05d: %s stopped, dominated by %s.' % (epoch + 1, self.key, ', '.join(map(str, dominating))))
+
+
+# INSTRUMENTATION
+class TimedIterator(object):
+  """Wraps a data iterator and records when every batch became available.
+
+  Created by `TrainingMonitor.wrap`. It passes through the attributes of the
+  wrapped iterator, so it can replace it in `fit`/`fit_generator`.
+  """
+
+  def __init__(self, iterator, maxlen = 1024):
+    self.iterator = iterator
+    # (start, end, batch size) of the most recent batches, oldest first
+    self.batches = deque(maxlen = maxlen)
+    self.produced = 0
+    self.lock = threading.Lock()
+
+  def __getattr__(self, name):
+    if name.startswith('_') or name == 'iterator':
+      raise AttributeError(name)
+    return getattr(self.iterator, name)
+
+  def __len__(self):
+    return len(self.iterator)
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    start = time.perf_counter()
+    batch = next(self.iterator)
+    end = time.perf_counter()
+
+    x = batch[0] if isinstance(batch, tuple) else batch
+    with self.lock:
+      self.batches.append((start, end, len(x)))
+      self.produced += 1
+    return batch
+
+  next = __next__
+
+  def get(self, seq):
+    # Timing of the `seq`-th batch, if it is still in the window
+    with self.lock:
+      first = self.produced - len(self.batches)
+      if first <= seq < self.produced:
+        return self.batches[seq - first]
+    return None
+
+
+class _RollingLog(object):
+  # Buffered CSV or JSONL writer (by file extension) that rotates the file
+  # once it grows past `max_bytes`, keeping `backup_count` old files
+
+  def __init__(self, path, max_bytes, backup_count):
+    self.path = path
+    self.csv = path.endswith('.csv')
+    self.max_bytes = max_bytes
+    self.backup_count = backup_count
+    self.fields = None
+    self.rows = []
+    self.file = None
+
+  def _open(self):
+    folder = os.path.dirname(self.path)
+    if folder and not os.path.exists(folder):
+      os.makedirs(folder)
+    self.file = open(self.path, 'a')
+    if self.csv and self.file.tell() == 0:
+      csv.writer(self.file).writerow(self.fields)
+
+  def _rotate(self):
+    self.file.close()
+    for i in range(self.backup_count - 1, 0, -1):
+      if os.path.exists('%s.%d' % (self.path, i)):
+        os.replace('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+    if self.backup_count > 0:
+      os.replace(self.path, self.path + '.1')
+    else:
+      os.remove(self.path)
+    self._open()
+
+  def append(self, row):
+    if self.fields is None:
+      self.fields = list(row)
+    self.rows.append(row)
+
+  def flush(self):
+    if not self.rows:
+      return
+    if self.file is None:
+      self._open()
+
+    if self.csv:
+      csv.DictWriter(self.file, self.fields, extrasaction = 'ignore').writerows(self.rows)
+    else:
+      self.file.write(''.join(json.dumps(row) + '\n' for row in self.rows))
+    self.file.flush()
+    self.rows = []
+
+    if self.file.tell() > self.max_bytes:
+      self._rotate()
+
+  def close(self):
+    self.flush()
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+
+class TrainingMonitor(Callback):
+  """Logs the time every training step spends waiting for data and computing.
+
+  Pass the data through `wrap` so the monitor knows when every batch became
+  available:
+
+    monitor = TrainingMonitor('logs/vae.csv', trace_path = 'logs/vae_trace.json')
+    vae_model.fit(monitor.wrap(data_flow), ..., callbacks = [monitor])
+
+  A step waited for data when its batch only became available after the
+  step started; the rest of the step counts as compute. Every step is logged
+  with its throughput, the peak RSS of the process and the metrics Keras
+  reports (such as r_loss and kl_loss, averaged over the epoch so far) to
+  `log_path`, a rolling .csv or .jsonl file. With `trace_path`, the steps
+  and the batch loading are also written as a Chrome trace (chrome://tracing)
+  at the end of training, capped at `max_trace_events` events.
+  """
+
+  def __init__(self, log_path, trace_path = None, max_bytes = 50 * 2**20,
+               backup_count = 3, flush_every = 100, max_trace_events = 200000):
+    super(TrainingMonitor, self).__init__()
+    self.log = _RollingLog(log_path, max_bytes, backup_count)
+    self.trace_path = trace_path
+    self.flush_every = flush_every
+    self.max_trace_events = max_trace_events
+    self.data = None
+
+  def wrap(self, iterator):
+    self.data = TimedIterator(iterator)
+    return self.data
+
+  def _trace(self, name, tid, start, end):
+    if self.trace_path is not None and len(self.events) < self.max_trace_events:
+      self.events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': tid,
+                          'ts': 1e6 * (start - self.start), 'dur': 1e6 * (end - start)})
+
+  def on_train_begin(self, logs = None):
+    self.start = time.perf_counter()
+    self.last_step_end = self.start
+    self.events = []
+    self.epoch = 0
+    # Batches consumed so far; the data iterator keeps running across epochs
+    self.global_step = 0
+
+  def on_epoch_begin(self, epoch, logs = None):
+    self.epoch = epoch
+
+  def on_train_batch_begin(self, batch, logs = None):
+    self.step_start = time.perf_counter()
+
+  def on_train_batch_end(self, batch, logs = None):
+    end = time.perf_counter()
+    step_time = end - self.step_start
+    row = {'epoch': self.epoch, 'step': batch, 'time': end - self.start,
+           'step_time': step_time, 'data_wait': None, 'compute': None,
+           'images_per_sec': None,
+           'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+
+    timing = self.data.get(self.global_step) if self.data is not None else None
+    if timing is not None:
+      load_start, ready, batch_size = timing
+      data_wait = min(max(ready - self.step_start, 0.), step_time)
+      row['data_wait'] = data_wait
+      row['compute'] = step_time - data_wait
+      row['images_per_sec'] = batch_size / (end - self.last_step_end)
+
+      self._trace('load_batch', 1, load_start, ready)
+      if data_wait > 0:
+        self._trace('data_wait', 0, self.step_start, self.step_start + data_wait)
+      self._trace('compute', 0, self.step_start + data_wait, end)
+    else:
+      self._trace('step', 0, self.step_start, end)
+
+    for name, value in (logs or {}).items():
+      row[name] = float(value)
+
+    self.log.append(row)
+    if len(self.log.rows) >= self.flush_every:
+      self.log.flush()
+
+    self.global_step += 1
+    self.last_step_end = end
+
+  def on_epoch_end(self, epoch, logs = None):
+    self.log.flush()
+
+  def on_train_end(self, logs = None):
+    self.log.close()
+    if self.trace_path is not None:
+      with open(self.trace_path, 'w') as f:
+        json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,258 @@
+"""Asynchronous, rotating checkpoints that can resume training.
+
+`CheckpointManager` replaces `ModelCheckpoint(..., save_weights_only = True)`.
+At the end of every epoch (or every `save_freq` steps) it copies the weights
+and the optimizer state into memory and writes them on a background thread,
+so training does not wait for the disk. Every checkpoint is written to a
+temporary file and renamed into place, and the last `keep` checkpoints are
+kept, so a crash during a write never corrupts the latest good checkpoint.
+
+The checkpoints use the layout of `model.save_weights('weights.h5')`, so
+`model.load_weights` reads them as usual, and the latest one is also linked
+to `weights.h5` in the checkpoint folder.
+"""
+
+import glob
+import os
+import queue
+import shutil
+import threading
+
+import h5py
+import tensorflow as tf
+
+import keras
+from keras import backend as K
+from keras.callbacks import Callback
+
+CHECKPOINT_PATTERN = 'ckpt-epoch%05d-step%09d.h5'
+WEIGHTS_FILE = 'weights.h5'
+
+
+def _optimizer_variables(optimizer):
+  # A method of the legacy optimizers, a property of the newer ones
+  variables = optimizer.variables
+  return list(variables() if callable(variables) else variables)
+
+
+def snapshot(model, epoch, epoch_step):
+  """Copies the weights and the optimizer state of `model` into memory."""
+  layers = []
+  for layer in model.layers:
+    weights = layer.weights
+    layers.append((layer.name, [w.name for w in weights], K.batch_get_value(weights)))
+
+  optimizer_weights = []
+  if model.optimizer is not None:
+    variables = _optimizer_variables(model.optimizer)
+    optimizer_weights = list(zip([v.name for v in variables], K.batch_get_value(variables)))
+
+  step = int(K.get_value(model.optimizer.iterations)) if model.optimizer is not None else 0
+  return {'layers': layers, 'optimizer_weights': optimizer_weights,
+          'epoch': epoch, 'epoch_step': epoch_step, 'step': step}
+
+
+def write_checkpoint(path, state):
+  """Writes a `snapshot` to `path`, atomically."""
+  tmp_path = path + '.tmp'
+
+  with h5py.File(tmp_path, 'w') as f:
+    # Same layout as keras' save_weights
+    f.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in state['layers']]
+    f.attrs['backend'] = K.backend().encode('utf8')
+    f.attrs['keras_version'] = keras.__version__.encode('utf8')
+    for name, weight_names, values in sorted(state['layers'], key = lambda layer: layer[0]):
+      group = f.create_group(name)
+      group.attrs['weight_names'] = [weight_name.encode('utf8') for weight_name in weight_names]
+      for weight_name, value in zip(weight_names, values):
+        group.create_dataset(weight_name, data = value)
+
+    group = f.create_group('optimizer_weights')
+    group.attrs['weight_names'] = [name.encode('utf8') for name, _ in state['optimizer_weights']]
+    for i, (_, value) in enumerate(state['optimizer_weights']):
+      group.create_dataset('%05d' % i, data = value)
+
+    for key in ('epoch', 'epoch_step', 'step'):
+      f.attrs[key] = state[key]
+
+  with open(tmp_path, 'rb+') as f:
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+
+
+def read_checkpoint_info(path):
+  with h5py.File(path, 'r') as f:
+    return {key: int(f.attrs[key]) for key in ('epoch', 'epoch_step', 'step')}
+
+
+def restore_checkpoint(model, path):
+  """Loads the weights and, if the model is compiled, the optimizer state."""
+  model.load_weights(path)
+
+  with h5py.File(path, 'r') as f:
+    group = f['optimizer_weights']
+    values = [group['%05d' % i][()] for i in range(len(group.attrs['weight_names']))]
+    info = {key: int(f.attrs[key]) for key in ('epoch', 'epoch_step', 'step')}
+
+  if model.optimizer is not None and values:
+    variables = model.trainable_weights
+    if len(_optimizer_variables(model.optimizer)) < len(values):
+      # The slots are created on the first update. Zero gradients create them
+      # without moving the weights, and all of them are overwritten below
+      model.optimizer.apply_gradients(zip([tf.zeros_like(v) for v in variables], variables))
+
+    optimizer_variables = _optimizer_variables(model.optimizer)
+    if len(optimizer_variables) != len(values):
+      raise ValueError('The checkpoint %s holds %d optimizer weights, the optimizer of the '
+                       'model has %d' % (path, len(values), len(optimizer_variables)))
+    K.batch_set_value(zip(optimizer_variables, values))
+
+  return info
+
+
+class CheckpointManager(Callback):
+  """Saves rotating checkpoints of the model in `directory` on a background thread.
+
+  `save_freq` is 'epoch' or a number of training steps. Before training,
+  `restore` loads the latest checkpoint and returns the epoch to resume from
+  and the steps of that epoch already done:
+
+    checkpoint = CheckpointManager('weights/VAE', keep = 5)
+    initial_epoch, epoch_step = checkpoint.restore(vae_model)
+    vae_model.fit(..., initial_epoch = initial_epoch, callbacks = [checkpoint])
+
+  The optimizer step count is restored with the optimizer state. A checkpoint
+  saved in the middle of an epoch has a nonzero `epoch_step`; the caller
+  trains only the steps left in that epoch, on fresh batches (see
+  `face_gen.train.fit_resumed`). The step numbers of the checkpoints saved
+  during that epoch count from the start of the epoch. A step checkpoint
+  that falls on the last batch of an epoch is saved as the start of the
+  next epoch, with `epoch_step` 0.
+  """
+
+  def __init__(self, directory, keep = 5, save_freq = 'epoch', verbose = 1):
+    super(CheckpointManager, self).__init__()
+    if keep < 1:
+      raise ValueError('keep must be at least 1, not %r' % (keep,))
+    self.directory = directory
+    self.keep = keep
+    self.save_freq = save_freq
+    self.verbose = verbose
+
+    self.epoch = 0
+    # Steps of the current epoch done before the restored checkpoint
+    self.epoch_step = 0
+    self._queue = queue.Queue(maxsize = 1)
+    self._error = None
+    self._writer = None
+
+  # CHECKPOINT FILES
+  def checkpoints(self):
+    # Oldest first
+    return sorted(glob.glob(os.path.join(self.directory, 'ckpt-epoch*-step*.h5')))
+
+  def latest(self):
+    checkpoints = self.checkpoints()
+    return checkpoints[-1] if checkpoints else None
+
+  def clear(self):
+    """Deletes the checkpoints of the directory, e.g. to train it again from scratch."""
+    for path in self.checkpoints() + [os.path.join(self.directory, WEIGHTS_FILE)]:
+      if os.path.exists(path):
+        os.remove(path)
+
+  def restore(self, model, path = None):
+    """Restores the latest checkpoint into `model` and returns `(epoch, epoch_step)`,
+    the epoch to resume from and the steps of that epoch already done."""
+    path = path or self.latest()
+    if path is None:
+      return 0, 0
+
+    info = restore_checkpoint(model, path)
+    self.epoch_step = info['epoch_step']
+    if self.verbose > 0:
+      print('Restored %s (epoch %d, step %d)' % (path, info['epoch'], info['step']))
+    return info['epoch'], info['epoch_step']
+
+  # BACKGROUND WRITES
+  def _write(self):
+    while True:
+      state = self._queue.get()
+      if state is None:
+        self._queue.task_done()
+        break
+
+      try:
+        path = os.path.join(self.directory, CHECKPOINT_PATTERN % (state['epoch'], state['step']))
+        write_checkpoint(path, state)
+        self._link_latest(path)
+        for old in self.checkpoints()[:-self.keep]:
+          os.remove(old)
+        if self.verbose > 0:
+          print('\nSaved checkpoint %s' % path)
+      except Exception as e:
+        self._error = e
+      finally:
+        self._queue.task_done()
+
+  def _link_latest(self, path):
+    weights_path = os.path.join(self.directory, WEIGHTS_FILE)
+    tmp_path = weights_path + '.tmp'
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    try:
+      os.link(path, tmp_path)
+    except OSError:
+      shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, weights_path)
+
+  def _raise_error(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise RuntimeError('Writing a checkpoint failed: %r' % error)
+
+  def save(self, epoch, epoch_step = 0):
+    """Snapshots the model now and writes the checkpoint in the background.
+
+    `epoch` is the index of the epoch to resume from, i.e. the number of
+    complete epochs for a checkpoint at the end of an epoch.
+    """
+    self._raise_error()
+    if self._writer is None or not self._writer.is_alive():
+      if not os.path.exists(self.directory):
+        os.makedirs(self.directory)
+      self._writer = threading.Thread(target = self._write, daemon = True)
+      self._writer.start()
+
+    # Blocks only while the previous checkpoint is still queued
+    self._queue.put(snapshot(self.model, epoch, epoch_step))
+
+  def wait(self):
+    """Blocks until every checkpoint is written."""
+    if self._writer is not None and self._writer.is_alive():
+      self._queue.join()
+    self._raise_error()
+
+  # CALLBACK
+  def on_epoch_begin(self, epoch, logs = None):
+    self.epoch = epoch
+
+  def on_train_batch_end(self, batch, logs = None):
+    epoch_step = self.epoch_step + batch + 1
+    if self.save_freq != 'epoch' and epoch_step % self.save_freq == 0:
+      if batch + 1 == self.params.get('steps'):
+        # The epoch is complete, resuming starts the next one
+        self.save(self.epoch + 1)
+      else:
+        self.save(self.epoch, epoch_step)
+
+  def on_epoch_end(self, epoch, logs = None):
+    self.epoch_step = 0
+    if self.save_freq == 'epoch':
+      self.save(epoch + 1)
+
+  def on_train_end(self, logs = None):
+    self.wait()
+    if self._writer is not None and self._writer.is_alive():
+      self._queue.put(None)
+      self._writer.join()
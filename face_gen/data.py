@@ -0,0 +1,599 @@
+"""Input pipeline for the CelebA images.
+
+Decoding and resizing every JPEG again on every epoch dominates the training
+time on CPU, so the images are decoded and resized only once into a cache of
+memory-mapped uint8 shards. Batches are then sliced straight out of the cache.
+
+The JPEGs are read straight from the downloaded zip file, so the ~200k small
+files never have to be extracted to disk, and a `ParallelLoader` can spread the
+decoding over several worker processes.
+"""
+
+import ctypes
+import io
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from functools import partial
+from multiprocessing import Pool
+from zipfile import ZipFile
+
+import numpy as np
+from PIL import Image
+
+CACHE_INDEX = 'index.json'
+CACHE_FILENAMES = 'filenames.txt'
+
+PIL_INTERPOLATION = {
+  'nearest': Image.NEAREST,
+  'bilinear': Image.BILINEAR,
+  'bicubic': Image.BICUBIC,
+  'lanczos': Image.LANCZOS,
+}
+
+
+def load_image(path, target_size, interpolation = 'nearest'):
+  # Same steps as keras.preprocessing.image.load_img, so the cached images
+  # match the ones flow_from_directory used to produce
+  with Image.open(path) as img:
+    img = img.convert('RGB')
+    width_height = (target_size[1], target_size[0])
+    if img.size != width_height:
+      img = img.resize(width_height, PIL_INTERPOLATION[interpolation])
+    return np.asarray(img, dtype = np.uint8)
+
+
+# ZIP ARCHIVE
+class ZipImageReader(object):
+  """Random access to the images inside a zip archive, without extracting it.
+
+  The member index is built once, when the reader is created. Every thread
+  and every worker process opens its own handle on the archive, so reads
+  never contend on a shared file position.
+  """
+
+  def __init__(self, zip_path, suffix = '.jpg'):
+    self.zip_path = zip_path
+
+    with ZipFile(zip_path) as archive:
+      members = [info for info in archive.infolist()
+                 if info.filename.lower().endswith(suffix) and not info.is_dir()]
+
+    self.members = sorted(members, key = lambda info: info.filename)
+    self.filenames = [info.filename for info in self.members]
+    self._local = threading.local()
+
+  def __len__(self):
+    return len(self.members)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_local']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._local = threading.local()
+
+  def _archive(self):
+    # A handle inherited through fork shares its file position with the
+    # parent, so it is reopened in every new process
+    if getattr(self._local, 'pid', None) != os.getpid():
+      self._local.archive = ZipFile(self.zip_path)
+      self._local.pid = os.getpid()
+    return self._local.archive
+
+  def read_bytes(self, i):
+    return self._archive().read(self.members[i])
+
+  def load_image(self, i, target_size, interpolation = 'nearest'):
+    return load_image(io.BytesIO(self.read_bytes(i)), target_size, interpolation)
+
+
+# Set once per pool worker by the initializer, so the reader (and its index)
+# is not pickled again with every task
+_worker_load = None
+
+def _init_worker(load):
+  global _worker_load
+  _worker_load = load
+
+def _worker_load_item(item):
+  return _worker_load(item)
+
+
+# CACHE
+def build_cache(source, cache_folder, target_size, shard_size = 10000,
+                shuffle_seed = 0, interpolation = 'nearest', workers = None,
+                overwrite = False):
+  """Decodes and resizes the images once into memory-mapped uint8 shards.
+
+  `source` is either a list of image filenames or a `ZipImageReader`.
+
+  The images are written in a random order (unless `shuffle_seed` is None),
+  so contiguous slices of the cache are already well mixed. The index file is
+  written last; an existing complete cache is reused unless `overwrite` is set.
+  """
+  image_shape = (target_size[0], target_size[1], 3)
+  index_path = os.path.join(cache_folder, CACHE_INDEX)
+
+  if os.path.exists(index_path) and not overwrite:
+    dataset = CachedDataset(cache_folder)
+    if dataset.image_shape != image_shape:
+      raise ValueError('Cache in %s holds images of shape %s, expected %s. '
+                       'Use another folder or overwrite = True.'
+                       % (cache_folder, dataset.image_shape, image_shape))
+    return dataset
+
+  if not os.path.exists(cache_folder):
+    os.makedirs(cache_folder)
+
+  if isinstance(source, ZipImageReader):
+    filenames = np.asarray(source.filenames)
+    items = np.arange(len(source))
+    load = partial(source.load_image, target_size = target_size, interpolation = interpolation)
+  else:
+    filenames = np.asarray(source)
+    items = filenames
+    load = partial(load_image, target_size = target_size, interpolation = interpolation)
+
+  if shuffle_seed is not None:
+    order = np.random.RandomState(shuffle_seed).permutation(len(filenames))
+    filenames, items = filenames[order], items[order]
+
+  shard_sizes = []
+
+  with Pool(workers, initializer = _init_worker, initargs = (load,)) as pool:
+    for start in range(0, len(filenames), shard_size):
+      shard_items = items[start:start + shard_size]
+      shard_path = os.path.join(cache_folder, 'shard_%05d.npy' % len(shard_sizes))
+      tmp_path = shard_path + '.tmp'
+
+      shard = np.lib.format.open_memmap(tmp_path, mode = 'w+', dtype = np.uint8,
+                                        shape = (len(shard_items),) + image_shape)
+      for i, img in enumerate(pool.imap(_worker_load_item, shard_items, chunksize = 64)):
+        shard[i] = img
+      shard.flush()
+      del shard
+      os.replace(tmp_path, shard_path)
+
+      shard_sizes.append(len(shard_items))
+      print("Cached %d / %d images" % (start + len(shard_items), len(filenames)))
+
+  with open(os.path.join(cache_folder, CACHE_FILENAMES), 'w') as f:
+    f.write('\n'.join(str(name) for name in filenames))
+
+  with open(index_path + '.tmp', 'w') as f:
+    json.dump({'image_shape': list(image_shape),
+               'shard_sizes': shard_sizes,
+               'interpolation': interpolation}, f)
+  os.replace(index_path + '.tmp', index_path)
+
+  return CachedDataset(cache_folder)
+
+
+class CachedDataset(object):
+  """Read-only view of a cache written by `build_cache`."""
+
+  def __init__(self, cache_folder):
+    self.cache_folder = cache_folder
+
+    with open(os.path.join(cache_folder, CACHE_INDEX)) as f:
+      index = json.load(f)
+    with open(os.path.join(cache_folder, CACHE_FILENAMES)) as f:
+      self.filenames = f.read().split('\n')
+
+    self.image_shape = tuple(index['image_shape'])
+    self.shard_sizes = index['shard_sizes']
+    self.offsets = np.cumsum([0] + self.shard_sizes)
+    self._shards = None
+
+  def __len__(self):
+    return int(self.offsets[-1])
+
+  # The memory maps are opened lazily and not pickled, so every worker
+  # process maps the shards itself
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_shards'] = None
+    return state
+
+  @property
+  def shards(self):
+    if self._shards is None:
+      self._shards = [np.load(os.path.join(self.cache_folder, 'shard_%05d.npy' % i), mmap_mode = 'r')
+                      for i in range(len(self.shard_sizes))]
+    return self._shards
+
+  def read(self, index, out = None):
+    """Returns the images at `index` (a slice or an array of indices).
+
+    A slice that falls inside a single shard is returned as a view of the
+    memory map, without copying, unless `out` is given.
+    """
+    if isinstance(index, slice):
+      start, stop, step = index.indices(len(self))
+      shard = int(np.searchsorted(self.offsets, start, side = 'right')) - 1
+      if start < stop and stop <= self.offsets[shard + 1]:
+        offset = self.offsets[shard]
+        view = self.shards[shard][start - offset:stop - offset:step]
+        if out is None:
+          return view
+        out[:len(view)] = view
+        return out[:len(view)]
+      index = np.arange(start, stop, step)
+
+    index = np.asarray(index)
+    if out is None:
+      out = np.empty((len(index),) + self.image_shape, dtype = np.uint8)
+    else:
+      out = out[:len(index)]
+
+    shard_ids = np.searchsorted(self.offsets, index, side = 'right') - 1
+    for shard in np.unique(shard_ids):
+      positions = np.flatnonzero(shard_ids == shard)
+      local = index[positions] - self.offsets[shard]
+      # Read each shard in ascending order to keep the page cache happy
+      order = np.argsort(local, kind = 'stable')
+      out[positions[order]] = self.shards[shard][local[order]]
+
+    return out
+
+
+# ITERATORS
+def partition_range(n, partition):
+  # First image and number of images of partition `index` of `count` equal,
+  # contiguous partitions. The last n % count images are left out, so every
+  # partition yields the same number of batches
+  if partition is None:
+    return 0, n
+  index, count = partition
+  size = n // count
+  return index * size, size
+
+
+def split_range(n, validation_split, subset):
+  # First image and number of images of `subset` ('training', 'validation',
+  # or None for all of them). The validation images are the last
+  # `validation_split` of the source, which the cache already shuffled
+  if subset is None:
+    return 0, n
+  if subset not in ('training', 'validation'):
+    raise ValueError("subset must be 'training', 'validation' or None, not %r" % (subset,))
+  if not 0. <= validation_split < 1.:
+    raise ValueError('validation_split must be in [0, 1), not %r' % (validation_split,))
+  n_validation = int(round(n * validation_split))
+  if subset == 'validation':
+    if not n_validation:
+      raise ValueError('The validation subset is empty, set validation_split')
+    return n - n_validation, n_validation
+  return 0, n - n_validation
+
+
+# Images per window of the 'window' shuffle, the size of a cache shard
+SHUFFLE_WINDOW = 10000
+
+
+class BatchIterator(object):
+  """Endless, thread-safe iterator over batches of `n` images.
+
+  It can be passed wherever a Keras `DirectoryIterator` was used, including
+  `fit_generator` and `next(data_flow)`. Subclasses implement `_load_batch`.
+
+  `shuffle` is one of:
+    False    - batches are contiguous slices, in order
+    'batch'  - batches are contiguous slices, visited in a random order.
+               The fastest, but every batch holds the same images on
+               every epoch
+    'window' - every epoch permutes the images within windows of
+               `shuffle_window` contiguous images and visits the windows
+               in a random order, so the batches change from epoch to epoch
+               while every batch reads from a single region of the source
+    True     - every epoch uses a fresh permutation of all the images
+
+  The images are scaled by `rescale` into float32 batches, or stay uint8 if
+  `rescale` is None. `class_mode` is 'input' (yields `(x, x)`) or None
+  (yields `x` only).
+
+  The iterator covers the images `start` to `start + n` of the source, e.g.
+  one partition of it for data-parallel training. Like `flow_from_directory`,
+  the subclasses hold out the last `validation_split` of the images:
+  `subset = 'training'` iterates over the rest, `subset = 'validation'` over
+  them.
+  """
+
+  def __init__(self, n, batch_size, shuffle, seed, rescale, class_mode, start = 0,
+               shuffle_window = SHUFFLE_WINDOW):
+    self.n = n
+    self.start = start
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.shuffle_window = shuffle_window
+    self.seed = seed
+    self.rescale = rescale
+    self.class_mode = class_mode
+
+    self.epoch = 0
+    self.batch_index = 0
+    self.lock = threading.Lock()
+    self._set_batch_order()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.lock = threading.Lock()
+
+  @property
+  def samples(self):
+    return self.n
+
+  def __len__(self):
+    return (self.n + self.batch_size - 1) // self.batch_size
+
+  def _set_batch_order(self):
+    seed = None if self.seed is None else self.seed + self.epoch
+    rng = np.random.RandomState(seed)
+
+    self.index_array = None
+    self.batch_order = np.arange(len(self))
+
+    if self.shuffle == 'batch':
+      self.batch_order = rng.permutation(len(self))
+    elif self.shuffle == 'window':
+      # Sorted by the random rank of the window, then by a random key within it
+      windows = np.arange(self.n) // self.shuffle_window
+      window_order = rng.permutation(windows[-1] + 1 if self.n else 0)
+      self.index_array = np.lexsort((rng.random_sample(self.n), window_order[windows]))
+    elif self.shuffle:
+      self.index_array = rng.permutation(self.n)
+
+  def _batch_indices(self, idx):
+    # Returns a slice whenever possible, so the batch can be read without
+    # gathering individual images
+    if self.index_array is not None:
+      start = idx * self.batch_size
+      return self.index_array[start:start + self.batch_size] + self.start
+
+    start = self.batch_order[idx] * self.batch_size
+    return slice(self.start + start, self.start + min(start + self.batch_size, self.n))
+
+  def on_epoch_end(self):
+    self.epoch += 1
+    self._set_batch_order()
+
+  def reset(self):
+    self.batch_index = 0
+
+  def __iter__(self):
+    return self
+
+  def _next_indices(self):
+    with self.lock:
+      if self.batch_index >= len(self):
+        self.on_epoch_end()
+        self.reset()
+      indices = self._batch_indices(self.batch_index)
+      self.batch_index += 1
+    return indices
+
+  def __next__(self):
+    return self._format_batch(self._load_batch(self._next_indices()))
+
+  next = __next__
+
+  def __getitem__(self, idx):
+    if idx >= len(self):
+      raise IndexError('Asked to retrieve batch %d, but the iterator has only '
+                       '%d batches' % (idx, len(self)))
+    return self._format_batch(self._load_batch(self._batch_indices(idx)))
+
+  def _load_batch(self, indices, out = None):
+    raise NotImplementedError
+
+  def _format_batch(self, batch, copy = False):
+    # Without rescale the batch stays uint8 and is only copied if asked to,
+    # e.g. when it lives in a buffer that is about to be reused
+    if self.rescale is None:
+      x = np.array(batch) if copy else np.asarray(batch)
+    else:
+      x = batch.astype(np.float32)
+      x *= self.rescale
+
+    # class_mode = 'input' uses the images as the targets too. Both are the
+    # same array, the targets are not a second copy of the batch
+    if self.class_mode == 'input':
+      return x, x
+    return x
+
+
+class CacheIterator(BatchIterator):
+  """Iterates over a `CachedDataset`.
+
+  The default `shuffle = 'window'` changes the contents of the batches from
+  epoch to epoch while reading every batch from one window of the cache.
+  The cache is shuffled once when it is built, so `shuffle = 'batch'` only
+  visits contiguous batches in a random order, which reads every batch as a
+  single slice of a memory map but keeps the same images together on every
+  epoch.
+  """
+
+  def __init__(self, dataset, batch_size = 32, shuffle = 'window', seed = None,
+               rescale = 1./255, class_mode = 'input', partition = None,
+               validation_split = 0., subset = None, shuffle_window = SHUFFLE_WINDOW):
+    self.dataset = dataset
+    self.filenames = dataset.filenames
+    self.image_shape = dataset.image_shape
+    split_start, split_n = split_range(len(dataset), validation_split, subset)
+    start, n = partition_range(split_n, partition)
+    super(CacheIterator, self).__init__(n, batch_size, shuffle, seed,
+                                        rescale, class_mode, split_start + start, shuffle_window)
+
+  def _load_batch(self, indices, out = None):
+    return self.dataset.read(indices, out = out)
+
+
+class ZipIterator(BatchIterator):
+  """Decodes batches straight from a `ZipImageReader`.
+
+  Nothing has to be extracted or cached first, so training can start as soon
+  as the archive is downloaded, at the cost of decoding every image on every
+  epoch.
+  """
+
+  def __init__(self, reader, target_size, batch_size = 32, shuffle = True,
+               seed = None, rescale = 1./255, class_mode = 'input',
+               interpolation = 'nearest', partition = None, validation_split = 0., subset = None):
+    self.reader = reader
+    self.filenames = reader.filenames
+    self.target_size = tuple(target_size)
+    self.image_shape = self.target_size + (3,)
+    self.interpolation = interpolation
+    split_start, split_n = split_range(len(reader), validation_split, subset)
+    start, n = partition_range(split_n, partition)
+    super(ZipIterator, self).__init__(n, batch_size, shuffle, seed,
+                                      rescale, class_mode, split_start + start)
+
+  def _load_batch(self, indices, out = None):
+    if isinstance(indices, slice):
+      indices = range(indices.start, indices.stop)
+    if out is None:
+      out = np.empty((len(indices),) + self.image_shape, dtype = np.uint8)
+
+    for j, i in enumerate(indices):
+      out[j] = self.reader.load_image(i, self.target_size, self.interpolation)
+    return out[:len(indices)]
+
+
+# PARALLEL LOADING
+def _loader_worker(iterator, buffer, shape, tasks, results):
+  buffers = np.frombuffer(buffer, dtype = np.uint8).reshape(shape)
+
+  while True:
+    task = tasks.get()
+    if task is None:
+      break
+
+    seq, slot, indices = task
+    try:
+      batch = iterator._load_batch(indices, out = buffers[slot])
+      results.put((seq, slot, len(batch), None))
+    except Exception:
+      results.put((seq, slot, 0, traceback.format_exc()))
+
+
+# Default bound of the shared memory of the batches of a ParallelLoader
+PREFETCH_BYTES = 256 * 2**20
+
+
+class ParallelLoader(object):
+  """Loads the batches of a `BatchIterator` in `workers` processes.
+
+  The workers decode straight into a ring of `prefetch` batch buffers in
+  shared memory, so batches are never pickled between processes. Batches
+  are still returned in the order of the wrapped iterator, and the loader
+  can be used wherever the iterator itself was used.
+
+  At most `prefetch` batches are loaded at once. By default the ring holds
+  2 batches per worker but no more than PREFETCH_BYTES (and at least 2
+  batches), so its size does not grow with the number of cores.
+  """
+
+  def __init__(self, iterator, workers = None, prefetch = None, start_method = None):
+    self.iterator = iterator
+    self.workers = workers or os.cpu_count()
+    batch_bytes = iterator.batch_size * int(np.prod(iterator.image_shape))
+    self.prefetch = prefetch or max(2, min(2 * self.workers, PREFETCH_BYTES // batch_bytes))
+    # Time spent in __next__ waiting for the workers
+    self.wait_time = 0.
+
+    context = multiprocessing.get_context(start_method)
+    shape = (self.prefetch, iterator.batch_size) + tuple(iterator.image_shape)
+    buffer = context.RawArray(ctypes.c_uint8, int(np.prod(shape)))
+    self._buffers = np.frombuffer(buffer, dtype = np.uint8).reshape(shape)
+
+    self._tasks = context.Queue()
+    self._results = context.Queue()
+    self._processes = [context.Process(target = _loader_worker,
+                                       args = (iterator, buffer, shape, self._tasks, self._results),
+                                       daemon = True)
+                       for _ in range(self.workers)]
+    for process in self._processes:
+      process.start()
+
+    self.lock = threading.Lock()
+    self._ready = {}
+    self._next_submit = 0
+    self._next_yield = 0
+    for slot in range(self.prefetch):
+      self._submit(slot)
+
+  def __getattr__(self, name):
+    # Passes through n, samples, filenames, batch_size, ... of the iterator
+    if name.startswith('_') or name == 'iterator':
+      raise AttributeError(name)
+    return getattr(self.iterator, name)
+
+  def __len__(self):
+    return len(self.iterator)
+
+  def __iter__(self):
+    return self
+
+  def _submit(self, slot):
+    self._tasks.put((self._next_submit, slot, self.iterator._next_indices()))
+    self._next_submit += 1
+
+  def __next__(self):
+    with self.lock:
+      seq = self._next_yield
+      start = time.time()
+      while seq not in self._ready:
+        try:
+          done, slot, n, error = self._results.get(timeout = 1)
+        except queue.Empty:
+          if not all(process.is_alive() for process in self._processes):
+            raise RuntimeError('A ParallelLoader worker process died unexpectedly')
+          continue
+        if error is not None:
+          raise RuntimeError('Loading batch %d failed in a worker process:\n%s' % (done, error))
+        self._ready[done] = (slot, n)
+      self.wait_time += time.time() - start
+
+      slot, n = self._ready.pop(seq)
+      self._next_yield += 1
+      # The batch is formatted into a new array before the slot is handed
+      # back to the workers
+      batch = self.iterator._format_batch(self._buffers[slot][:n], copy = True)
+      self._submit(slot)
+    return batch
+
+  next = __next__
+
+  def close(self):
+    if not self._processes:
+      return
+    for _ in self._processes:
+      self._tasks.put(None)
+    for process in self._processes:
+      process.join(timeout = 5)
+      if process.is_alive():
+        process.terminate()
+    self._processes = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def __del__(self):
+    if getattr(self, '_processes', None):
+      self.close()
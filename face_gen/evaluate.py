@@ -0,0 +1,195 @@
+"""Evaluates the VAE on the held out images, one score per image.
+
+The images are streamed through the model in large batches and only the
+reconstruction loss and the KL term of every image are kept. The images are
+reconstructed from `mu` rather than from a sampled z, so an image gets the
+same score every time. The scores are written to a (n, 2) float32 .npy
+file, a few bytes per image, so the whole dataset can be scored for outlier
+and anomaly detection. Row `i` is image `i` of the evaluated images,
+`scores.txt` next to it lists their filenames.
+
+  python -m face_gen evaluate --weights weights/VAE/weights.h5 --cache data/cache_128x128/ \\
+      --validation-split 0.05 --scores scores/validation.npy --top 20
+
+During training, `ValidationScorer` runs the same evaluation at the end of
+every epoch within a time budget and adds `val_r_loss` and `val_kl_loss` to
+the logs (`python -m face_gen train --validation-split 0.05 --eval-seconds 60`).
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from keras.callbacks import Callback
+
+SCORE_COLUMNS = ['r_loss', 'kl_loss']
+
+
+def _score_function(vae_model):
+  import tensorflow as tf
+
+  # One trace for every batch size, the last batch is usually smaller
+  @tf.function(input_signature = [tf.TensorSpec((None,) + tuple(vae_model.input_shape[1:]),
+                                                vae_model.input.dtype)])
+  def score(x):
+    _, r_loss, kl = vae_model.compute_losses(x, sample = False)
+    return tf.stack([r_loss, kl], axis = 1)
+
+  return score
+
+
+def _prefetched(data_flow, n_batches):
+  # Reads the next batch on a thread while the current one is scored
+  batches = [None]
+
+  def load(i):
+    batches[0] = data_flow[i]
+
+  thread = threading.Thread(target = load, args = (0,))
+  thread.start()
+  for i in range(n_batches):
+    thread.join()
+    batch = batches[0]
+    if i + 1 < n_batches:
+      thread = threading.Thread(target = load, args = (i + 1,))
+      thread.start()
+    yield batch
+
+
+def evaluate_scores(vae_model, data_flow, scores_path = None, max_seconds = None, score_function = None,
+                    verbose = 0):
+  """r_loss and KL term of every image of `data_flow`, a `BatchIterator` with
+  `shuffle = False` and `class_mode = None` (see `train.make_validation_flow`).
+
+  Returns the mean `r_loss` and `kl_loss` and the number of images scored.
+  With `scores_path`, the per-image scores are written there as they come.
+  With `max_seconds`, the evaluation stops after the first batch that ends
+  past the budget; the images are visited in the same order every time (in
+  the random order of the cache), so the scored part is a consistent sample
+  from one call to the next, and the rows not reached stay NaN.
+  """
+  if data_flow.shuffle is not False or data_flow.class_mode is not None:
+    raise ValueError('data_flow must be built with shuffle = False and class_mode = None')
+
+  score = score_function or _score_function(vae_model)
+  scores = None
+  if scores_path is not None:
+    folder = os.path.dirname(scores_path)
+    if folder and not os.path.exists(folder):
+      os.makedirs(folder)
+    scores = open_memmap(scores_path + '.tmp', mode = 'w+', dtype = np.float32,
+                         shape = (data_flow.n, len(SCORE_COLUMNS)))
+    scores[:] = np.nan
+
+  started = time.perf_counter()
+  totals = np.zeros(len(SCORE_COLUMNS), dtype = np.float64)
+  n = 0
+  for x in _prefetched(data_flow, len(data_flow)):
+    batch_scores = score(x).numpy()
+    if scores is not None:
+      scores[n:n + len(batch_scores)] = batch_scores
+    totals += batch_scores.sum(axis = 0, dtype = np.float64)
+    n += len(batch_scores)
+    if max_seconds is not None and time.perf_counter() - started > max_seconds:
+      break
+
+  if scores is not None:
+    scores.flush()
+    del scores
+    os.replace(scores_path + '.tmp', scores_path)
+    with open(os.path.splitext(scores_path)[0] + '.txt', 'w') as f:
+      f.write('\n'.join(data_flow.filenames[data_flow.start:data_flow.start + data_flow.n]))
+
+  if verbose > 0:
+    print('Scored %d / %d images in %.1f s' % (n, data_flow.n, time.perf_counter() - started))
+  means = totals / max(n, 1)
+  return {'r_loss': float(means[0]), 'kl_loss': float(means[1]), 'count': n}
+
+
+class ValidationScorer(Callback):
+  """Evaluates the held out images every `every` epochs, within `max_seconds`.
+
+  Adds `val_r_loss`, `val_kl_loss` and `val_count` (the number of images that
+  fitted in the budget) to the logs of the epoch. With `scores_folder`, the
+  per-image scores of every evaluation are kept as `epoch<epoch>.npy`.
+  """
+
+  def __init__(self, data_flow, max_seconds = 60., every = 1, scores_folder = None, verbose = 0):
+    super(ValidationScorer, self).__init__()
+    self.data_flow = data_flow
+    self.max_seconds = max_seconds
+    self.every = every
+    self.scores_folder = scores_folder
+    self.verbose = verbose
+    self._score = None
+
+  def on_epoch_end(self, epoch, logs = None):
+    if (epoch + 1) % self.every:
+      return
+    if self._score is None:
+      self._score = _score_function(self.model)
+
+    scores_path = None
+    if self.scores_folder is not None:
+      scores_path = os.path.join(self.scores_folder, 'epoch%05d.npy' % (epoch + 1))
+    result = evaluate_scores(self.model, self.data_flow, scores_path, self.max_seconds, self._score)
+
+    if logs is not None:
+      logs['val_r_loss'] = result['r_loss']
+      logs['val_kl_loss'] = result['kl_loss']
+      logs['val_count'] = result['count']
+    if self.verbose > 0:
+      print('\nEpoch %05d: val_r_loss %.5g, val_kl_loss %.5g on %d images.'
+            % (epoch + 1, result['r_loss'], result['kl_loss'], result['count']))
+
+
+# COMMAND LINE
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+  parser.add_argument('--weights', default = './weights/VAE/weights.h5')
+  parser.add_argument('--cache', required = True, help = 'cache folder of the images')
+  parser.add_argument('--validation-split', type = float, default = 0.,
+                      help = 'score the last VALIDATION_SPLIT of the cache, by default all of it')
+  parser.add_argument('--scores', default = None, help = '.npy file of the per-image scores')
+  parser.add_argument('--batch-size', type = int, default = 1024)
+  parser.add_argument('--max-seconds', type = float, default = None)
+  parser.add_argument('--top', type = int, default = 0, help = 'list the images with the highest r_loss')
+  parser.add_argument('--loss-factor', type = float, default = 10000)
+  parser.add_argument('--z-dim', type = int, default = 200)
+  args = parser.parse_args(argv)
+
+  if args.top and not args.scores:
+    parser.error('--top needs --scores')
+
+  from keras import backend as K
+  from face_gen.data import CachedDataset, CacheIterator
+  from face_gen.models import load_vae
+
+  dataset = CachedDataset(args.cache)
+  data_flow = CacheIterator(dataset, batch_size = args.batch_size, shuffle = False, rescale = None,
+                            class_mode = None, validation_split = args.validation_split,
+                            subset = 'validation' if args.validation_split else None)
+  _, _, vae_model = load_vae(args.weights, dataset.image_shape, args.z_dim)
+  K.set_value(vae_model.loss_factor, args.loss_factor)
+
+  result = evaluate_scores(vae_model, data_flow, args.scores, args.max_seconds, verbose = 1)
+  print('r_loss  : %.6g' % result['r_loss'])
+  print('kl_loss : %.6g' % result['kl_loss'])
+
+  if args.top and args.scores:
+    scores = np.load(args.scores, mmap_mode = 'r')
+    r_loss = np.nan_to_num(scores[:, 0], nan = -np.inf)
+    rows = np.argsort(-r_loss)[:args.top]
+    for row in rows:
+      print('%s  r_loss %.5g  kl_loss %.5g' % (data_flow.filenames[data_flow.start + row],
+                                                scores[row, 0], scores[row, 1]))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,243 @@
+"""Exports the decoder (and the `mu` encoder) as standalone inference artifacts.
+
+A TFLite file holds the whole graph with its weights folded in as
+constants, optionally quantized after training to float16 (half the size)
+or int8 (a quarter, calibrated on latents from the prior or on cached
+images). A SavedModel is the unquantized alternative. `load_artifact`
+runs either without building the Keras models, and with `tflite_runtime`
+installed the TFLite files load without TensorFlow at all.
+
+  python -m face_gen export --weights weights/VAE/weights.h5 --output exported/ \\
+      --format tflite --quantize float16 --encoder --compare
+  python -m face_gen generate --decoder-artifact exported/decoder.tflite --n 1000 --output generated/
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+QUANTIZATIONS = [None, 'float16', 'int8']
+EXPORT_INFO = 'export.json'
+
+
+# EXPORT
+def _concrete_function(model):
+  import tensorflow as tf
+  spec = tf.TensorSpec((None,) + tuple(model.input_shape[1:]), model.input.dtype, name = 'input')
+  return tf.function(lambda x: model(x, training = False)).get_concrete_function(spec)
+
+
+def export_tflite(model, path, quantize = None, representative_data = None):
+  """Converts `model` to a TFLite file at `path`.
+
+  `quantize = 'int8'` needs `representative_data`, an array of inputs the
+  activation ranges are calibrated on. The inputs and outputs stay float
+  (or uint8 images for the encoder), so the artifact is used the same way
+  whatever the quantization.
+  """
+  import tensorflow as tf
+
+  function = _concrete_function(model)
+  converter = tf.lite.TFLiteConverter.from_concrete_functions([function], model)
+  if quantize is not None:
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  if quantize == 'float16':
+    converter.target_spec.supported_types = [tf.float16]
+  elif quantize == 'int8':
+    if representative_data is None:
+      raise ValueError('int8 quantization needs representative data')
+    converter.representative_dataset = lambda: ([x[None]] for x in representative_data)
+
+  with open(path, 'wb') as f:
+    f.write(converter.convert())
+  return path
+
+
+def export_saved_model(model, path):
+  import tensorflow as tf
+
+  module = tf.Module()
+  module.model = model
+  module.serve = tf.function(lambda x: model(x, training = False),
+                             input_signature = [tf.TensorSpec((None,) + tuple(model.input_shape[1:]),
+                                                              model.input.dtype, name = 'input')])
+  tf.saved_model.save(module, path, signatures = module.serve)
+  return path
+
+
+def export_models(vae_encoder, vae_decoder, output_dir, export_format = 'tflite', quantize = None,
+                  include_encoder = False, calibration_images = None, calibration_size = 512):
+  """Exports the decoder, and the `mu` encoder with `include_encoder`, to `output_dir`.
+
+  The decoder is calibrated on latents drawn from the prior, the encoder on
+  `calibration_images` (uint8 images, e.g. read from the cache).
+  """
+  if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+
+  z_dim = vae_decoder.input_shape[-1]
+  extension = '.tflite' if export_format == 'tflite' else ''
+  models = [('decoder', vae_decoder,
+             np.random.RandomState(0).standard_normal((calibration_size, z_dim)).astype(np.float32))]
+  if include_encoder:
+    from face_gen.latent_index import mu_encoder
+    models.append(('encoder', mu_encoder(vae_encoder), calibration_images))
+
+  paths = {}
+  for name, model, representative_data in models:
+    path = os.path.join(output_dir, name + extension)
+    if export_format == 'tflite':
+      export_tflite(model, path, quantize, representative_data)
+    else:
+      export_saved_model(model, path)
+    paths[name] = path
+
+  with open(os.path.join(output_dir, EXPORT_INFO), 'w') as f:
+    json.dump({'format': export_format,
+               'quantize': quantize,
+               'z_dim': z_dim,
+               'input_dim': list(vae_encoder.input_shape[1:]),
+               'files': {name: os.path.basename(path) for name, path in paths.items()}}, f, indent = 2)
+  return paths
+
+
+# LOADING
+def _tflite_interpreter(path, num_threads):
+  try:
+    from tflite_runtime.interpreter import Interpreter
+  except ImportError:
+    import tensorflow as tf
+    Interpreter = tf.lite.Interpreter
+  return Interpreter(model_path = path, num_threads = num_threads)
+
+
+class TFLiteModel(object):
+  """Runs a TFLite artifact. Not thread-safe: use one per thread."""
+
+  def __init__(self, path, num_threads = None):
+    self.interpreter = _tflite_interpreter(path, num_threads or os.cpu_count())
+    self.input = self.interpreter.get_input_details()[0]
+    self.output = self.interpreter.get_output_details()[0]
+    self.input_shape = tuple(self.input['shape_signature'])
+    self._batch_size = None
+
+  def predict_on_batch(self, x):
+    x = np.asarray(x, dtype = self.input['dtype'])
+    if len(x) != self._batch_size:
+      # The graph is built for a batch size, so it is only resized when the
+      # batch size changes
+      self.interpreter.resize_tensor_input(self.input['index'], x.shape)
+      self.interpreter.allocate_tensors()
+      self._batch_size = len(x)
+    self.interpreter.set_tensor(self.input['index'], x)
+    self.interpreter.invoke()
+    return self.interpreter.get_tensor(self.output['index'])
+
+
+class SavedModelModel(object):
+  """Runs a SavedModel artifact without rebuilding the Keras model."""
+
+  def __init__(self, path):
+    import tensorflow as tf
+    self._serve = tf.saved_model.load(path).signatures['serving_default']
+    spec = self._serve.structured_input_signature[1]['input']
+    self.input_shape = tuple(spec.shape)
+    self._dtype = spec.dtype
+
+  def predict_on_batch(self, x):
+    import tensorflow as tf
+    outputs = self._serve(input = tf.constant(x, dtype = self._dtype))
+    return next(iter(outputs.values())).numpy()
+
+
+def load_artifact(path, num_threads = None):
+  """Loads an exported model; both kinds have `predict_on_batch` like a Keras model."""
+  if path.endswith('.tflite'):
+    return TFLiteModel(path, num_threads)
+  return SavedModelModel(path)
+
+
+# COMPARISON
+def _throughput(model, x, batch_size, repeats = 3):
+  model.predict_on_batch(x[:batch_size])
+  started = time.perf_counter()
+  for _ in range(repeats):
+    for i in range(0, len(x), batch_size):
+      model.predict_on_batch(x[i:i + batch_size])
+  return repeats * len(x) / (time.perf_counter() - started)
+
+
+def compare_decoder(weights_path, artifact_path, input_dim, z_dim, n = 1024, batch_size = 256):
+  """Load time, images/s and mean squared error of the artifact against the Keras decoder."""
+  from face_gen.models import load_decoder
+
+  started = time.perf_counter()
+  decoder = load_decoder(weights_path, input_dim, z_dim)
+  keras_load = time.perf_counter() - started
+
+  started = time.perf_counter()
+  artifact = load_artifact(artifact_path)
+  artifact_load = time.perf_counter() - started
+
+  z = np.random.RandomState(1).standard_normal((n, z_dim)).astype(np.float32)
+  expected = np.concatenate([decoder.predict_on_batch(z[i:i + batch_size]) for i in range(0, n, batch_size)])
+  outputs = np.concatenate([artifact.predict_on_batch(z[i:i + batch_size]) for i in range(0, n, batch_size)])
+
+  return {'keras_load_s': keras_load,
+          'artifact_load_s': artifact_load,
+          'keras_images_per_sec': _throughput(decoder, z, batch_size),
+          'artifact_images_per_sec': _throughput(artifact, z, batch_size),
+          'mse': float(np.mean(np.square(outputs - expected))),
+          'max_abs_error': float(np.max(np.abs(outputs - expected))),
+          'artifact_mb': os.path.getsize(artifact_path) / 2. ** 20 if os.path.isfile(artifact_path) else None}
+
+
+# COMMAND LINE
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+  parser.add_argument('--weights', default = './weights/VAE/weights.h5')
+  parser.add_argument('--output', required = True, help = 'output folder')
+  parser.add_argument('--format', default = 'tflite', choices = ['tflite', 'saved_model'])
+  parser.add_argument('--quantize', default = None, choices = QUANTIZATIONS[1:],
+                      help = 'post-training quantization, TFLite only')
+  parser.add_argument('--encoder', action = 'store_true', help = 'also export the mu encoder')
+  parser.add_argument('--cache', default = None, help = 'cache folder with images to calibrate the int8 encoder on')
+  parser.add_argument('--compare', action = 'store_true', help = 'compare the decoder with the Keras one')
+  parser.add_argument('--input-dim', type = int, default = 128)
+  parser.add_argument('--z-dim', type = int, default = 200)
+  args = parser.parse_args(argv)
+
+  if args.quantize and args.format != 'tflite':
+    parser.error('--quantize needs --format tflite')
+
+  calibration_images = None
+  if args.encoder and args.quantize == 'int8':
+    if not args.cache:
+      parser.error('int8 quantization of the encoder needs --cache')
+    from face_gen.data import CachedDataset
+    dataset = CachedDataset(args.cache)
+    calibration_images = dataset.read(slice(0, min(512, len(dataset.filenames))))
+
+  from face_gen.models import load_vae
+  input_dim = (args.input_dim, args.input_dim, 3)
+  vae_encoder, vae_decoder, _ = load_vae(args.weights, input_dim, args.z_dim)
+
+  paths = export_models(vae_encoder, vae_decoder, args.output, args.format, args.quantize,
+                        include_encoder = args.encoder, calibration_images = calibration_images)
+  for name, path in sorted(paths.items()):
+    print('Exported the %s to %s' % (name, path))
+
+  if args.compare:
+    result = compare_decoder(args.weights, paths['decoder'], input_dim, args.z_dim)
+    print('Load time  : %.3f s (Keras %.3f s)' % (result['artifact_load_s'], result['keras_load_s']))
+    print('Images/s   : %.1f (Keras %.1f)' % (result['artifact_images_per_sec'], result['keras_images_per_sec']))
+    print('MSE        : %.3g (max abs error %.3g)' % (result['mse'], result['max_abs_error']))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,154 @@
+"""Generates faces with the VAE decoder and writes them to disk.
+
+Latent vectors are sampled from a standard normal distribution in large
+batches and decoded with batched inference, while a pool of threads encodes
+and writes the images of the previous batch. The latent vector of every
+image only depends on the seed and the index of the image, so a run can be
+split into ranges (`--start`, `--n`) over several processes or machines and
+still produce the same images.
+
+  python -m face_gen.generate --weights weights/VAE/weights.h5 --n 100000 \\
+      --output generated/
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+# Latent vectors are drawn in fixed blocks, so they do not depend on the
+# batch size
+SEED_BLOCK = 1024
+
+
+def sample_latents(seed, start, count, z_dim):
+  """Latent vectors of the images `start` to `start + count` for `seed`."""
+  first, last = start // SEED_BLOCK, (start + count - 1) // SEED_BLOCK
+  blocks = [np.random.default_rng([seed, block]).standard_normal((SEED_BLOCK, z_dim), dtype = np.float32)
+            for block in range(first, last + 1)]
+  offset = start - first * SEED_BLOCK
+  return np.concatenate(blocks)[offset:offset + count]
+
+
+def to_uint8(images):
+  # Decoder outputs are in [0, 1]
+  return np.clip(images * 255. + 0.5, 0, 255).astype(np.uint8)
+
+
+def image_path(output_dir, index, shard_size, image_format):
+  return os.path.join(output_dir, '%05d' % (index // shard_size), '%09d.%s' % (index, image_format))
+
+
+class ImageWriter(object):
+  """Encodes and writes images on a pool of threads.
+
+  PIL releases the GIL while it encodes, so the threads run in parallel
+  with each other and with the decoder. At most `max_pending` batches are
+  queued; `submit` blocks beyond that to bound the memory use.
+  """
+
+  def __init__(self, workers = None, max_pending = 2, quality = 95):
+    self.workers = workers or os.cpu_count()
+    self.max_pending = max_pending
+    self.quality = quality
+    self.pool = ThreadPoolExecutor(self.workers)
+    self.pending = []
+
+  def _write(self, images, paths):
+    for img, path in zip(images, paths):
+      folder = os.path.dirname(path)
+      if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok = True)
+      if path.endswith('.png'):
+        Image.fromarray(img).save(path, compress_level = 1)
+      else:
+        Image.fromarray(img).save(path, quality = self.quality)
+
+  def _wait(self, max_pending):
+    while len(self.pending) > max_pending:
+      for future in self.pending.pop(0):
+        future.result()
+
+  def submit(self, images, paths):
+    self._wait(self.max_pending - 1)
+    chunk = (len(images) + self.workers - 1) // self.workers
+    self.pending.append([self.pool.submit(self._write, images[i:i + chunk], paths[i:i + chunk])
+                         for i in range(0, len(images), chunk)])
+
+  def close(self):
+    self._wait(0)
+    self.pool.shutdown()
+
+
+def generate_faces(decoder, n_images, output_dir, z_dim, start = 0, batch_size = 1024,
+                   seed = 0, image_format = 'png', shard_size = 10000, workers = None,
+                   quality = 95, verbose = 1):
+  """Decodes `n_images` faces and writes them to sharded folders of `output_dir`.
+
+  Image `i` is written to `output_dir/<i // shard_size>/<i>.<image_format>`.
+  """
+  writer = ImageWriter(workers, quality = quality)
+  started = time.time()
+
+  try:
+    for batch_start in range(start, start + n_images, batch_size):
+      count = min(batch_size, start + n_images - batch_start)
+      z = sample_latents(seed, batch_start, count, z_dim)
+      images = to_uint8(decoder.predict_on_batch(z))
+
+      paths = [image_path(output_dir, i, shard_size, image_format)
+               for i in range(batch_start, batch_start + count)]
+      writer.submit(images, paths)
+
+      if verbose > 0:
+        done = batch_start + count - start
+        print('Generated %d / %d images (%.1f images/s)'
+              % (done, n_images, done / (time.time() - started)))
+  finally:
+    writer.close()
+
+
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+  parser.add_argument('--weights', default = './weights/VAE/weights.h5',
+                      help = 'weights of the VAE saved by the training script')
+  parser.add_argument('--decoder-artifact', default = None,
+                      help = 'decoder exported by face_gen.export, used instead of --weights')
+  parser.add_argument('--output', required = True, help = 'output folder')
+  parser.add_argument('--n', type = int, required = True, help = 'number of images')
+  parser.add_argument('--start', type = int, default = 0, help = 'index of the first image')
+  parser.add_argument('--seed', type = int, default = 0)
+  parser.add_argument('--batch-size', type = int, default = 1024)
+  parser.add_argument('--format', default = 'png', choices = ['png', 'jpg'])
+  parser.add_argument('--quality', type = int, default = 95, help = 'JPEG quality')
+  parser.add_argument('--shard-size', type = int, default = 10000, help = 'images per folder')
+  parser.add_argument('--workers', type = int, default = None, help = 'image writer threads')
+  parser.add_argument('--input-dim', type = int, default = 128)
+  parser.add_argument('--z-dim', type = int, default = 200)
+  args = parser.parse_args(argv)
+
+  if args.decoder_artifact:
+    from face_gen.export import load_artifact
+    vae_decoder = load_artifact(args.decoder_artifact)
+  else:
+    # Only the decoder is built, the encoder is not needed here
+    from face_gen.models import load_decoder
+    vae_decoder = load_decoder(args.weights, (args.input_dim, args.input_dim, 3), args.z_dim)
+
+  generate_faces(vae_decoder, args.n, args.output, args.z_dim,
+                 start = args.start,
+                 batch_size = args.batch_size,
+                 seed = args.seed,
+                 image_format = args.format,
+                 shard_size = args.shard_size,
+                 workers = args.workers,
+                 quality = args.quality)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
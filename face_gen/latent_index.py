@@ -0,0 +1,298 @@
+"""Latent vectors of the whole dataset, with nearest-neighbour search.
+
+`encode_dataset` runs every image through the `mu` head of the VAE encoder
+once (the mean, not a random sample) and stores the latent vectors as a
+memory-mapped float32 array next to the list of filenames. `LatentIndex`
+answers exact top-k queries over them with chunked matrix products, and
+`IVFIndex` adds an approximate inverted-file index (k-means cells) for even
+faster queries.
+
+  python -m face_gen.latent_index encode --weights weights/VAE/weights.h5 \\
+      --cache data/cache_128x128/ --output latents/
+  python -m face_gen.latent_index query --index latents/ --image 000001.jpg --k 10
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+LATENTS_FILE = 'latents.npy'
+FILENAMES_FILE = 'filenames.txt'
+INDEX_FILE = 'index.json'
+
+
+# ENCODING
+def mu_encoder(vae_encoder):
+  # The deterministic head of the encoder, instead of the sampled encoder_output
+  from keras.models import Model
+  return Model(vae_encoder.input, vae_encoder.get_layer('mu').output)
+
+
+def encode_dataset(vae_encoder, data_flow, output_dir, verbose = 1):
+  """Encodes every image of `data_flow` once and writes the latents to `output_dir`.
+
+  `data_flow` must go through the images in order (shuffle = False) and yield
+  the images only (class_mode = None); it can be wrapped in a ParallelLoader.
+  """
+  if data_flow.shuffle or data_flow.class_mode is not None:
+    raise ValueError('encode_dataset needs an iterator with shuffle = False and class_mode = None')
+
+  if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+
+  encoder = mu_encoder(vae_encoder)
+  z_dim = encoder.output_shape[-1]
+  latents_path = os.path.join(output_dir, LATENTS_FILE)
+  latents = np.lib.format.open_memmap(latents_path + '.tmp', mode = 'w+', dtype = np.float32,
+                                      shape = (data_flow.n, z_dim))
+  started = time.time()
+  done = 0
+  for _ in range(len(data_flow)):
+    x = next(data_flow)
+    latents[done:done + len(x)] = encoder.predict_on_batch(x)
+    done += len(x)
+    if verbose > 0:
+      print('Encoded %d / %d images (%.1f images/s)' % (done, data_flow.n, done / (time.time() - started)))
+
+  latents.flush()
+  del latents
+  os.replace(latents_path + '.tmp', latents_path)
+
+  with open(os.path.join(output_dir, FILENAMES_FILE), 'w') as f:
+    f.write('\n'.join(data_flow.filenames))
+  with open(os.path.join(output_dir, INDEX_FILE), 'w') as f:
+    json.dump({'count': done, 'z_dim': z_dim}, f)
+
+  return LatentIndex.load(output_dir)
+
+
+# EXACT SEARCH
+def _top_k(distances, k):
+  # Smallest k distances of every row, sorted
+  k = min(k, distances.shape[1])
+  indices = np.argpartition(distances, k - 1, axis = 1)[:, :k]
+  distances = np.take_along_axis(distances, indices, axis = 1)
+  order = np.argsort(distances, axis = 1)
+  return np.take_along_axis(distances, order, axis = 1), np.take_along_axis(indices, order, axis = 1)
+
+
+def _search(latents, norms, queries, k, chunk_size):
+  # Squared L2 distances |x|^2 - 2 x.q + |q|^2, a matrix product per chunk,
+  # merged into a running top k
+  best_distances = np.empty((len(queries), 0), dtype = np.float32)
+  best_indices = np.empty((len(queries), 0), dtype = np.int64)
+  query_norms = np.einsum('ij,ij->i', queries, queries)[:, None]
+
+  for start in range(0, len(latents), chunk_size):
+    chunk = np.asarray(latents[start:start + chunk_size])
+    distances = norms[None, start:start + len(chunk)] - 2 * queries.dot(chunk.T) + query_norms
+    distances, indices = _top_k(distances, k)
+
+    distances = np.concatenate([best_distances, distances], axis = 1)
+    indices = np.concatenate([best_indices, indices + start], axis = 1)
+    best_distances, order = _top_k(distances, k)
+    best_indices = np.take_along_axis(indices, order, axis = 1)
+
+  return np.maximum(best_distances, 0), best_indices
+
+
+class LatentIndex(object):
+  """Exact k-nearest-neighbour search over the latent vectors of the dataset."""
+
+  def __init__(self, latents, filenames, chunk_size = 65536):
+    self.latents = latents
+    self.filenames = filenames
+    self.chunk_size = chunk_size
+    self._rows = None
+    # Squared norms of all the latents, computed once
+    self.norms = np.concatenate([np.einsum('ij,ij->i', chunk, chunk) for chunk in
+                                 (np.asarray(latents[i:i + chunk_size])
+                                  for i in range(0, len(latents), chunk_size))] or
+                                [np.empty(0, dtype = np.float32)])
+
+  @classmethod
+  def load(cls, output_dir, mmap = True, **kwargs):
+    latents = np.load(os.path.join(output_dir, LATENTS_FILE), mmap_mode = 'r' if mmap else None)
+    with open(os.path.join(output_dir, FILENAMES_FILE)) as f:
+      filenames = f.read().split('\n')
+    return cls(latents, filenames, **kwargs)
+
+  def __len__(self):
+    return len(self.latents)
+
+  def row(self, filename):
+    # Also matches the name without its folders, e.g. '000001.jpg'
+    if self._rows is None:
+      self._rows = {}
+      for i, name in enumerate(self.filenames):
+        self._rows[name] = i
+        self._rows.setdefault(os.path.basename(name), i)
+    return self._rows[filename]
+
+  def query(self, queries, k = 10):
+    """Returns the squared distances and rows of the `k` nearest latents of every query."""
+    queries = np.atleast_2d(np.asarray(queries, dtype = np.float32))
+    return _search(self.latents, self.norms, queries, k, self.chunk_size)
+
+  def neighbours(self, filename, k = 10):
+    """The `k` images closest to `filename`, as (filename, squared distance) pairs."""
+    row = self.row(filename)
+    distances, rows = self.query(self.latents[row], k + 1)
+    return [(self.filenames[i], float(d)) for d, i in zip(distances[0], rows[0]) if i != row][:k]
+
+
+# APPROXIMATE SEARCH
+def _assign(vectors, centroids, chunk_size = 65536):
+  centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+  return np.concatenate([np.argmin(centroid_norms[None] - 2 * np.asarray(vectors[i:i + chunk_size]).dot(centroids.T), axis = 1)
+                         for i in range(0, len(vectors), chunk_size)])
+
+
+def kmeans(vectors, n_clusters, iterations = 10, seed = 0):
+  rng = np.random.RandomState(seed)
+  centroids = vectors[rng.choice(len(vectors), n_clusters, replace = False)].copy()
+
+  for _ in range(iterations):
+    labels = _assign(vectors, centroids)
+    counts = np.bincount(labels, minlength = n_clusters)
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, labels, vectors)
+    # Empty clusters keep their centroid
+    filled = counts > 0
+    centroids[filled] = sums[filled] / counts[filled, None]
+
+  return centroids
+
+
+class IVFIndex(object):
+  """Approximate k-nearest-neighbour search with an inverted-file index.
+
+  The latents are grouped into `n_lists` k-means cells, stored contiguously
+  by cell. A query only scans the `n_probe` cells with the closest
+  centroids, which trades a little recall for a much smaller scan.
+  """
+
+  def __init__(self, index, centroids, order, offsets, n_probe = 16):
+    self.index = index
+    self.centroids = centroids
+    self.order = order
+    self.offsets = offsets
+    self.n_probe = n_probe
+    self.vectors = np.ascontiguousarray(np.asarray(index.latents)[order])
+    self.norms = index.norms[order]
+
+  @classmethod
+  def build(cls, index, n_lists = 1024, n_probe = 16, sample = 100000, iterations = 10, seed = 0):
+    rng = np.random.RandomState(seed)
+    rows = np.sort(rng.choice(len(index), min(sample, len(index)), replace = False))
+    centroids = kmeans(np.asarray(index.latents[rows]), min(n_lists, len(rows)), iterations, seed)
+
+    labels = _assign(index.latents, centroids)
+    order = np.argsort(labels, kind = 'stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength = len(centroids)))])
+    return cls(index, centroids, order, offsets, n_probe)
+
+  def save(self, output_dir):
+    np.save(os.path.join(output_dir, 'ivf_centroids.npy'), self.centroids)
+    np.save(os.path.join(output_dir, 'ivf_order.npy'), self.order)
+    np.save(os.path.join(output_dir, 'ivf_offsets.npy'), self.offsets)
+
+  @classmethod
+  def load(cls, index, output_dir, n_probe = 16):
+    return cls(index,
+               np.load(os.path.join(output_dir, 'ivf_centroids.npy')),
+               np.load(os.path.join(output_dir, 'ivf_order.npy')),
+               np.load(os.path.join(output_dir, 'ivf_offsets.npy')),
+               n_probe)
+
+  def query(self, queries, k = 10):
+    queries = np.atleast_2d(np.asarray(queries, dtype = np.float32))
+    _, cells = _search(self.centroids, np.einsum('ij,ij->i', self.centroids, self.centroids),
+                       queries, self.n_probe, len(self.centroids))
+
+    all_distances = np.full((len(queries), k), np.inf, dtype = np.float32)
+    all_rows = np.full((len(queries), k), -1, dtype = np.int64)
+    for q, query_cells in enumerate(cells):
+      positions = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in query_cells])
+      if len(positions) == 0:
+        continue
+      candidates = self.vectors[positions]
+      distances = self.norms[positions] - 2 * candidates.dot(queries[q]) + queries[q].dot(queries[q])
+      distances, best = _top_k(distances[None], k)
+      all_distances[q, :best.shape[1]] = np.maximum(distances[0], 0)
+      all_rows[q, :best.shape[1]] = self.order[positions[best[0]]]
+
+    return all_distances, all_rows
+
+
+# COMMAND LINE
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+  commands = parser.add_subparsers(dest = 'command')
+  commands.required = True
+
+  encode = commands.add_parser('encode', help = 'encode the whole dataset once')
+  encode.add_argument('--weights', default = './weights/VAE/weights.h5')
+  source = encode.add_mutually_exclusive_group(required = True)
+  source.add_argument('--cache', help = 'cache folder written by build_cache')
+  source.add_argument('--zip', help = 'the CelebA zip file')
+  encode.add_argument('--output', required = True)
+  encode.add_argument('--batch-size', type = int, default = 512)
+  encode.add_argument('--workers', type = int, default = None, help = 'decoding processes for --zip')
+  encode.add_argument('--input-dim', type = int, default = 128)
+  encode.add_argument('--z-dim', type = int, default = 200)
+  encode.add_argument('--ivf-lists', type = int, default = 0,
+                      help = 'also build an approximate index with this many cells')
+
+  query = commands.add_parser('query', help = 'find the nearest neighbours of an image')
+  query.add_argument('--index', required = True)
+  query.add_argument('--image', required = True, help = 'filename of the image')
+  query.add_argument('--k', type = int, default = 10)
+  query.add_argument('--approximate', action = 'store_true', help = 'use the IVF index')
+  query.add_argument('--n-probe', type = int, default = 16)
+
+  args = parser.parse_args(argv)
+
+  if args.command == 'encode':
+    from face_gen.data import CachedDataset, CacheIterator, ZipImageReader, ZipIterator, ParallelLoader
+    from face_gen.models import load_vae
+
+    input_dim = (args.input_dim, args.input_dim, 3)
+    vae_encoder, _, _ = load_vae(args.weights, input_dim, args.z_dim)
+
+    if args.cache:
+      data_flow = CacheIterator(CachedDataset(args.cache), batch_size = args.batch_size,
+                                shuffle = False, rescale = None, class_mode = None)
+    else:
+      data_flow = ParallelLoader(ZipIterator(ZipImageReader(args.zip), target_size = input_dim[:2],
+                                             batch_size = args.batch_size, shuffle = False,
+                                             rescale = None, class_mode = None),
+                                 workers = args.workers)
+
+    index = encode_dataset(vae_encoder, data_flow, args.output)
+    if args.ivf_lists:
+      IVFIndex.build(index, n_lists = args.ivf_lists).save(args.output)
+    return 0
+
+  index = LatentIndex.load(args.index)
+  if args.approximate:
+    searcher = IVFIndex.load(index, args.index, n_probe = args.n_probe)
+  else:
+    searcher = index
+
+  row = index.row(args.image)
+  started = time.time()
+  distances, rows = searcher.query(index.latents[row], args.k + 1)
+  print('Query took %.2f ms' % (1000 * (time.time() - started)))
+  for distance, i in zip(distances[0], rows[0]):
+    if i != row and i >= 0:
+      print('%-50s %.4f' % (index.filenames[i], distance))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
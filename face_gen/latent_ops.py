@@ -0,0 +1,222 @@
+"""Morphs between faces and attribute arithmetic in the latent space.
+
+Interpolation paths between many pairs of latent vectors are built at once
+with broadcasting, attribute directions for all the CelebA attributes come
+from one pass of matrix products, and all the frames are decoded in large batches
+and written as image sequences while the next batch decodes.
+
+  python -m face_gen morph --index latents/ --pairs 000001.jpg 000002.jpg \\
+      --steps 60 --method slerp --output morphs/
+  python -m face_gen attribute --index latents/ --attributes list_attr_celeba.csv \\
+      --attribute Smiling --images 000001.jpg --strengths -3 3 --steps 30 --output smiles/
+
+Frame `f` of sequence `s` is written to `output/s<s>/<f>.<format>`.
+"""
+
+import argparse
+import csv
+import os
+import sys
+import time
+
+import numpy as np
+
+from face_gen.generate import ImageWriter, to_uint8
+
+
+# INTERPOLATION
+def lerp_paths(z0, z1, n_steps):
+  """Linear paths from every row of `z0` to the same row of `z1`, (pairs, n_steps, z_dim)."""
+  z0, z1 = np.atleast_2d(z0), np.atleast_2d(z1)
+  t = np.linspace(0., 1., n_steps, dtype = np.float32)[None, :, None]
+  return (1 - t) * z0[:, None] + t * z1[:, None]
+
+
+def slerp_paths(z0, z1, n_steps, eps = 1e-6):
+  """Spherical paths, which keep the norm of the latent vectors typical of the prior.
+
+  Pairs that are (nearly) parallel fall back to the linear path.
+  """
+  z0, z1 = np.atleast_2d(z0).astype(np.float32), np.atleast_2d(z1).astype(np.float32)
+  norms = np.linalg.norm(z0, axis = 1) * np.linalg.norm(z1, axis = 1)
+  cos = np.clip(np.einsum('ij,ij->i', z0, z1) / np.maximum(norms, eps), -1., 1.)
+  omega = np.arccos(cos)[:, None, None]
+  sin_omega = np.sin(omega)
+
+  t = np.linspace(0., 1., n_steps, dtype = np.float32)[None, :, None]
+  parallel = sin_omega < eps
+  safe_sin = np.where(parallel, 1., sin_omega)
+  w0 = np.where(parallel, 1 - t, np.sin((1 - t) * omega) / safe_sin)
+  w1 = np.where(parallel, t, np.sin(t * omega) / safe_sin)
+  return (w0 * z0[:, None] + w1 * z1[:, None]).astype(np.float32)
+
+
+INTERPOLATIONS = {'linear': lerp_paths, 'slerp': slerp_paths}
+
+
+# ATTRIBUTES
+def read_attributes(csv_path):
+  """Reads the CelebA attributes file (list_attr_celeba.csv).
+
+  Returns the image filenames, the attribute names and the labels as an
+  int8 matrix of 1 / -1 with a row per image.
+  """
+  with open(csv_path, newline = '') as f:
+    rows = csv.reader(f)
+    header = next(rows)
+    filenames, labels = [], []
+    for row in rows:
+      filenames.append(row[0])
+      labels.append(row[1:])
+  return filenames, header[1:], np.array(labels, dtype = np.int8)
+
+
+def align_rows(filenames, names):
+  # Rows of `filenames` in the order of `names`, matched by the name without
+  # its folders
+  rows = {os.path.basename(name): i for i, name in enumerate(filenames)}
+  return np.array([rows[os.path.basename(name)] for name in names])
+
+
+def attribute_vectors(latents, labels, chunk_size = 65536):
+  """Direction of every attribute: mean latent with it minus mean latent without it.
+
+  `labels` holds a row of 1 / -1 per row of `latents`; the result has a row
+  per attribute. The sums are accumulated over chunks of rows, so `latents`
+  can be memory-mapped.
+  """
+  positive = (np.asarray(labels) > 0).astype(np.float32)
+  sums = np.zeros((positive.shape[1], latents.shape[1]), dtype = np.float64)
+  total = np.zeros(latents.shape[1], dtype = np.float64)
+  for start in range(0, len(latents), chunk_size):
+    chunk = np.asarray(latents[start:start + chunk_size], dtype = np.float64)
+    sums += positive[start:start + chunk_size].T.dot(chunk)
+    total += chunk.sum(axis = 0)
+
+  n_positive = positive.sum(axis = 0)[:, None]
+  n_negative = len(latents) - n_positive
+  return (sums / np.maximum(n_positive, 1) - (total - sums) / np.maximum(n_negative, 1)).astype(np.float32)
+
+
+def attribute_paths(z, direction, strengths, n_steps):
+  """Moves every row of `z` along `direction`, from strengths[0] to strengths[1]."""
+  t = np.linspace(strengths[0], strengths[1], n_steps, dtype = np.float32)[None, :, None]
+  return np.atleast_2d(z)[:, None] + t * np.asarray(direction, dtype = np.float32)[None, None]
+
+
+# DECODING
+def frame_path(output_dir, sequence, frame, image_format):
+  return os.path.join(output_dir, 's%05d' % sequence, '%05d.%s' % (frame, image_format))
+
+
+def decode_paths(decoder, paths, output_dir, batch_size = 1024, image_format = 'png',
+                 workers = None, quality = 95, verbose = 1):
+  """Decodes every frame of `paths` (sequences, frames, z_dim) and writes the image sequences.
+
+  The frames of all the sequences are decoded together, `batch_size` at a
+  time, while a pool of threads writes the previous batch.
+  """
+  n_frames = paths.shape[1]
+  latents = paths.reshape(-1, paths.shape[-1]).astype(np.float32)
+  writer = ImageWriter(workers, quality = quality)
+  started = time.time()
+
+  try:
+    for start in range(0, len(latents), batch_size):
+      images = to_uint8(decoder.predict_on_batch(latents[start:start + batch_size]))
+      files = [frame_path(output_dir, i // n_frames, i % n_frames, image_format)
+               for i in range(start, start + len(images))]
+      writer.submit(images, files)
+
+      if verbose > 0:
+        done = start + len(images)
+        print('Decoded %d / %d frames (%.1f frames/s)' % (done, len(latents), done / (time.time() - started)))
+  finally:
+    writer.close()
+
+
+# COMMAND LINE
+def _latents(args, names):
+  # Latent vectors of images of the dataset (from the latent index) or of
+  # image files (encoded here)
+  if args.index:
+    from face_gen.latent_index import LatentIndex
+    index = LatentIndex.load(args.index)
+    return np.asarray(index.latents)[[index.row(name) for name in names]]
+
+  from face_gen.data import load_image
+  from face_gen.latent_index import mu_encoder
+  from face_gen.models import load_vae
+  vae_encoder, _, _ = load_vae(args.weights, (args.input_dim, args.input_dim, 3), args.z_dim)
+  images = np.stack([load_image(name, (args.input_dim, args.input_dim)) for name in names])
+  return mu_encoder(vae_encoder).predict(images, batch_size = 256, verbose = 0)
+
+
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+  commands = parser.add_subparsers(dest = 'command')
+  commands.required = True
+
+  common = argparse.ArgumentParser(add_help = False)
+  common.add_argument('--weights', default = './weights/VAE/weights.h5')
+  common.add_argument('--index', default = None,
+                      help = 'latent index of the dataset; without it the images are files to encode')
+  common.add_argument('--output', required = True)
+  common.add_argument('--steps', type = int, default = 30, help = 'frames per sequence')
+  common.add_argument('--batch-size', type = int, default = 1024)
+  common.add_argument('--format', default = 'png', choices = ['png', 'jpg'])
+  common.add_argument('--workers', type = int, default = None, help = 'image writer threads')
+  common.add_argument('--input-dim', type = int, default = 128)
+  common.add_argument('--z-dim', type = int, default = 200)
+
+  morph = commands.add_parser('morph', parents = [common], help = 'morph between pairs of faces')
+  pairs = morph.add_mutually_exclusive_group(required = True)
+  pairs.add_argument('--pairs', nargs = '+', help = 'images, taken two by two')
+  pairs.add_argument('--random-pairs', type = int, help = 'number of random pairs of the index')
+  morph.add_argument('--method', default = 'slerp', choices = sorted(INTERPOLATIONS))
+  morph.add_argument('--seed', type = int, default = 0)
+
+  attribute = commands.add_parser('attribute', parents = [common], help = 'add an attribute to faces')
+  attribute.add_argument('--attributes', required = True, help = 'list_attr_celeba.csv')
+  attribute.add_argument('--attribute', required = True, help = 'e.g. Smiling')
+  attribute.add_argument('--images', nargs = '+', required = True)
+  attribute.add_argument('--strengths', type = float, nargs = 2, default = [-2., 2.])
+
+  args = parser.parse_args(argv)
+
+  if args.command == 'morph':
+    if args.random_pairs:
+      if not args.index:
+        parser.error('--random-pairs needs --index')
+      from face_gen.latent_index import LatentIndex
+      latents = LatentIndex.load(args.index).latents
+      rows = np.random.RandomState(args.seed).randint(len(latents), size = 2 * args.random_pairs)
+      z = np.asarray(latents[rows])
+    else:
+      if len(args.pairs) % 2:
+        parser.error('--pairs needs an even number of images')
+      z = _latents(args, args.pairs)
+    paths = INTERPOLATIONS[args.method](z[0::2], z[1::2], args.steps)
+
+  else:
+    if not args.index:
+      parser.error('attribute needs --index, the directions are computed from the whole dataset')
+    from face_gen.latent_index import LatentIndex
+    index = LatentIndex.load(args.index)
+    filenames, names, labels = read_attributes(args.attributes)
+    if args.attribute not in names:
+      parser.error('Unknown attribute %s, one of %s' % (args.attribute, ', '.join(names)))
+
+    labels = labels[align_rows(filenames, index.filenames)]
+    directions = attribute_vectors(index.latents, labels)
+    z = np.asarray(index.latents)[[index.row(name) for name in args.images]]
+    paths = attribute_paths(z, directions[names.index(args.attribute)], args.strengths, args.steps)
+
+  from face_gen.models import load_decoder
+  decoder = load_decoder(args.weights, (args.input_dim, args.input_dim, 3), args.z_dim)
+  decode_paths(decoder, paths, args.output, args.batch_size, args.format, args.workers)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
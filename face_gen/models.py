@@ -0,0 +1,445 @@
+"""Encoder and decoder builders for the Autoencoder and the VAE.
+
+With `input_rescale` set, the encoders take the uint8 images as they come out
+of the data pipeline and scale them inside the model, so the host never holds
+a float32 copy of the batches. `make_r_loss` scales the reconstruction
+targets with the same function.
+
+`VAEModel` trains the VAE with its own training step, which computes the
+reconstruction and KL terms once per batch and reports them as metrics.
+
+`architecture` derives the layer stack from the image size, so the models
+can be built for any INPUT_DIM, with layer names that stay the same from
+one resolution to the next (see face_gen.progressive).
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from keras.layers import Input, Conv2D, Flatten, Dense, Conv2DTranspose, Reshape, Lambda, Activation, BatchNormalization, LeakyReLU, Dropout
+from keras.metrics import Mean
+from keras.models import Model
+from keras.utils import unpack_x_y_sample_weight
+from keras import backend as K
+
+
+# Architecture used by the training script
+ENCODER_CONV_FILTERS = [32, 64, 64, 64]
+DECODER_CONV_FILTERS = [64, 64, 32, 3]
+CONV_KERNEL_SIZE = [3, 3, 3, 3]
+CONV_STRIDES = [2, 2, 2, 2]
+
+# The convolutions halve the images down to at most BASE_SIZE x BASE_SIZE
+# before the dense layers, e.g. 4 layers from 128 x 128 to 8 x 8
+BASE_SIZE = 8
+
+
+def _n_layers(size, base_size):
+  n_layers = 0
+  while size > base_size:
+    if size % 2:
+      raise ValueError('The image size must be a multiple of %d times a power of 2, not %d'
+                       % (base_size, size))
+    size //= 2
+    n_layers += 1
+  return max(n_layers, 1)
+
+
+def architecture(input_dim, final_dim = None, base_size = BASE_SIZE):
+  """Layers of the encoder and the decoder for `input_dim` images.
+
+  A stride-2 convolution per halving of the image down to `base_size`, with
+  the filters of the training script for the deepest layers (the 128 x 128
+  architecture is exactly ENCODER_CONV_FILTERS / DECODER_CONV_FILTERS).
+
+  When the model is a stage of a progressive training towards `final_dim`,
+  it has the deepest layers of the final model: `layer_offset` numbers the
+  encoder layers like those of the final model (the decoder layers are
+  numbered from the latent vector and need no offset), and every layer has
+  the shape it has in the final model, so it carries over from one stage to
+  the next. Two 1 x 1 convolutions adapt the stage to the pixels: one from
+  the color channels to the channels its first encoder layer expects
+  (`from_rgb_filters`) and one from its last decoder layer back to the color
+  channels (`to_rgb_channels`). They are None for the final model.
+  """
+  if input_dim[0] != input_dim[1]:
+    raise ValueError('The images must be square, not %s' % (input_dim[:2],))
+
+  n_layers = _n_layers(input_dim[0], base_size)
+  n_final_layers = _n_layers((final_dim or input_dim)[0], base_size)
+  if n_final_layers < n_layers:
+    raise ValueError('final_dim must be at least as large as input_dim')
+
+  # The filters of the final model, the shallowest layers are dropped at
+  # lower resolutions
+  final_filters = ENCODER_CONV_FILTERS[:1] * max(n_final_layers - len(ENCODER_CONV_FILTERS), 0) + \
+                  ENCODER_CONV_FILTERS[-n_final_layers:]
+  layer_offset = n_final_layers - n_layers
+  # The mirror image of the encoder, down to the color channels
+  final_decoder_filters = final_filters[::-1][1:] + [input_dim[2]]
+
+  return {'encoder_conv_filters': final_filters[layer_offset:],
+          'decoder_conv_filters': final_decoder_filters[:n_layers],
+          'conv_kernel_size': [3] * n_layers,
+          'conv_strides': [2] * n_layers,
+          'layer_offset': layer_offset,
+          'from_rgb_filters': final_filters[layer_offset - 1] if layer_offset else None,
+          'to_rgb_channels': input_dim[2] if layer_offset else None}
+
+
+def rescale_images(x, rescale):
+  # Casts (uint8) images to float32 and scales them, inside the graph
+  return K.cast(x, 'float32') * rescale
+
+
+def _encoder_input(input_dim, input_rescale):
+  if input_rescale is None:
+    encoder_input = Input(shape = input_dim, name = 'encoder_input')
+    return encoder_input, encoder_input
+
+  encoder_input = Input(shape = input_dim, dtype = 'uint8', name = 'encoder_input')
+  x = Lambda(rescale_images, arguments = {'rescale': input_rescale}, name = 'encoder_rescale')(encoder_input)
+  return encoder_input, x
+
+
+# ENCODER
+def build_encoder(input_dim, output_dim, conv_filters, conv_kernel_size,
+                  conv_strides, input_rescale = None, layer_offset = 0):
+
+  # Clear tensorflow session to reset layer index numbers to 0 for LeakyRelu,
+  # BatchNormalization and Dropout.
+  # Otherwise, the names of above mentioned layers in the model
+  # would be inconsistent
+  K.clear_session()
+
+  # Number of Conv layers
+  n_layers = len(conv_filters)
+
+  # Define model input
+  encoder_input, x = _encoder_input(input_dim, input_rescale)
+
+  # Add convolutional layers
+  for i in range(n_layers):
+      x = Conv2D(filters = conv_filters[i],
+                  kernel_size = conv_kernel_size[i],
+                  strides = conv_strides[i],
+                  padding = 'same',
+                  name = 'encoder_conv_' + str(i + layer_offset)
+                  )(x)
+
+      x = LeakyReLU()(x)
+
+  # Required for reshaping latent vector while building Decoder
+  shape_before_flattening = K.int_shape(x)[1:]
+
+  x = Flatten()(x)
+
+  # Define model output
+  encoder_output = Dense(output_dim, name = 'encoder_output')(x)
+
+  return encoder_input, encoder_output, shape_before_flattening, Model(encoder_input, encoder_output)
+
+
+# VAE ENCODER
+def build_vae_encoder(input_dim, output_dim, conv_filters, conv_kernel_size,
+                  conv_strides, use_batch_norm = False, use_dropout = False,
+                  input_rescale = None, layer_offset = 0, from_rgb_filters = None):
+
+  # Clear tensorflow session to reset layer index numbers to 0 for LeakyRelu,
+  # BatchNormalization and Dropout.
+  # Otherwise, the names of above mentioned layers in the model
+  # would be inconsistent
+  K.clear_session()
+
+  # Number of Conv layers
+  n_layers = len(conv_filters)
+
+  # Define model input
+  encoder_input, x = _encoder_input(input_dim, input_rescale)
+
+  # From the color channels to the channels of the first layer, at a stage
+  # of a progressive training (see `architecture`)
+  if from_rgb_filters is not None:
+    x = Conv2D(filters = from_rgb_filters, kernel_size = 1,
+               name = 'encoder_from_rgb_' + str(layer_offset))(x)
+    x = LeakyReLU()(x)
+
+  # Add convolutional layers
+  for i in range(n_layers):
+      x = Conv2D(filters = conv_filters[i],
+                  kernel_size = conv_kernel_size[i],
+                  strides = conv_strides[i],
+                  padding = 'same',
+                  name = 'encoder_conv_' + str(i + layer_offset)
+                  )(x)
+      if use_batch_norm:
+        x = BatchNormalization()(x)
+
+      x = LeakyReLU()(x)
+
+      if use_dropout:
+        x = Dropout(rate=0.25)(x)
+
+  # Required for reshaping latent vector while building Decoder
+  shape_before_flattening = K.int_shape(x)[1:]
+
+  x = Flatten()(x)
+
+  mean_mu = Dense(output_dim, name = 'mu')(x)
+  log_var = Dense(output_dim, name = 'log_var')(x)
+
+  # Defining a function for sampling
+  def sampling(args):
+    mean_mu, log_var = args
+    epsilon = K.random_normal(shape=K.shape(mean_mu), mean=0., stddev=1.)
+    return mean_mu + K.exp(log_var/2)*epsilon
+
+  # Using a Keras Lambda Layer to include the sampling function as a layer
+  # in the model
+  encoder_output = Lambda(sampling, name='encoder_output')([mean_mu, log_var])
+
+  return encoder_input, encoder_output, mean_mu, log_var, shape_before_flattening, Model(encoder_input, encoder_output)
+
+
+# DECODER
+def build_decoder(input_dim, shape_before_flattening, conv_filters, conv_kernel_size,
+                  conv_strides, to_rgb_channels = None):
+
+  # Number of Conv layers
+  n_layers = len(conv_filters)
+
+  # Define model input
+  decoder_input = Input(shape = (input_dim,) , name = 'decoder_input')
+
+  # To get an exact mirror image of the encoder
+  x = Dense(np.prod(shape_before_flattening), name = 'decoder_dense')(decoder_input)
+  x = Reshape(shape_before_flattening)(x)
+
+  # Add convolutional layers
+  for i in range(n_layers):
+      x = Conv2DTranspose(filters = conv_filters[i],
+                  kernel_size = conv_kernel_size[i],
+                  strides = conv_strides[i],
+                  padding = 'same',
+                  name = 'decoder_conv_' + str(i)
+                  )(x)
+
+      # Adding a sigmoid layer at the end to restrict the outputs
+      # between 0 and 1
+      if i < n_layers - 1 or to_rgb_channels is not None:
+        x = LeakyReLU()(x)
+      else:
+        x = Activation('sigmoid')(x)
+
+  # Back to the color channels, at a stage of a progressive training
+  if to_rgb_channels is not None:
+    x = Conv2D(filters = to_rgb_channels, kernel_size = 1,
+               name = 'decoder_to_rgb_' + str(n_layers - 1))(x)
+    x = Activation('sigmoid')(x)
+
+  # Define model output
+  decoder_output = x
+
+  return decoder_input, decoder_output, Model(decoder_input, decoder_output)
+
+
+# LOSS
+def make_r_loss(target_rescale = None):
+  # With uint8 batches the targets are the raw images, so they are scaled
+  # exactly like the encoder input before they are compared to the output
+  def r_loss(y_true, y_pred):
+    if target_rescale is not None:
+      y_true = rescale_images(y_true, target_rescale)
+    return K.mean(K.square(y_true - y_pred), axis = [1,2,3])
+
+  return r_loss
+
+r_loss = make_r_loss()
+
+
+def kl_loss(mean_mu, log_var):
+  return -0.5 * K.sum(1 + log_var - K.square(mean_mu) - K.exp(log_var), axis = 1)
+
+
+# VAE
+class VAEModel(Model):
+  """The VAE built from `vae_encoder` and `decoder`, with its own training step.
+
+  A single forward pass returns the reconstruction together with `mu` and
+  `log_var`, so the reconstruction and KL terms are computed once per batch
+  and reported as the `r_loss` and `kl_loss` metrics without being evaluated
+  again. `compute_losses(x, sample = False)` decodes `mu` instead of a
+  sampled z, so the losses of an image are the same every time.
+  `loss_factor` is a variable, so it can be changed during training (see
+  `face_gen.callbacks.LossFactorScheduler`).
+
+  With `accumulation_steps` K > 1, every batch is split into K micro-batches
+  whose gradients are accumulated before a single optimizer step. Each
+  micro-batch is weighted by its share of the batch, so the step matches the
+  step on the whole batch, while the activations only take the memory of a
+  micro-batch.
+
+  The layers are the same as those of `Model(vae_input, vae_output)`, so the
+  weights files are interchangeable with the plain functional model.
+  """
+
+  def __init__(self, vae_encoder, decoder, loss_factor = 10000, target_rescale = None,
+               accumulation_steps = 1, **kwargs):
+    mean_mu = vae_encoder.get_layer('mu').output
+    log_var = vae_encoder.get_layer('log_var').output
+    reconstruction = decoder(vae_encoder.output)
+
+    super(VAEModel, self).__init__(vae_encoder.input, [reconstruction, mean_mu, log_var], **kwargs)
+
+    self.r_loss = make_r_loss(target_rescale)
+    self.accumulation_steps = accumulation_steps
+
+    # Keep the loss factor, the metric trackers and the model decoding `mu`
+    # out of the tracked layers and weights, which would change the layout
+    # of the weights file
+    self._self_setattr_tracking = False
+    self.mean_model = Model(vae_encoder.input, [decoder(mean_mu), mean_mu, log_var])
+    self.loss_factor = K.variable(loss_factor, name = 'loss_factor')
+    self.loss_tracker = Mean(name = 'loss')
+    self.r_loss_tracker = Mean(name = 'r_loss')
+    self.kl_loss_tracker = Mean(name = 'kl_loss')
+    self._self_setattr_tracking = True
+
+  @property
+  def metrics(self):
+    # Listed here so Keras resets them at the start of every epoch
+    return [self.loss_tracker, self.r_loss_tracker, self.kl_loss_tracker]
+
+  def compute_losses(self, x, training = False, sample = True):
+    model = self if sample else self.mean_model
+    reconstruction, mean_mu, log_var = model(x, training = training)
+    r_loss = self.r_loss(x, reconstruction)
+    kl = kl_loss(mean_mu, log_var)
+    loss = K.mean(self.loss_factor * r_loss + kl)
+    if self.losses:
+      loss += tf.add_n(self.losses)
+    return loss, r_loss, kl
+
+  def _update_metrics(self, loss, r_loss, kl):
+    self.loss_tracker.update_state(loss)
+    self.r_loss_tracker.update_state(r_loss)
+    self.kl_loss_tracker.update_state(kl)
+    return {metric.name: metric.result() for metric in self.metrics}
+
+  def train_step(self, data):
+    x, _, _ = unpack_x_y_sample_weight(data)
+    if self.accumulation_steps > 1:
+      return self._accumulated_train_step(x)
+
+    with tf.GradientTape() as tape:
+      loss, r_loss, kl = self.compute_losses(x, training = True)
+
+    gradients = tape.gradient(loss, self.trainable_weights)
+    self.optimizer.apply_gradients(zip(gradients, self.trainable_weights))
+    return self._update_metrics(loss, r_loss, kl)
+
+  def _accumulated_train_step(self, x):
+    n = tf.shape(x)[0]
+    micro_batch_size = (n + self.accumulation_steps - 1) // self.accumulation_steps
+    # Fewer micro-batches than accumulation_steps if the batch is small, never an empty one
+    n_micro_batches = (n + micro_batch_size - 1) // micro_batch_size
+
+    def accumulate(i, loss, gradients):
+      x_i = x[i * micro_batch_size:(i + 1) * micro_batch_size]
+      # The loss is a mean over the batch, so the micro-batch means are
+      # weighted by their share of the batch
+      weight = tf.cast(tf.shape(x_i)[0], tf.float32) / tf.cast(n, tf.float32)
+
+      with tf.GradientTape() as tape:
+        loss_i, r_loss, kl = self.compute_losses(x_i, training = True)
+      gradients_i = tape.gradient(loss_i, self.trainable_weights)
+
+      # Per-image terms, their mean over the micro-batches is the batch mean
+      self.r_loss_tracker.update_state(r_loss)
+      self.kl_loss_tracker.update_state(kl)
+      return (i + 1, loss + weight * loss_i,
+              [g + weight * g_i for g, g_i in zip(gradients, gradients_i)])
+
+    # One micro-batch at a time, running them in parallel would bring back
+    # the memory use of the whole batch
+    _, loss, gradients = tf.while_loop(lambda i, loss, gradients: i < n_micro_batches, accumulate,
+                                       (tf.constant(0), tf.constant(0.),
+                                        [tf.zeros_like(w) for w in self.trainable_weights]),
+                                       parallel_iterations = 1)
+
+    self.optimizer.apply_gradients(zip(gradients, self.trainable_weights))
+    self.loss_tracker.update_state(loss)
+    return {metric.name: metric.result() for metric in self.metrics}
+
+  def test_step(self, data):
+    x, _, _ = unpack_x_y_sample_weight(data)
+    return self._update_metrics(*self.compute_losses(x))
+
+  def predict_step(self, data):
+    # predict() returns the reconstructions only, like the plain vae_model
+    x, _, _ = unpack_x_y_sample_weight(data)
+    return self(x, training = False)[0]
+
+
+def build_vae(input_dim, z_dim, loss_factor = 10000, input_rescale = 1./255, accumulation_steps = 1,
+              final_dim = None):
+  # The VAE of the training script for `input_dim` images. `final_dim` is
+  # the resolution of the last stage of a progressive training
+  layers = architecture(input_dim, final_dim)
+  _, _, _, _, vae_shape_before_flattening, vae_encoder = build_vae_encoder(input_dim = input_dim,
+                                    output_dim = z_dim,
+                                    conv_filters = layers['encoder_conv_filters'],
+                                    conv_kernel_size = layers['conv_kernel_size'],
+                                    conv_strides = layers['conv_strides'],
+                                    input_rescale = input_rescale,
+                                    layer_offset = layers['layer_offset'],
+                                    from_rgb_filters = layers['from_rgb_filters'])
+
+  # The decoder mirrors this encoder, so it reshapes to the encoder's own
+  # shape_before_flattening
+  _, _, vae_decoder = build_decoder(input_dim = z_dim,
+                                    shape_before_flattening = vae_shape_before_flattening,
+                                    conv_filters = layers['decoder_conv_filters'],
+                                    conv_kernel_size = layers['conv_kernel_size'],
+                                    conv_strides = layers['conv_strides'],
+                                    to_rgb_channels = layers['to_rgb_channels'])
+
+  vae_model = VAEModel(vae_encoder, vae_decoder, loss_factor = loss_factor,
+                       target_rescale = input_rescale, accumulation_steps = accumulation_steps)
+
+  return vae_encoder, vae_decoder, vae_model
+
+
+def load_vae(weights_path, input_dim, z_dim, input_rescale = 1./255):
+  # Builds the VAE of the training script and loads weights saved from it,
+  # e.g. weights/VAE/weights.h5
+  vae_encoder, vae_decoder, vae_model = build_vae(input_dim, z_dim, input_rescale = input_rescale)
+  vae_model.load_weights(weights_path)
+  return vae_encoder, vae_decoder, vae_model
+
+
+def load_decoder(weights_path, input_dim, z_dim):
+  # Builds the decoder alone and loads its weights from the weights of the
+  # whole VAE, which hold the decoder as a nested model (the first decoder
+  # layer is decoder_conv_0 at every resolution)
+  import h5py
+
+  layers = architecture(input_dim)
+  downsampling = int(np.prod(layers['conv_strides']))
+  shape_before_flattening = (input_dim[0] // downsampling, input_dim[1] // downsampling,
+                             layers['encoder_conv_filters'][-1])
+  _, _, decoder = build_decoder(input_dim = z_dim,
+                                shape_before_flattening = shape_before_flattening,
+                                conv_filters = layers['decoder_conv_filters'],
+                                conv_kernel_size = layers['conv_kernel_size'],
+                                conv_strides = layers['conv_strides'])
+
+  with h5py.File(weights_path, 'r') as f:
+    for name in f.attrs['layer_names']:
+      group = f[name]
+      weight_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in group.attrs['weight_names']]
+      if any(n.startswith('decoder_conv_0/') for n in weight_names):
+        decoder.set_weights([group[n][()] for n in weight_names])
+        return decoder
+
+  raise ValueError('No decoder weights in ' + weights_path)
@@ -0,0 +1,348 @@
+"""Data-parallel training on all the local CPU cores.
+
+`train_parallel` starts `workers` processes, each pinned to its own group of
+cores and training on its own partition of the cache with a `1 / workers`
+share of the batch. After every step the gradients are averaged with an
+all-reduce over shared memory: each worker writes its gradients to its own
+slot, sums one slice over all the slots, and reads back the whole average,
+with two barriers per step. Every worker applies the same averaged update,
+so the replicas stay identical, starting from the weights of rank 0.
+
+Rank 0 writes the checkpoints with `CheckpointManager`, so they keep the
+layout of `weights/VAE/weights.h5` (or `AE`), and training resumes from them.
+
+  python -m face_gen parallel train --cache data/cache_128x128/ --workers 8 --epochs 200
+  python -m face_gen parallel scaling --workers 1 2 4 8 --steps 20
+"""
+
+import argparse
+import ctypes
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import time
+import traceback
+
+import numpy as np
+
+# Losses reduced with the gradients: loss, r_loss, kl_loss, then the batch size
+N_STATS = 4
+# Seconds a worker waits at a barrier for the others before giving up
+BARRIER_TIMEOUT = 600
+
+
+# MODELS
+def _build_model(config):
+  input_dim = tuple(config['input_dim'])
+  if config['model'] == 'vae':
+    from face_gen.models import build_vae
+    _, _, model = build_vae(input_dim, config['z_dim'], loss_factor = config['loss_factor'])
+  else:
+    from face_gen.train import build_autoencoder
+    _, _, model = build_autoencoder(input_dim, config['z_dim'])
+  return model
+
+
+def _loss_function(model, config):
+  # Returns loss, r_loss, kl_loss for a batch
+  import tensorflow as tf
+  from face_gen.models import make_r_loss
+
+  if config['model'] == 'vae':
+    def losses(x):
+      loss, r_loss, kl = model.compute_losses(x, training = True)
+      return loss, tf.reduce_mean(r_loss), tf.reduce_mean(kl)
+  else:
+    r_loss_fn = make_r_loss(target_rescale = 1./255)
+    def losses(x):
+      r_loss = tf.reduce_mean(r_loss_fn(x, model(x, training = True)))
+      return r_loss, r_loss, tf.zeros_like(r_loss)
+  return losses
+
+
+def _model_sizes(config):
+  # Number of trainable values and of all the weight values of the model
+  from keras import backend as K
+  model = _build_model(config)
+  sizes = (sum(int(np.prod(w.shape)) for w in model.trainable_weights),
+           sum(int(np.prod(w.shape)) for w in model.weights))
+  K.clear_session()
+  return sizes
+
+
+# WORKER
+def _pin_cores(rank, world_size):
+  # Splits the cores of this process between the workers
+  if not hasattr(os, 'sched_setaffinity'):
+    return None
+  cores = sorted(os.sched_getaffinity(0))
+  per_worker = max(len(cores) // world_size, 1)
+  mine = cores[rank * per_worker:(rank + 1) * per_worker] or cores[rank % len(cores):][:1]
+  os.sched_setaffinity(0, mine)
+  return len(mine)
+
+
+def _worker(rank, config, gradients_buffer, weights_buffer, barrier, results):
+  try:
+    threads = _pin_cores(rank, config['workers']) or max(os.cpu_count() // config['workers'], 1)
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    from keras.optimizers import Adam
+    from face_gen.checkpoints import CheckpointManager
+    from face_gen.data import CachedDataset, CacheIterator
+
+    world_size = config['workers']
+    n_values, _ = config['sizes']
+    gradients = np.frombuffer(gradients_buffer, dtype = np.float32).reshape(world_size + 1, n_values + N_STATS)
+    slots, reduced = gradients[:world_size], gradients[world_size]
+    weights = np.frombuffer(weights_buffer, dtype = np.float32)
+
+    model = _build_model(config)
+    model.compile(optimizer = Adam(learning_rate = config['learning_rate']))
+    variables = model.trainable_weights
+    losses = _loss_function(model, config)
+
+    checkpoint, initial_epoch, epoch_step = None, 0, 0
+    if config['checkpoint_folder'] is not None:
+      checkpoint = CheckpointManager(config['checkpoint_folder'], verbose = config['verbose'] if rank == 0 else 0)
+      checkpoint.set_model(model)
+      # Every worker restores the optimizer state, which is the same everywhere.
+      # The workers save at the end of the epochs only, but the folder may hold
+      # a mid-epoch checkpoint of train.py, whose epoch is finished shorter
+      initial_epoch, epoch_step = checkpoint.restore(model)
+
+    # Broadcast the weights of rank 0
+    if rank == 0:
+      weights[:] = np.concatenate([w.ravel() for w in model.get_weights()])
+    barrier.wait(timeout = BARRIER_TIMEOUT)
+    if rank > 0:
+      values, offset = [], 0
+      for w in model.get_weights():
+        values.append(weights[offset:offset + w.size].reshape(w.shape))
+        offset += w.size
+      model.set_weights(values)
+
+    @tf.function
+    def compute_gradients(x):
+      with tf.GradientTape() as tape:
+        loss, r_loss, kl = losses(x)
+      grads = tape.gradient(loss, variables)
+      # Weighted by the batch size, the reduction sums the slots
+      n = tf.cast(tf.shape(x)[0], tf.float32)
+      return tf.concat([tf.reshape(g, [-1]) * n for g in grads] + [tf.stack([loss, r_loss, kl]) * n, [n]], 0)
+
+    @tf.function
+    def apply_gradients(flat):
+      grads = tf.split(flat[:n_values], [int(np.prod(v.shape)) for v in variables])
+      model.optimizer.apply_gradients(zip([tf.reshape(g, v.shape) for g, v in zip(grads, variables)], variables))
+
+    dataset = CachedDataset(config['cache_folder'])
+    local_batch_size = max(config['batch_size'] // world_size, 1)
+    data_flow = CacheIterator(dataset, batch_size = local_batch_size, shuffle = 'window',
+                              seed = config['seed'] + rank, rescale = None, class_mode = None,
+                              partition = (rank, world_size))
+    steps_per_epoch = config['steps_per_epoch'] or len(data_flow)
+    if epoch_step >= steps_per_epoch:
+      # Saved on the last batch of the epoch, or with longer epochs than these
+      initial_epoch, epoch_step = initial_epoch + 1, 0
+
+    # The slice of the gradients this worker reduces
+    chunk = (n_values + N_STATS + world_size - 1) // world_size
+    mine = slice(rank * chunk, min((rank + 1) * chunk, n_values + N_STATS))
+
+    images, started, step = 0, None, 0
+    for epoch in range(initial_epoch, config['epochs']):
+      totals = np.zeros(N_STATS)
+      epoch_steps = steps_per_epoch - epoch_step if epoch == initial_epoch else steps_per_epoch
+      for _ in range(epoch_steps):
+        if step == config['warmup_steps']:
+          images, started = 0, time.perf_counter()
+
+        slots[rank] = compute_gradients(next(data_flow)).numpy()
+        barrier.wait(timeout = BARRIER_TIMEOUT)
+        np.sum(slots[:, mine], axis = 0, out = reduced[mine])
+        barrier.wait(timeout = BARRIER_TIMEOUT)
+        update = reduced / reduced[-1]
+        apply_gradients(update)
+
+        totals += reduced[-N_STATS:]
+        images += int(reduced[-1])
+        step += 1
+
+      if rank == 0:
+        loss, r_loss, kl = totals[:3] / totals[3]
+        if config['verbose'] > 0:
+          print('Epoch %d/%d - loss: %.4f - r_loss: %.4f - kl_loss: %.4f'
+                % (epoch + 1, config['epochs'], loss, r_loss, kl))
+        if checkpoint is not None:
+          checkpoint.save(epoch + 1)
+
+    if rank == 0:
+      if checkpoint is not None:
+        checkpoint.on_train_end()
+      elapsed = time.perf_counter() - started if started else float('nan')
+      results.put(('done', rank, {'images_per_sec': images / elapsed if started else float('nan'),
+                                  'steps': step}))
+    else:
+      results.put(('done', rank, None))
+
+  except Exception:
+    barrier.abort()
+    results.put(('error', rank, traceback.format_exc()))
+
+
+# TRAINING
+def train_parallel(cache_folder, workers = None, model = 'vae', epochs = 1, batch_size = 512,
+                   learning_rate = 0.0005, loss_factor = 10000, z_dim = 200,
+                   weights_folder = './weights/', steps_per_epoch = None, warmup_steps = 2,
+                   seed = 0, verbose = 1):
+  """Trains the VAE (`model = 'vae'`) or the Simple Autoencoder ('ae') on `workers` processes.
+
+  `batch_size` is the global batch, split between the workers. With
+  `weights_folder = None` no checkpoints are read or written. Returns the
+  throughput in images/s after `warmup_steps`.
+  """
+  from face_gen.data import CachedDataset
+
+  workers = workers or os.cpu_count()
+  config = {'cache_folder': cache_folder,
+            'workers': workers,
+            'model': model,
+            'input_dim': list(CachedDataset(cache_folder).image_shape),
+            'z_dim': z_dim,
+            'epochs': epochs,
+            'batch_size': batch_size,
+            'learning_rate': learning_rate,
+            'loss_factor': loss_factor,
+            'steps_per_epoch': steps_per_epoch,
+            'warmup_steps': warmup_steps,
+            'seed': seed,
+            'verbose': verbose,
+            'checkpoint_folder': None if weights_folder is None else
+                                 os.path.join(weights_folder, 'VAE' if model == 'vae' else 'AE')}
+  config['sizes'] = _model_sizes(config)
+
+  context = multiprocessing.get_context('spawn')
+  n_values, n_weights = config['sizes']
+  # A slot per worker, and the reduced sum
+  gradients_buffer = context.RawArray(ctypes.c_float, (workers + 1) * (n_values + N_STATS))
+  weights_buffer = context.RawArray(ctypes.c_float, n_weights)
+  barrier = context.Barrier(workers)
+  results = context.Queue()
+
+  processes = [context.Process(target = _worker,
+                               args = (rank, config, gradients_buffer, weights_buffer, barrier, results),
+                               daemon = True)
+               for rank in range(workers)]
+  for process in processes:
+    process.start()
+
+  outcome, errors = None, []
+  try:
+    for _ in range(workers):
+      while True:
+        try:
+          status, rank, value = results.get(timeout = 1)
+          break
+        except queue.Empty:
+          # A worker killed without reporting would leave the others waiting at the barrier
+          dead = [rank for rank, p in enumerate(processes) if p.exitcode not in (None, 0)]
+          if dead:
+            barrier.abort()
+            raise RuntimeError('The training workers %s died' % ', '.join(map(str, dead)))
+      if status == 'error':
+        errors.append('Worker %d failed:\n%s' % (rank, value))
+      elif rank == 0:
+        outcome = value
+  finally:
+    for process in processes:
+      process.join(timeout = 10)
+      if process.is_alive():
+        process.terminate()
+
+  if errors:
+    raise RuntimeError(errors[0])
+  return outcome
+
+
+def measure_scaling(cache_folder, worker_counts, steps = 20, warmup_steps = 3, batch_size = 512,
+                    model = 'vae', z_dim = 200):
+  """Images/s, speedup and scaling efficiency for every number of workers.
+
+  The global batch stays `batch_size`, so the workers split the same work
+  (strong scaling). The efficiency is the speedup over one worker divided by
+  the number of workers.
+  """
+  rows = []
+  for workers in worker_counts:
+    result = train_parallel(cache_folder, workers, model = model, epochs = 1, batch_size = batch_size,
+                            z_dim = z_dim, weights_folder = None, steps_per_epoch = steps + warmup_steps,
+                            warmup_steps = warmup_steps, verbose = 0)
+    rows.append({'workers': workers, 'images_per_sec': result['images_per_sec']})
+
+  baseline = rows[0]['images_per_sec'] / rows[0]['workers']
+  for row in rows:
+    row['speedup'] = row['images_per_sec'] / baseline
+    row['efficiency'] = row['speedup'] / row['workers']
+  return rows
+
+
+# COMMAND LINE
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+  commands = parser.add_subparsers(dest = 'command')
+  commands.required = True
+
+  train = commands.add_parser('train', help = 'train on all the cores')
+  train.add_argument('--cache', required = True, help = 'cache folder written by build_cache')
+  train.add_argument('--workers', type = int, default = None)
+  train.add_argument('--model', default = 'vae', choices = ['ae', 'vae'])
+  train.add_argument('--weights', default = './weights/', help = 'checkpoint folder')
+  train.add_argument('--epochs', type = int, default = 200)
+  train.add_argument('--batch-size', type = int, default = 512, help = 'global batch size')
+  train.add_argument('--learning-rate', type = float, default = 0.0005)
+  train.add_argument('--loss-factor', type = float, default = 10000)
+  train.add_argument('--z-dim', type = int, default = 200)
+
+  scaling = commands.add_parser('scaling', help = 'report the scaling efficiency from 1 to N workers')
+  scaling.add_argument('--cache', default = None, help = 'cache folder, synthetic images without it')
+  scaling.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4])
+  scaling.add_argument('--model', default = 'vae', choices = ['ae', 'vae'])
+  scaling.add_argument('--steps', type = int, default = 20)
+  scaling.add_argument('--batch-size', type = int, default = 512)
+  scaling.add_argument('--input-dim', type = int, default = 128, help = 'for the synthetic images')
+  scaling.add_argument('--z-dim', type = int, default = 200)
+
+  args = parser.parse_args(argv)
+
+  if args.command == 'train':
+    result = train_parallel(args.cache, args.workers, model = args.model, epochs = args.epochs,
+                            batch_size = args.batch_size, learning_rate = args.learning_rate,
+                            loss_factor = args.loss_factor, z_dim = args.z_dim,
+                            weights_folder = args.weights)
+    if result:
+      print('%.1f images/s' % result['images_per_sec'])
+    return 0
+
+  cache_folder = args.cache
+  if cache_folder is None:
+    from face_gen.benchmark import write_synthetic_cache
+    cache_folder = tempfile.mkdtemp(prefix = 'face_gen_scaling_')
+    write_synthetic_cache(cache_folder, args.batch_size * 4, (args.input_dim, args.input_dim, 3))
+
+  rows = measure_scaling(cache_folder, args.workers, args.steps, batch_size = args.batch_size,
+                         model = args.model, z_dim = args.z_dim)
+  print('workers  images/s  speedup  efficiency')
+  for row in rows:
+    print('%7d  %8.1f  %7.2f  %9.0f%%' % (row['workers'], row['images_per_sec'], row['speedup'],
+                                          100 * row['efficiency']))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,209 @@
+"""Progressive training of the VAE, from small images up to INPUT_DIM.
+
+Every stage trains the VAE at a resolution, e.g. 32 -> 64 -> 128 pixels, and
+starts from the weights of the previous stage. The architecture of a stage
+is the final architecture without its shallowest convolutions, with a 1 x 1
+convolution from the pixels into its first encoder layer and one from its
+last decoder layer back to the pixels (see `face_gen.models.architecture`).
+Every convolution and dense layer of a stage keeps its name and shape in
+the next one and carries over; only the new convolution at each end and
+the two 1 x 1 adapters start from scratch. Most epochs run on a fraction of
+the pixels, and of the FLOPs, of the final resolution.
+
+  python -m face_gen progressive --data-zip celeba-dataset.zip --sizes 32 64 128 --epochs 10 10 5
+  python -m face_gen progressive --data-zip celeba-dataset.zip --target-r-loss 0.012 --compare
+
+Every run writes its checkpoints and logs to a folder of its own,
+weights/<run name>/VAE_32x32/, ..., weights/<run name>/VAE/ for the final
+stage, so a run never resumes from a plain training or from another run.
+The run name defaults to the start time; a run started again with the same
+`--run-name` resumes from its checkpoints, or deletes them and starts over
+with `--fresh`.
+
+With `--target-r-loss`, the wall-clock time until the final stage reaches
+that reconstruction loss is reported; `--compare` also trains at the final
+resolution from the start and reports its time to the same target. Both
+runs of a comparison always start from scratch. The caches are built
+before the clock starts.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from face_gen.data import ZipImageReader, build_cache
+from face_gen.train import make_data_flow, train_vae
+
+PROGRESSIVE_SIZES = [32, 64, 128]
+
+
+def _leaf_layers(model):
+  # The layers with weights of `model` and of the models nested in it, by name
+  layers = {}
+  for layer in model.layers:
+    if hasattr(layer, 'layers'):
+      layers.update(_leaf_layers(layer))
+    elif layer.weights:
+      layers[layer.name] = layer
+  return layers
+
+
+def transfer_weights(source, target):
+  """Copies the weights of the layers of `source` into the layers of `target`
+  with the same name and weight shapes.
+
+  Returns the names of the layers that were copied.
+  """
+  source_layers = _leaf_layers(source)
+  copied = []
+  for name, layer in sorted(_leaf_layers(target).items()):
+    if name not in source_layers:
+      continue
+    weights = source_layers[name].get_weights()
+    if [w.shape for w in weights] == [tuple(w.shape) for w in layer.weights]:
+      layer.set_weights(weights)
+      copied.append(name)
+  return copied
+
+
+def stage_name(size, final_size):
+  # The final stage is saved like a plain training, as <run folder>/VAE/
+  return 'VAE' if size == final_size else 'VAE_{0}x{0}'.format(size)
+
+
+def default_run_name():
+  return time.strftime('progressive_%Y%m%d-%H%M%S')
+
+
+def train_progressive(reader, sizes = PROGRESSIVE_SIZES, epochs = 10, z_dim = 200, batch_size = 512,
+                      weights_folder = './weights/', log_folder = './logs/', learning_rate = 0.0005,
+                      loss_factor = 10000, accumulation_steps = 1, target_r_loss = None, workers = None,
+                      names = None, run_name = None, resume = True):
+  """Trains the VAE on the images of `reader` at every size of `sizes` in turn.
+
+  `epochs` is a number of epochs per stage, or a list with one per stage.
+  The stages are saved in `weights_folder/run_name/` (and logged in
+  `log_folder/run_name/`), by default a new folder named after the start
+  time. With `resume = False`, the checkpoints already in that folder are
+  deleted and every stage starts over.
+  Returns the final `(vae_encoder, vae_decoder, vae_model)` and, with
+  `target_r_loss`, the `TargetLossTimer` of the final stage, counting from
+  the start of the first stage.
+
+  A single size trains at that size from the start, which is the baseline
+  of the comparison.
+  """
+  from face_gen.callbacks import TargetLossTimer
+  from face_gen.models import build_vae
+
+  sizes = list(sizes)
+  epochs = epochs if isinstance(epochs, (list, tuple)) else [epochs] * len(sizes)
+  if len(epochs) != len(sizes):
+    raise ValueError('%d sizes but %d numbers of epochs' % (len(sizes), len(epochs)))
+  names = names or [stage_name(size, sizes[-1]) for size in sizes]
+  run_name = run_name or default_run_name()
+  weights_folder = os.path.join(weights_folder, run_name)
+  log_folder = os.path.join(log_folder, run_name)
+  final_dim = (sizes[-1], sizes[-1], 3)
+
+  # Decoding and resizing the images is done once, before the clock starts
+  for size in sizes:
+    build_cache(reader, './data/cache_{}x{}/'.format(size, size), target_size = (size, size))
+
+  timer = None
+  started = time.perf_counter()
+  previous = None
+  for size, stage_epochs, name in zip(sizes, epochs, names):
+    input_dim = (size, size, 3)
+    vae_encoder, vae_decoder, vae_model = build_vae(input_dim, z_dim, final_dim = final_dim,
+                                                    accumulation_steps = accumulation_steps)
+    if previous is not None:
+      copied = transfer_weights(previous, vae_model)
+      print('Stage %dx%d: carried over the weights of %s' % (size, size, ', '.join(copied)))
+
+    callbacks = []
+    if target_r_loss is not None and size == sizes[-1]:
+      timer = TargetLossTimer(target_r_loss, started = started, verbose = 1)
+      callbacks.append(timer)
+
+    with make_data_flow(reader, input_dim, batch_size, workers = workers) as data_flow:
+      train_vae(vae_model, data_flow, stage_epochs, weights_folder, log_folder,
+                learning_rate = learning_rate, loss_factor = loss_factor,
+                name = name, callbacks = callbacks, resume = resume)
+    previous = vae_model
+
+  return (vae_encoder, vae_decoder, vae_model), timer
+
+
+# COMMAND LINE
+def _report(label, timer):
+  if timer.elapsed is None:
+    print('%-12s: r_loss %.5g not reached in %d epochs' % (label, timer.target, timer.epochs))
+  else:
+    print('%-12s: r_loss %.5g reached after %.1f s' % (label, timer.target, timer.elapsed))
+
+
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+  parser.add_argument('--data-zip', default = 'celeba-dataset.zip')
+  parser.add_argument('--sizes', type = int, nargs = '+', default = PROGRESSIVE_SIZES,
+                      help = 'image sizes of the stages, the last one is the final resolution')
+  parser.add_argument('--epochs', type = int, nargs = '+', default = [10],
+                      help = 'epochs of every stage, or one number for all the stages')
+  parser.add_argument('--weights', default = './weights/', help = 'checkpoint folder, with a folder per run')
+  parser.add_argument('--logs', default = './logs/')
+  parser.add_argument('--run-name', default = None,
+                      help = 'folder of the run in --weights and --logs, by default named after the start time')
+  parser.add_argument('--fresh', action = 'store_true',
+                      help = 'delete the checkpoints of an earlier run with the same --run-name and start over')
+  parser.add_argument('--batch-size', type = int, default = 512)
+  parser.add_argument('--accumulation-steps', type = int, default = 1)
+  parser.add_argument('--learning-rate', type = float, default = 0.0005)
+  parser.add_argument('--loss-factor', type = float, default = 10000)
+  parser.add_argument('--z-dim', type = int, default = 200)
+  parser.add_argument('--workers', type = int, default = None, help = 'data loading processes')
+  parser.add_argument('--target-r-loss', type = float, default = None,
+                      help = 'stop the final stage at this reconstruction loss and report the time to it')
+  parser.add_argument('--compare', action = 'store_true',
+                      help = 'also train at the final size from the start, up to --target-r-loss')
+  parser.add_argument('--compare-epochs', type = int, default = None,
+                      help = 'epoch limit of the comparison, by default the total of --epochs')
+  args = parser.parse_args(argv)
+
+  if args.compare and args.target_r_loss is None:
+    parser.error('--compare needs --target-r-loss')
+  if not os.path.exists(args.data_zip):
+    parser.error('%s not found' % args.data_zip)
+  epochs = args.epochs * len(args.sizes) if len(args.epochs) == 1 else args.epochs
+  if len(epochs) != len(args.sizes):
+    parser.error('--epochs needs one number, or one per size')
+
+  reader = ZipImageReader(args.data_zip)
+  run_name = args.run_name or default_run_name()
+  # A comparison times both runs from scratch
+  resume = not (args.fresh or args.compare)
+  options = dict(z_dim = args.z_dim, batch_size = args.batch_size, weights_folder = args.weights,
+                 log_folder = args.logs, learning_rate = args.learning_rate, loss_factor = args.loss_factor,
+                 accumulation_steps = args.accumulation_steps, target_r_loss = args.target_r_loss,
+                 workers = args.workers, resume = resume)
+
+  _, timer = train_progressive(reader, args.sizes, epochs, run_name = run_name, **options)
+  print('Weights of the final stage in %s' % os.path.join(args.weights, run_name, 'VAE'))
+
+  if args.compare:
+    size = args.sizes[-1]
+    _, baseline = train_progressive(reader, [size], [args.compare_epochs or sum(epochs)],
+                                    run_name = '{0}_{1}x{1}_only'.format(run_name, size), **options)
+    print()
+    _report('Progressive', timer)
+    _report('%dx%d only' % (size, size), baseline)
+    if timer.elapsed is not None and baseline.elapsed is not None:
+      print('Speed-up    : %.2fx' % (baseline.elapsed / timer.elapsed))
+  elif timer is not None:
+    _report('Progressive', timer)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
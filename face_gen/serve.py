@@ -0,0 +1,360 @@
+"""Local inference server for the VAE decoder and encoder.
+
+Concurrent requests are coalesced into dynamic batches: a `MicroBatcher`
+collects requests until it holds `max_batch` rows or the oldest request has
+waited `max_wait` seconds, runs the batch through the model on one of
+`workers` threads and hands every request its own rows back. Batches grow
+by themselves under load, while all the workers are busy.
+
+  python -m face_gen serve --weights weights/VAE/weights.h5 --port 8000
+  python -m face_gen serve --weights weights/VAE/weights.h5 --unix-socket /tmp/face_gen.sock
+
+Endpoints:
+
+  GET/POST /generate  n, seed, start, format (npy or png): n decoded faces
+                      of `sample_latents(seed, start, n)`, or of random
+                      latents without a seed. The latents can also be
+                      POSTed as an .npy array (Content-Type: application/x-npy).
+  POST     /encode    an image file, or an .npy array of uint8 images: the
+                      `mu` latent vectors, as JSON
+  GET      /stats     queue depth, batch sizes and latency percentiles
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from PIL import Image
+
+from face_gen.data import load_image
+from face_gen.generate import sample_latents, to_uint8
+
+MAX_IMAGES = 1024
+
+
+# MICRO-BATCHING
+class MicroBatcher(object):
+  """Runs `fn` on batches of the rows of concurrent requests.
+
+  `submit(rows)` returns a Future of `fn` applied to `rows`; `fn` maps an
+  array of rows to an array with one output row per input row. A request is
+  never split, so a batch holds at least one request and stops growing once
+  it holds `max_batch` rows.
+  """
+
+  def __init__(self, fn, max_batch = 256, max_wait = 0.005, workers = 1, history = 10000):
+    self.fn = fn
+    self.max_batch = max_batch
+    self.max_wait = max_wait
+    self.workers = workers
+
+    self._requests = deque()
+    self._condition = threading.Condition()
+    # A batch is only collected once a worker is free to run it
+    self._free_workers = threading.Semaphore(workers)
+    self._pool = ThreadPoolExecutor(workers)
+    self._closed = False
+
+    self._stats_lock = threading.Lock()
+    self._latencies = deque(maxlen = history)
+    self._batch_sizes = deque(maxlen = history)
+    self.n_requests = 0
+    self.n_batches = 0
+
+    self._collector = threading.Thread(target = self._collect, daemon = True)
+    self._collector.start()
+
+  def submit(self, rows):
+    future = Future()
+    with self._condition:
+      if self._closed:
+        raise RuntimeError('The batcher is closed')
+      self._requests.append((np.asarray(rows), future, time.perf_counter()))
+      self._condition.notify()
+    return future
+
+  def __call__(self, rows):
+    return self.submit(rows).result()
+
+  @property
+  def queue_depth(self):
+    return len(self._requests)
+
+  def _collect(self):
+    while True:
+      self._free_workers.acquire()
+
+      with self._condition:
+        while not self._requests and not self._closed:
+          self._condition.wait()
+        if self._closed and not self._requests:
+          self._free_workers.release()
+          return
+
+        # Wait for more requests until the batch is full or the oldest
+        # request has waited max_wait
+        deadline = self._requests[0][2] + self.max_wait
+        while sum(len(r[0]) for r in self._requests) < self.max_batch and not self._closed:
+          remaining = deadline - time.perf_counter()
+          if remaining <= 0:
+            break
+          self._condition.wait(remaining)
+
+        batch = [self._requests.popleft()]
+        size = len(batch[0][0])
+        while self._requests and size + len(self._requests[0][0]) <= self.max_batch:
+          size += len(self._requests[0][0])
+          batch.append(self._requests.popleft())
+
+      self._pool.submit(self._run, batch)
+
+  def _run(self, batch):
+    try:
+      rows = np.concatenate([r[0] for r in batch]) if len(batch) > 1 else batch[0][0]
+      try:
+        outputs = self.fn(rows)
+      except Exception as e:
+        for _, future, _ in batch:
+          future.set_exception(e)
+        return
+
+      done = time.perf_counter()
+      offset = 0
+      for request_rows, future, submitted in batch:
+        future.set_result(outputs[offset:offset + len(request_rows)])
+        offset += len(request_rows)
+
+      with self._stats_lock:
+        self._latencies.extend(done - submitted for _, _, submitted in batch)
+        self._batch_sizes.append(len(rows))
+        self.n_requests += len(batch)
+        self.n_batches += 1
+    finally:
+      self._free_workers.release()
+
+  def stats(self):
+    with self._stats_lock:
+      latencies = np.array(self._latencies)
+      batch_sizes = np.array(self._batch_sizes)
+      stats = {'requests': self.n_requests,
+               'batches': self.n_batches,
+               'queue_depth': self.queue_depth,
+               'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else 0.}
+    for p in (50, 95, 99):
+      stats['latency_ms_p%d' % p] = 1000 * float(np.percentile(latencies, p)) if len(latencies) else 0.
+    return stats
+
+  def close(self):
+    with self._condition:
+      self._closed = True
+      self._condition.notify_all()
+    self._collector.join()
+    self._pool.shutdown()
+
+
+# MODELS
+def _batched_function(model, input_shape, input_dtype):
+  # A single graph for every batch size, callable from several threads
+  import tensorflow as tf
+  forward = tf.function(lambda x: model(x, training = False),
+                        input_signature = [tf.TensorSpec((None,) + tuple(input_shape), input_dtype)])
+  return lambda rows: forward(rows).numpy()
+
+
+class InferenceService(object):
+  """The decoder and the `mu` encoder of the VAE, each behind a MicroBatcher."""
+
+  def __init__(self, vae_encoder, vae_decoder, max_batch = 256, max_wait = 0.005, workers = 1):
+    import tensorflow as tf
+    from face_gen.latent_index import mu_encoder
+
+    self.z_dim = vae_decoder.input_shape[-1]
+    self.input_dim = vae_encoder.input_shape[1:]
+
+    decode = _batched_function(vae_decoder, (self.z_dim,), tf.float32)
+    encode = _batched_function(mu_encoder(vae_encoder), self.input_dim, tf.as_dtype(vae_encoder.input.dtype))
+    self.decoder = MicroBatcher(lambda z: to_uint8(decode(z)), max_batch, max_wait, workers)
+    self.encoder = MicroBatcher(encode, max_batch, max_wait, workers)
+
+  def generate(self, n, seed = None, start = 0):
+    if seed is None:
+      seed = int(np.random.randint(2 ** 31))
+    return self.decoder(sample_latents(seed, start, n, self.z_dim))
+
+  def stats(self):
+    return {'decoder': self.decoder.stats(), 'encoder': self.encoder.stats()}
+
+  def close(self):
+    self.decoder.close()
+    self.encoder.close()
+
+
+# HTTP
+def _npy_bytes(array):
+  buffer = io.BytesIO()
+  np.save(buffer, array)
+  return buffer.getvalue()
+
+
+def _png_base64(images):
+  encoded = []
+  for img in images:
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format = 'PNG', compress_level = 1)
+    encoded.append(base64.b64encode(buffer.getvalue()).decode('ascii'))
+  return encoded
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+  # Set on the subclass made by make_server
+  service = None
+  protocol_version = 'HTTP/1.1'
+
+  def address_string(self):
+    # Unix socket clients have no address
+    return self.client_address[0] if self.client_address else 'unix'
+
+  def log_message(self, format, *args):
+    pass
+
+  def _send(self, status, body, content_type = 'application/json'):
+    if content_type == 'application/json':
+      body = json.dumps(body).encode('utf8')
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _body(self):
+    length = int(self.headers.get('Content-Length') or 0)
+    return self.rfile.read(length)
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+    self._handle(url.path, params, None)
+
+  def do_POST(self):
+    url = urlparse(self.path)
+    params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+    self._handle(url.path, params, self._body(), self.headers.get('Content-Type', ''))
+
+  def _handle(self, path, params, body, content_type = ''):
+    try:
+      if content_type.startswith('application/json') and body:
+        # Malformed JSON raises a ValueError too, answered with 400
+        fields = json.loads(body.decode('utf8'))
+        if not isinstance(fields, dict):
+          raise ValueError('The JSON body must be an object')
+        params.update(fields)
+        body = None
+
+      if path == '/generate':
+        self._generate(params, body)
+      elif path == '/encode':
+        self._encode(body)
+      elif path == '/stats':
+        self._send(200, self.service.stats())
+      else:
+        self._send(404, {'error': 'unknown endpoint ' + path})
+    except ValueError as e:
+      self._send(400, {'error': str(e)})
+    except Exception as e:
+      self._send(500, {'error': repr(e)})
+
+  def _generate(self, params, body):
+    if body:
+      z = np.load(io.BytesIO(body)).astype(np.float32).reshape(-1, self.service.z_dim)
+      if len(z) > MAX_IMAGES:
+        raise ValueError('At most %d images per request' % MAX_IMAGES)
+      images = self.service.decoder(z)
+    else:
+      n = int(params.get('n', 1))
+      if not 0 < n <= MAX_IMAGES:
+        raise ValueError('n must be between 1 and %d' % MAX_IMAGES)
+      seed = int(params['seed']) if 'seed' in params else None
+      images = self.service.generate(n, seed, int(params.get('start', 0)))
+
+    if params.get('format', 'npy') == 'png':
+      self._send(200, {'images': _png_base64(images)})
+    else:
+      self._send(200, _npy_bytes(images), 'application/x-npy')
+
+  def _encode(self, body):
+    if not body:
+      raise ValueError('/encode needs an image body, a PNG or JPEG file or a .npy array')
+    if body.startswith(b'\x93NUMPY'):
+      images = np.load(io.BytesIO(body))
+      if images.ndim == 3:
+        images = images[None]
+      if images.shape[1:] != tuple(self.service.input_dim):
+        raise ValueError('Expected images of shape %s' % (tuple(self.service.input_dim),))
+      if len(images) > MAX_IMAGES:
+        raise ValueError('At most %d images per request' % MAX_IMAGES)
+    else:
+      try:
+        images = load_image(io.BytesIO(body), self.service.input_dim[:2])[None]
+      except OSError as e:
+        raise ValueError('Cannot decode the image: %s' % e)
+
+    self._send(200, {'mu': self.service.encoder(images.astype(np.uint8)).tolist()})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+def make_server(service, host = '127.0.0.1', port = 8000, unix_socket = None):
+  handler = type('Handler', (RequestHandler,), {'service': service})
+  if unix_socket is None:
+    return ThreadingHTTPServer((host, port), handler)
+
+  if os.path.exists(unix_socket):
+    os.remove(unix_socket)
+  return ThreadingUnixHTTPServer(unix_socket, handler)
+
+
+# COMMAND LINE
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+  parser.add_argument('--weights', default = './weights/VAE/weights.h5')
+  parser.add_argument('--host', default = '127.0.0.1')
+  parser.add_argument('--port', type = int, default = 8000)
+  parser.add_argument('--unix-socket', default = None, help = 'listen on this socket instead of a port')
+  parser.add_argument('--max-batch', type = int, default = 256, help = 'rows per batch')
+  parser.add_argument('--max-wait-ms', type = float, default = 5, help = 'longest wait for a batch to fill')
+  parser.add_argument('--workers', type = int, default = 1, help = 'batches running at the same time')
+  parser.add_argument('--input-dim', type = int, default = 128)
+  parser.add_argument('--z-dim', type = int, default = 200)
+  args = parser.parse_args(argv)
+
+  from face_gen.models import load_vae
+  vae_encoder, vae_decoder, _ = load_vae(args.weights, (args.input_dim, args.input_dim, 3), args.z_dim)
+  service = InferenceService(vae_encoder, vae_decoder, args.max_batch, args.max_wait_ms / 1000., args.workers)
+  server = make_server(service, args.host, args.port, args.unix_socket)
+
+  print('Serving on %s' % (args.unix_socket or 'http://%s:%d' % (args.host, args.port)))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    service.close()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,231 @@
+"""Hyperparameter sweep of the VAE: short trials over a grid of configurations.
+
+Every combination of loss factor, latent dimension and learning rate is
+trained for a few epochs on the same subset of the cache, copied once into
+its own cache so that all the trials read it from the page cache. The
+trials run `parallel` at a time in a pool of processes, each pinned to its
+own group of cores. A trial stops early when other trials reached a lower
+r_loss and a lower kl_loss at the same epoch (see
+`face_gen.callbacks.ParetoStopper`). Every finished trial is appended to a
+CSV table, with its losses on a held out part of the subset.
+
+  python -m face_gen sweep --cache data/cache_128x128/ --subset 20000 --epochs 5 --parallel 4 \\
+      --loss-factors 1000 10000 100000 --z-dims 100 200 --learning-rates 0.0005 0.001 \\
+      --output sweeps/results.csv
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from face_gen.data import CACHE_FILENAMES, CACHE_INDEX, CachedDataset
+
+RESULT_FIELDS = ['trial', 'loss_factor', 'z_dim', 'learning_rate', 'epochs', 'stopped_early',
+                 'r_loss', 'kl_loss', 'val_r_loss', 'val_kl_loss', 'seconds', 'error']
+
+
+def grid(loss_factors, z_dims, learning_rates):
+  """Every combination of the values, as a list of configurations."""
+  return [{'loss_factor': loss_factor, 'z_dim': z_dim, 'learning_rate': learning_rate}
+          for loss_factor, z_dim, learning_rate in itertools.product(loss_factors, z_dims, learning_rates)]
+
+
+def build_subset(cache_folder, subset_folder, n, chunk_size = 4096):
+  """Copies the first `n` images of a cache into a cache of their own.
+
+  The cache is shuffled when it is built, so its first images are a random
+  sample. An existing subset is reused if it was copied from the same cache
+  and holds the same images, by filename, in the same order.
+  """
+  source = CachedDataset(cache_folder)
+  n = min(n, len(source))
+  index_path = os.path.join(subset_folder, CACHE_INDEX)
+  if os.path.exists(index_path):
+    with open(index_path) as f:
+      index = json.load(f)
+    subset = CachedDataset(subset_folder)
+    if index.get('source') == os.path.abspath(cache_folder) and subset.image_shape == source.image_shape \
+        and subset.filenames == source.filenames[:n]:
+      return subset
+
+  if not os.path.exists(subset_folder):
+    os.makedirs(subset_folder)
+  # The stale index goes first, so an interrupted rebuild is never reused
+  if os.path.exists(index_path):
+    os.remove(index_path)
+  shard_path = os.path.join(subset_folder, 'shard_00000.npy')
+  shard = open_memmap(shard_path + '.tmp', mode = 'w+', dtype = np.uint8, shape = (n,) + source.image_shape)
+  for start in range(0, n, chunk_size):
+    source.read(slice(start, min(start + chunk_size, n)), out = shard[start:start + chunk_size])
+  shard.flush()
+  del shard
+  os.replace(shard_path + '.tmp', shard_path)
+
+  with open(os.path.join(subset_folder, CACHE_FILENAMES), 'w') as f:
+    f.write('\n'.join(source.filenames[:n]))
+  # The index is written last, like build_cache does
+  with open(index_path + '.tmp', 'w') as f:
+    json.dump({'image_shape': list(source.image_shape), 'shard_sizes': [n],
+               'source': os.path.abspath(cache_folder)}, f)
+  os.replace(index_path + '.tmp', index_path)
+  return CachedDataset(subset_folder)
+
+
+# TRIALS
+def _init_worker(slots, n_slots):
+  # Pins the pool process to the cores of a free slot before TensorFlow
+  # starts its thread pools
+  from face_gen.parallel import _pin_cores
+  threads = _pin_cores(slots.get(), n_slots) or max(os.cpu_count() // n_slots, 1)
+  os.environ['OMP_NUM_THREADS'] = str(threads)
+
+  import tensorflow as tf
+  tf.config.threading.set_intra_op_parallelism_threads(threads)
+  tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def _run_trial(trial, config, options, curves):
+  started = time.perf_counter()
+  result = dict(config, trial = trial)
+  try:
+    import tensorflow as tf
+    from keras.optimizers import Adam
+    from face_gen.callbacks import ParetoStopper
+    from face_gen.data import CacheIterator
+    from face_gen.evaluate import evaluate_scores
+    from face_gen.models import build_vae
+
+    tf.keras.utils.set_random_seed(options['seed'])
+    dataset = CachedDataset(options['subset_folder'])
+    # Reshuffled within windows every epoch like the full training, so the
+    # loss curves the trials are ranked by do not come from fixed batches
+    data_flow = CacheIterator(dataset, batch_size = options['batch_size'], shuffle = 'window',
+                              seed = options['seed'], rescale = None,
+                              validation_split = options['validation_split'], subset = 'training')
+
+    _, _, vae_model = build_vae(dataset.image_shape, config['z_dim'], loss_factor = config['loss_factor'])
+    vae_model.compile(optimizer = Adam(learning_rate = config['learning_rate']))
+    stopper = ParetoStopper(trial, curves, margin = options['margin'], min_epochs = options['min_epochs'])
+    history = vae_model.fit(data_flow, epochs = options['epochs'],
+                            steps_per_epoch = options['steps_per_epoch'] or len(data_flow),
+                            callbacks = [stopper], verbose = 0)
+
+    result.update(epochs = len(history.history['loss']),
+                  stopped_early = stopper.stopped_epoch is not None,
+                  r_loss = history.history['r_loss'][-1],
+                  kl_loss = history.history['kl_loss'][-1])
+    if options['validation_split']:
+      validation_flow = CacheIterator(dataset, batch_size = 1024, shuffle = False, rescale = None,
+                                      class_mode = None, validation_split = options['validation_split'],
+                                      subset = 'validation')
+      scores = evaluate_scores(vae_model, validation_flow)
+      result.update(val_r_loss = scores['r_loss'], val_kl_loss = scores['kl_loss'])
+  except Exception:
+    result['error'] = traceback.format_exc().strip().split('\n')[-1]
+  result['seconds'] = time.perf_counter() - started
+  return result
+
+
+def run_sweep(cache_folder, configs, output_path, subset = 20000, epochs = 5, parallel = None,
+              batch_size = 128, steps_per_epoch = None, validation_split = 0.1, margin = 0.05,
+              min_epochs = 2, seed = 0, verbose = 1):
+  """Trains every configuration of `configs` (see `grid`) and writes a row per trial to `output_path`.
+
+  `parallel` trials run at a time, by default one per group of 2 cores.
+  Returns the rows, in the order the trials finished.
+  """
+  subset_folder = os.path.join(os.path.dirname(output_path) or '.', 'cache_subset_%d' % subset)
+  build_subset(cache_folder, subset_folder, subset)
+
+  parallel = min(parallel or max(os.cpu_count() // 2, 1), len(configs))
+  options = {'subset_folder': subset_folder, 'epochs': epochs, 'batch_size': batch_size,
+             'steps_per_epoch': steps_per_epoch, 'validation_split': validation_split,
+             'margin': margin, 'min_epochs': min_epochs, 'seed': seed}
+
+  context = multiprocessing.get_context('spawn')
+  manager = context.Manager()
+  # Curves of r_loss and kl_loss of every trial, shared between the trials
+  curves = manager.dict()
+  slots = context.Queue()
+  for slot in range(parallel):
+    slots.put(slot)
+
+  rows = []
+  with open(output_path, 'w', newline = '') as f:
+    writer = csv.DictWriter(f, RESULT_FIELDS, extrasaction = 'ignore')
+    writer.writeheader()
+    with ProcessPoolExecutor(parallel, mp_context = context, initializer = _init_worker,
+                             initargs = (slots, parallel)) as pool:
+      futures = [pool.submit(_run_trial, trial, config, options, curves) for trial, config in enumerate(configs)]
+      for future in as_completed(futures):
+        row = future.result()
+        rows.append(row)
+        writer.writerow(row)
+        f.flush()
+        if verbose > 0:
+          print('Trial %d (%d / %d): %s' % (row['trial'], len(rows), len(configs), _summary(row)))
+  manager.shutdown()
+  return rows
+
+
+# COMMAND LINE
+def _summary(row):
+  if row.get('error'):
+    return 'failed, ' + row['error']
+  text = 'loss_factor %g, z_dim %d, learning_rate %g: r_loss %.5g, kl_loss %.5g after %d epochs' % (
+    row['loss_factor'], row['z_dim'], row['learning_rate'], row['r_loss'], row['kl_loss'], row['epochs'])
+  if 'val_r_loss' in row:
+    text += ', val_r_loss %.5g' % row['val_r_loss']
+  return text + (' (stopped)' if row['stopped_early'] else '')
+
+
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+  parser.add_argument('--cache', required = True, help = 'cache folder written by build_cache')
+  parser.add_argument('--output', default = './sweeps/results.csv')
+  parser.add_argument('--loss-factors', type = float, nargs = '+', default = [1000, 10000, 100000])
+  parser.add_argument('--z-dims', type = int, nargs = '+', default = [100, 200])
+  parser.add_argument('--learning-rates', type = float, nargs = '+', default = [0.0005, 0.001])
+  parser.add_argument('--subset', type = int, default = 20000, help = 'images of the cache the trials train on')
+  parser.add_argument('--validation-split', type = float, default = 0.1,
+                      help = 'part of the subset held out to score the trials')
+  parser.add_argument('--epochs', type = int, default = 5)
+  parser.add_argument('--steps', type = int, default = None, help = 'steps per epoch, by default the whole subset')
+  parser.add_argument('--batch-size', type = int, default = 128)
+  parser.add_argument('--parallel', type = int, default = None, help = 'trials running at a time')
+  parser.add_argument('--margin', type = float, default = 0.05,
+                      help = 'a trial stops when another one is better by this fraction on both losses')
+  parser.add_argument('--min-epochs', type = int, default = 2, help = 'epochs before a trial can be stopped')
+  parser.add_argument('--seed', type = int, default = 0)
+  args = parser.parse_args(argv)
+
+  folder = os.path.dirname(args.output)
+  if folder and not os.path.exists(folder):
+    os.makedirs(folder)
+
+  configs = grid(args.loss_factors, args.z_dims, args.learning_rates)
+  rows = run_sweep(args.cache, configs, args.output, subset = args.subset, epochs = args.epochs,
+                   parallel = args.parallel, batch_size = args.batch_size, steps_per_epoch = args.steps,
+                   validation_split = args.validation_split, margin = args.margin,
+                   min_epochs = args.min_epochs, seed = args.seed)
+
+  key = 'val_r_loss' if args.validation_split else 'r_loss'
+  finished = sorted((row for row in rows if not row.get('error')), key = lambda row: row[key])
+  print('\nBest trials by %s (table in %s):' % (key, args.output))
+  for row in finished[:5]:
+    print('  %d: %s' % (row['trial'], _summary(row)))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,245 @@
+"""Trains the Simple Autoencoder and the VAE of the training script.
+
+The steps of face_gen_VAE.py as functions, with a command line:
+
+  python -m face_gen train --data-zip celeba-dataset.zip --model vae --epochs 200
+
+Training resumes from the latest checkpoint in the weights folder.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+from face_gen.data import ZipImageReader, build_cache, CacheIterator, ZipIterator, ParallelLoader
+
+KAGGLE_DATASET = 'jessicali9530/celeba-dataset'
+
+
+# DATA
+def download_celeba(kaggle_json = 'kaggle.json', path = '.'):
+  """Downloads the CelebA zip file from Kaggle to `path` with the Kaggle API."""
+  subprocess.check_call([sys.executable, '-m', 'pip', 'install', '-U', '-q', 'kaggle'])
+
+  kaggle_folder = os.path.expanduser('~/.kaggle')
+  if not os.path.exists(kaggle_folder):
+    os.makedirs(kaggle_folder)
+  if os.path.exists(kaggle_json):
+    shutil.copy(kaggle_json, kaggle_folder)
+    os.chmod(os.path.join(kaggle_folder, 'kaggle.json'), 0o600)
+
+  subprocess.check_call(['kaggle', 'datasets', 'download', '--force', '-d', KAGGLE_DATASET, '-p', path])
+  return os.path.join(path, KAGGLE_DATASET.split('/')[1] + '.zip')
+
+
+def make_data_flow(reader, input_dim, batch_size, use_cache = True, cache_folder = None, workers = None,
+                   validation_split = 0., shuffle = 'window'):
+  # uint8 batches of (x, x), loaded by `workers` processes, without the last
+  # `validation_split` of the images. The cached images are reshuffled within
+  # windows of the cache every epoch; shuffle = 'batch' keeps the batches of
+  # the cache as they are, which reads faster
+  if use_cache:
+    cache_folder = cache_folder or './data/cache_{}x{}/'.format(*input_dim[:2])
+    dataset = build_cache(reader, cache_folder, target_size = input_dim[:2])
+    data_flow = CacheIterator(dataset,
+                              batch_size = batch_size,
+                              shuffle = shuffle,
+                              rescale = None,
+                              validation_split = validation_split,
+                              subset = 'training'
+                              )
+  else:
+    data_flow = ZipIterator(reader,
+                            target_size = input_dim[:2],
+                            batch_size = batch_size,
+                            shuffle = True,
+                            rescale = None,
+                            validation_split = validation_split,
+                            subset = 'training'
+                            )
+
+  return ParallelLoader(data_flow, workers = workers)
+
+
+def make_validation_flow(reader, input_dim, batch_size, validation_split, use_cache = True, cache_folder = None):
+  # The held out images, in order, as uint8 batches of x only
+  if use_cache:
+    cache_folder = cache_folder or './data/cache_{}x{}/'.format(*input_dim[:2])
+    dataset = build_cache(reader, cache_folder, target_size = input_dim[:2])
+    return CacheIterator(dataset, batch_size = batch_size, shuffle = False, rescale = None,
+                         class_mode = None, validation_split = validation_split, subset = 'validation')
+
+  return ZipIterator(reader, target_size = input_dim[:2], batch_size = batch_size, shuffle = False,
+                     rescale = None, class_mode = None, validation_split = validation_split,
+                     subset = 'validation')
+
+
+# MODELS
+def build_autoencoder(input_dim, z_dim, input_rescale = 1./255):
+  from keras.models import Model
+  from face_gen.models import architecture, build_encoder, build_decoder
+
+  layers = architecture(input_dim)
+  encoder_input, encoder_output, shape_before_flattening, encoder = build_encoder(input_dim = input_dim,
+                                    output_dim = z_dim,
+                                    conv_filters = layers['encoder_conv_filters'],
+                                    conv_kernel_size = layers['conv_kernel_size'],
+                                    conv_strides = layers['conv_strides'],
+                                    input_rescale = input_rescale)
+
+  _, _, decoder = build_decoder(input_dim = z_dim,
+                                shape_before_flattening = shape_before_flattening,
+                                conv_filters = layers['decoder_conv_filters'],
+                                conv_kernel_size = layers['conv_kernel_size'],
+                                conv_strides = layers['conv_strides'])
+
+  simple_autoencoder = Model(encoder_input, decoder(encoder_output))
+  return encoder, decoder, simple_autoencoder
+
+
+# TRAINING
+def _callbacks(name, weights_folder, log_folder):
+  from face_gen.callbacks import TrainingMonitor
+  from face_gen.checkpoints import CheckpointManager
+
+  checkpoint = CheckpointManager(os.path.join(weights_folder, name), keep = 5)
+  monitor = TrainingMonitor(os.path.join(log_folder, name, 'steps.csv'),
+                            trace_path = os.path.join(log_folder, name, 'trace.json'))
+  return checkpoint, monitor
+
+
+def fit_resumed(model, data_flow, epochs, checkpoint, monitor, callbacks = (), resume = True):
+  """`model.fit` from the latest checkpoint of `checkpoint`, with the callbacks.
+
+  After a checkpoint saved in the middle of an epoch, only the steps left
+  in that epoch are run, on fresh batches from `data_flow` (the batches of
+  the interrupted run are not replayed), so the step count stays right and
+  the later epochs keep their length.
+  With `resume = False` the checkpoints already in the folder are deleted
+  (they would outlive the new ones in the rotation) and training starts
+  from the current weights. Returns the history of the last `fit`.
+  """
+  if not resume:
+    checkpoint.clear()
+  initial_epoch, epoch_step = checkpoint.restore(model)
+  callbacks = list(callbacks) + [checkpoint, monitor]
+  steps_per_epoch = len(data_flow)
+  if epoch_step >= steps_per_epoch:
+    # Saved on the last batch of the epoch, or with longer epochs than these
+    initial_epoch, epoch_step = initial_epoch + 1, 0
+    checkpoint.epoch_step = 0
+
+  history = None
+  if epoch_step and initial_epoch < epochs:
+    history = model.fit(monitor.wrap(data_flow),
+                        epochs = initial_epoch + 1,
+                        initial_epoch = initial_epoch,
+                        steps_per_epoch = steps_per_epoch - epoch_step,
+                        callbacks = callbacks)
+    initial_epoch += 1
+    if model.stop_training or initial_epoch >= epochs:
+      return history
+
+  return model.fit(monitor.wrap(data_flow),
+                   epochs = epochs,
+                   initial_epoch = initial_epoch,
+                   steps_per_epoch = steps_per_epoch,
+                   callbacks = callbacks)
+
+
+def train_autoencoder(simple_autoencoder, data_flow, epochs, weights_folder = './weights/',
+                      log_folder = './logs/', learning_rate = 0.0005, input_rescale = 1./255):
+  from keras.optimizers import Adam
+  from face_gen.models import make_r_loss
+
+  simple_autoencoder.compile(optimizer = Adam(learning_rate = learning_rate),
+                             loss = make_r_loss(target_rescale = input_rescale))
+
+  checkpoint, monitor = _callbacks('AE', weights_folder, log_folder)
+  return fit_resumed(simple_autoencoder, data_flow, epochs, checkpoint, monitor)
+
+
+def train_vae(vae_model, data_flow, epochs, weights_folder = './weights/', log_folder = './logs/',
+              learning_rate = 0.0005, loss_factor = 10000, name = 'VAE', callbacks = None, resume = True):
+  from keras import backend as K
+  from keras.optimizers import Adam
+
+  K.set_value(vae_model.loss_factor, loss_factor)
+  vae_model.compile(optimizer = Adam(learning_rate = learning_rate))
+
+  checkpoint, monitor = _callbacks(name, weights_folder, log_folder)
+  # The extra callbacks go first, so the metrics they add to the
+  # logs (e.g. val_r_loss) reach the checkpoint and the monitor
+  return fit_resumed(vae_model, data_flow, epochs, checkpoint, monitor, callbacks or [], resume)
+
+
+# COMMAND LINE
+def main(argv = None):
+  parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+  parser.add_argument('--data-zip', default = 'celeba-dataset.zip')
+  parser.add_argument('--download', action = 'store_true',
+                      help = 'download the zip file from Kaggle if it is missing')
+  parser.add_argument('--kaggle-json', default = 'kaggle.json')
+  parser.add_argument('--model', default = 'vae', choices = ['ae', 'vae', 'both'])
+  parser.add_argument('--weights', default = './weights/', help = 'checkpoint folder')
+  parser.add_argument('--logs', default = './logs/')
+  parser.add_argument('--epochs', type = int, default = 200)
+  parser.add_argument('--batch-size', type = int, default = 512)
+  parser.add_argument('--accumulation-steps', type = int, default = 1,
+                      help = 'micro-batches per VAE step, peak memory follows batch-size / accumulation-steps')
+  parser.add_argument('--learning-rate', type = float, default = 0.0005)
+  parser.add_argument('--loss-factor', type = float, default = 10000)
+  parser.add_argument('--input-dim', type = int, default = 128)
+  parser.add_argument('--z-dim', type = int, default = 200)
+  parser.add_argument('--no-cache', action = 'store_true', help = 'decode the images from the zip file on every epoch')
+  parser.add_argument('--cache-folder', default = None)
+  parser.add_argument('--shuffle', default = 'window', choices = ['window', 'full', 'batch'],
+                      help = "how the cached images are shuffled every epoch, 'batch' only reorders whole batches")
+  parser.add_argument('--workers', type = int, default = None, help = 'data loading processes')
+  parser.add_argument('--validation-split', type = float, default = 0.,
+                      help = 'hold out the last VALIDATION_SPLIT of the images and score the VAE on them')
+  parser.add_argument('--eval-seconds', type = float, default = 60.,
+                      help = 'time budget of the validation at the end of every epoch')
+  args = parser.parse_args(argv)
+
+  if not os.path.exists(args.data_zip):
+    if not args.download:
+      parser.error('%s not found, pass --download to download it from Kaggle' % args.data_zip)
+    download_celeba(args.kaggle_json, os.path.dirname(args.data_zip) or '.')
+
+  input_dim = (args.input_dim, args.input_dim, 3)
+  data_flow = make_data_flow(ZipImageReader(args.data_zip), input_dim, args.batch_size,
+                             use_cache = not args.no_cache,
+                             cache_folder = args.cache_folder,
+                             workers = args.workers,
+                             validation_split = args.validation_split,
+                             shuffle = True if args.shuffle == 'full' else args.shuffle)
+
+  with data_flow:
+    if args.model in ('ae', 'both'):
+      _, _, simple_autoencoder = build_autoencoder(input_dim, args.z_dim)
+      train_autoencoder(simple_autoencoder, data_flow, args.epochs, args.weights, args.logs,
+                        learning_rate = args.learning_rate)
+
+    if args.model in ('vae', 'both'):
+      from face_gen.models import build_vae
+      _, _, vae_model = build_vae(input_dim, args.z_dim, accumulation_steps = args.accumulation_steps)
+
+      callbacks = []
+      if args.validation_split:
+        from face_gen.evaluate import ValidationScorer
+        validation_flow = make_validation_flow(ZipImageReader(args.data_zip), input_dim, 1024,
+                                               args.validation_split, use_cache = not args.no_cache,
+                                               cache_folder = args.cache_folder)
+        callbacks.append(ValidationScorer(validation_flow, max_seconds = args.eval_seconds, verbose = 1))
+
+      train_vae(vae_model, data_flow, args.epochs, args.weights, args.logs,
+                learning_rate = args.learning_rate, loss_factor = args.loss_factor, callbacks = callbacks)
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
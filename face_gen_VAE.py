@@ -15,276 +15,130 @@ This example demonstrates the process of building and training a VAE using Keras
 Also, please see Face Generation using GAN:
 https://github.com/farrokhkarimi/face_gen_GAN
 
+Importing this file has no side effects: it only defines the settings and the steps below. Run it with <i>python face_gen_VAE.py</i> to go through the whole tutorial, or use the commands of the package (<i>python -m face_gen train</i>, <i>generate</i>, <i>encode</i>) to run a single step.
+
 ### Downloading the dataset
 The dataset can be downloaded directly into your Google Colab environment using the [Kaggle API](https://www.kaggle.com/docs/api) as shown below.
 """
 
-!pip install -U -q kaggle
-!mkdir -p ~/.kaggle
-
-"""Upload Kaggle.json downloaded from your registered kaggle account"""
-
-from google.colab import files
-files.upload()
+import os
 
-!cp kaggle.json ~/.kaggle/
-!chmod 600 /root/.kaggle/kaggle.json
-!kaggle datasets download --force -d jessicali9530/celeba-dataset
+import numpy as np
 
-import os
-from glob import glob
+from face_gen.data import ZipImageReader
+from face_gen.montage import interleave_rows, save_montage
+from face_gen.train import (download_celeba, make_data_flow, make_validation_flow, build_autoencoder,
+                            train_autoencoder, train_vae)
 
 WEIGHTS_FOLDER = './weights/'
-DATA_FOLDER = './data/img_align_celeba/'
+LOG_FOLDER = './logs/'
+DATA_ZIP = 'celeba-dataset.zip'
 
-if not os.path.exists(WEIGHTS_FOLDER):
-  os.makedirs(os.path.join(WEIGHTS_FOLDER,"AE"))
-  os.makedirs(os.path.join(WEIGHTS_FOLDER,"VAE"))
+"""Upload Kaggle.json downloaded from your registered kaggle account"""
 
-#Unzip the dataset downloaded from kaggle
-from zipfile import ZipFile
-with ZipFile('celeba-dataset.zip', 'r') as zipObj:
-   # Extract all the contents of zip file in the data directory
-   zipObj.extractall('./data/')
+def download_dataset():
+  if not os.path.exists('kaggle.json'):
+    try:
+      from google.colab import files
+      files.upload()
+    except ImportError:
+      pass
 
-"""### Imports"""
+  download_celeba('kaggle.json', path = os.path.dirname(DATA_ZIP) or '.')
 
-import numpy as np
+"""###Data"""
 
-from keras.preprocessing.image import ImageDataGenerator
-from keras.layers import Input, Conv2D, Flatten, Dense, Conv2DTranspose, Reshape, Lambda, Activation, BatchNormalization, LeakyReLU, Dropout
-from keras.models import Model
-from keras import backend as K
-from keras.optimizers import Adam
-from keras.callbacks import ModelCheckpoint 
-from keras.utils import plot_model
+"""Since the dataset is quite large, we shall not load the entire dataset into memory. The images are read straight from the zip file downloaded from kaggle, so ~200k small files are never extracted to disk. Decoding and resizing ~200k JPEGs again on every epoch would however keep the training waiting on the CPU, so the images are decoded and resized only once into a cache of memory-mapped uint8 shards (<i>build_cache</i>). Later runs reuse the cache.
 
-"""###Data"""
+The images are written to the cache in a random order. On every epoch the <i>CacheIterator</i> shuffles them again within windows of 10000 neighbouring images and visits the windows in a random order, so every batch holds different images from one epoch to the next while its reads stay within one region of the cache (<i>shuffle = 'batch'</i> reads every batch as a single contiguous slice instead, at the cost of the same batches on every epoch). Like <i>flow_from_directory</i> with <i>class_mode = 'input'</i>, it yields the images both as the input and the target of the model (the same array, not a copy). With <i>rescale = None</i> the images are yielded as uint8.
+
+Building the cache takes a few minutes. Set <i>USE_CACHE = False</i> to start training right away with a <i>ZipIterator</i>, which decodes every batch straight from the zip file instead.
 
-filenames = np.array(glob(os.path.join(DATA_FOLDER, '*/*.jpg')))
-NUM_IMAGES = len(filenames)
-print("Total number of images : " + str(NUM_IMAGES))
+Either way, the batches are loaded by a <i>ParallelLoader</i>: N_WORKERS processes load the upcoming batches into shared memory while the model trains on the current one, so the input pipeline is no longer limited to a single core. <i>make_data_flow</i> in <i>face_gen/train.py</i> puts these together.
 
-"""Since the dataset is quite large, we shall create an <i>ImageDataGenerator</i> object and employ its member function - <i>flow_from_directory</i> to define the flow of data directly from disk rather than loading the entire dataset into memory. The ImageDataGenerator can also be used to dynamically apply various transformations for image augmentation which is particularly useful in the case of small datasets."""
+Like <i>flow_from_directory</i> with <i>validation_split</i>, the last VALIDATION_SPLIT of the images are held out: <i>make_data_flow</i> only yields the <i>'training'</i> subset, and <i>make_validation_flow</i> yields the <i>'validation'</i> subset in order."""
 
 INPUT_DIM = (128,128,3) # Image dimension
+INPUT_RESCALE = 1./255 # Applied inside the models, the batches stay uint8
 BATCH_SIZE = 512
 Z_DIM = 200 # Dimension of the latent vector (z)
 
-data_flow = ImageDataGenerator(rescale=1./255).flow_from_directory(DATA_FOLDER, 
-                                                                   target_size = INPUT_DIM[:2],
-                                                                   batch_size = BATCH_SIZE,
-                                                                   shuffle = True,
-                                                                   class_mode = 'input',
-                                                                   subset = 'training'
-                                                                   )
+USE_CACHE = True
+N_WORKERS = os.cpu_count()
+CACHE_FOLDER = './data/cache_{}x{}/'.format(*INPUT_DIM[:2])
+VALIDATION_SPLIT = 0.05 # Held out images, the VAE is scored on them
 
 """### MODEL ARCHITECTURE
 
-####Building the Encoder
-"""
+The builders for the models below live in <i>face_gen/models.py</i>, and <i>build_autoencoder</i> in <i>face_gen/train.py</i> puts the Simple Autoencoder together.
 
-# ENCODER
-def build_encoder(input_dim, output_dim, conv_filters, conv_kernel_size, 
-                  conv_strides):
-  
-  # Clear tensorflow session to reset layer index numbers to 0 for LeakyRelu, 
-  # BatchNormalization and Dropout.
-  # Otherwise, the names of above mentioned layers in the model 
-  # would be inconsistent
-  global K
-  K.clear_session()
-  
-  # Number of Conv layers
-  n_layers = len(conv_filters)
-
-  # Define model input
-  encoder_input = Input(shape = input_dim, name = 'encoder_input')
-  x = encoder_input
-
-  # Add convolutional layers
-  for i in range(n_layers):
-      x = Conv2D(filters = conv_filters[i], 
-                  kernel_size = conv_kernel_size[i],
-                  strides = conv_strides[i], 
-                  padding = 'same',
-                  name = 'encoder_conv_' + str(i)
-                  )(x)
-
-      x = LeakyReLU()(x)
-    
-  # Required for reshaping latent vector while building Decoder
-  shape_before_flattening = K.int_shape(x)[1:] 
-  
-  x = Flatten()(x)
-
-  # Define model output
-  encoder_output = Dense(output_dim, name = 'encoder_output')(x)
-
-  return encoder_input, encoder_output, shape_before_flattening, Model(encoder_input, encoder_output)
-
-"""The architecture of the Encoder, as shown below, consists of a stack of convolutional layers followed by a dense (fully connected) layer which outputs a vector of size 200.
-
-
-<i>Note : The combination of padding = 'same' and stride = 2 will produce an output tensor half the size of the input tensor in both height and width. The depth/channels aren't affected as they are numerically equal to the number of filters. </i>
-"""
+The batches stay uint8 all the way into the model: with <i>input_rescale</i> set, the encoder takes the raw images and scales them by INPUT_RESCALE as its first layer, and the reconstruction loss scales its targets the same way. This keeps every batch 4x smaller on the host than a float32 copy.
 
-encoder_input, encoder_output,  shape_before_flattening, encoder  = build_encoder(input_dim = INPUT_DIM,
-                                    output_dim = Z_DIM, 
-                                    conv_filters = [32, 64, 64, 64],
-                                    conv_kernel_size = [3,3,3,3],
-                                    conv_strides = [2,2,2,2])
-
-encoder.summary()
-
-"""####Building the Decoder"""
-
-# Decoder
-def build_decoder(input_dim, shape_before_flattening, conv_filters, conv_kernel_size, 
-                  conv_strides):
-
-  # Number of Conv layers
-  n_layers = len(conv_filters)
+####Building the Encoder
 
-  # Define model input
-  decoder_input = Input(shape = (input_dim,) , name = 'decoder_input')
+The architecture of the Encoder, as shown below, consists of a stack of convolutional layers followed by a dense (fully connected) layer which outputs a vector of size 200.
 
-  # To get an exact mirror image of the encoder
-  x = Dense(np.prod(shape_before_flattening))(decoder_input)
-  x = Reshape(shape_before_flattening)(x)
 
-  # Add convolutional layers
-  for i in range(n_layers):
-      x = Conv2DTranspose(filters = conv_filters[i], 
-                  kernel_size = conv_kernel_size[i],
-                  strides = conv_strides[i], 
-                  padding = 'same',
-                  name = 'decoder_conv_' + str(i)
-                  )(x)
-      
-      # Adding a sigmoid layer at the end to restrict the outputs 
-      # between 0 and 1
-      if i < n_layers - 1:
-        x = LeakyReLU()(x)
-      else:
-        x = Activation('sigmoid')(x)
+<i>Note : The combination of padding = 'same' and stride = 2 will produce an output tensor half the size of the input tensor in both height and width. The depth/channels aren't affected as they are numerically equal to the number of filters. </i>
 
-  # Define model output
-  decoder_output = x
+The number of convolutional layers follows from INPUT_DIM: <i>architecture</i> adds a layer for every halving of the image down to 8 x 8, so 128 x 128 images go through the 4 layers above and 64 x 64 images through 3. <i>python -m face_gen progressive</i> uses this to train at 32, 64 and then 128 pixels, carrying the weights from one stage to the next.
 
-  return decoder_input, decoder_output, Model(decoder_input, decoder_output)
+####Building the Decoder
 
-"""Recall that it is the function of the Decoder to reconstruct the image from the latent vector. Therefore, it is necessary to define the decoder so as to increase the size of the activations gradually through the network.
+Recall that it is the function of the Decoder to reconstruct the image from the latent vector. Therefore, it is necessary to define the decoder so as to increase the size of the activations gradually through the network.
 
 Here, the Conv2DTranspose Layer is employed. This layer produces an output tensor double the size of the input tensor in both height and width.
 
 <i>Note : The Decoder, in this example, is defined to be a mirror image of the encoder, which is not mandatory.</i>
-"""
-
-decoder_input, decoder_output, decoder = build_decoder(input_dim = Z_DIM,
-                                        shape_before_flattening = shape_before_flattening,
-                                        conv_filters = [64,64,32,3],
-                                        conv_kernel_size = [3,3,3,3],
-                                        conv_strides = [2,2,2,2])
-decoder.summary()
-
-"""#### Attaching the Decoder to the Encoder"""
 
-# The input to the model will be the image fed to the encoder.
-simple_autoencoder_input = encoder_input
+#### Attaching the Decoder to the Encoder
 
-# The output will be the output of the decoder. The term - decoder(encoder_output) 
-# combines the model by passing the encoder output to the input of the decoder.
-simple_autoencoder_output = decoder(encoder_output)
+The input to the model is the image fed to the encoder. The output is the output of the decoder: the term decoder(encoder_output) combines the model by passing the encoder output to the input of the decoder.
 
-# Input to the combined model will be the input to the encoder.
-# Output of the combined model will be the output of the decoder.
-simple_autoencoder = Model(simple_autoencoder_input, simple_autoencoder_output)
-
-simple_autoencoder.summary()
-
-"""### COMPILATION AND TRAINING
+### COMPILATION AND TRAINING
 
 The loss function used is a simple Root Mean Square Error (RMSE). The true output is the same batch of images that was fed to the model at its input layer. The Adam optimizer is optimizing the RMSE error for encoding the batch of images into their respective latent vectors and subsequently decoding them to reconstruct the images. 
 
-The ModelCheckpoint Keras callback saves the model weights for reuse. It overwrites the file with a fresh set of weights after every epoch.
-
-NOTE : If you're using Google Colab, either download the weights to disc or mount your Google Drive.
-"""
-
-LEARNING_RATE = 0.0005
-N_EPOCHS = 10
-
-optimizer = Adam(lr = LEARNING_RATE)
+The CheckpointManager callback saves the model weights for reuse, together with the state of the optimizer. After every epoch it copies them into memory and writes them to disk on a background thread, so the training does not wait for the write. It keeps the last few checkpoints and links the latest one to weights.h5. If a previous run was interrupted, <i>restore</i> loads its latest checkpoint and returns the epoch to resume from.
 
-def r_loss(y_true, y_pred):
-    return K.mean(K.square(y_true - y_pred), axis = [1,2,3])
+The TrainingMonitor callback logs every training step to a rolling CSV file in LOG_FOLDER: how long the step waited for data_flow and how long it spent computing, the throughput in images/s, the peak memory use and the losses. It also writes a Chrome trace (open it in chrome://tracing) at the end of training. The monitor only sees the data through <i>monitor.wrap(data_flow)</i>.
 
-simple_autoencoder.compile(optimizer=optimizer, loss = r_loss)
-
-checkpoint_ae = ModelCheckpoint(os.path.join(WEIGHTS_FOLDER, 'AE/weights.h5'), save_weights_only = True, verbose=1)
+NOTE : If you're using Google Colab, either download the weights to disc or mount your Google Drive.
 
-"""<i>TIP</i> : Here's a really useful tip I found on Reddit (by arvind1096) - to prevent Google Colab from disconnecting due to a timeout issue, execute the following JS function in the Google Chrome console. 
+<i>TIP</i> : Here's a really useful tip I found on Reddit (by arvind1096) - to prevent Google Colab from disconnecting due to a timeout issue, execute the following JS function in the Google Chrome console. 
 
 <br>
 function ClickConnect(){console.log("Working");document.querySelector("colab-toolbar-button#connect").click()}setInterval(ClickConnect,60000)
 """
 
-simple_autoencoder.fit_generator(data_flow, 
-                                 shuffle=True, 
-                                 epochs = N_EPOCHS, 
-                                 initial_epoch = 0, 
-                                 steps_per_epoch=NUM_IMAGES / BATCH_SIZE,
-                                 callbacks=[checkpoint_ae])
+LEARNING_RATE = 0.0005
+N_EPOCHS_AE = 10
 
 """### RECONSTRUCTION
 
-The first step is to generate a new batch of images using the ImageDataGenerator defined in the 'Data' section at the top. The images are returned as an array and the number of images is equal to BATCH_SIZE.
-"""
-
-example_batch = next(data_flow)
-example_batch = example_batch[0]
-example_images = example_batch[:10]
+The first step is to generate a new batch of images using the data_flow defined in the 'Data' section at the top. The images are returned as an array and the number of images is equal to BATCH_SIZE.
 
-example_images.shape
+#### Displaying the reconstructed images
 
-"""#### Displaying the reconstructed images"""
-
-import matplotlib.pyplot as plt
+The images are tiled into a single grid with a reshape of the batch and written to MONTAGE_FOLDER, rather than drawn as one matplotlib subplot each, so hundreds of faces render as fast as ten. Each row of originals is followed by the row of their reconstructions. <i>python -m face_gen montage</i> writes grids of thousands of faces, streaming very large ones to a PNG file a strip of rows at a time.
+"""
 
-def plot_compare(images=None, add_noise=False):
-  
-  if images is None:
-    example_batch = next(data_flow)
-    example_batch = example_batch[0]
-    images = example_batch[:10]
+MONTAGE_FOLDER = './montages/'
+MONTAGE_COLS = 10 # Images per row of the grids of samples
 
+def plot_compare(simple_autoencoder, encoder, decoder, images, add_noise=False, path=None):
   n_to_show = images.shape[0]
 
   if add_noise:
     encodings = encoder.predict(images)
-    encodings += np.random.normal(0.0, 1.0, size = (n_to_show,200))
+    encodings += np.random.normal(0.0, 1.0, size = (n_to_show,Z_DIM))
     reconst_images = decoder.predict(encodings)
 
   else:
     reconst_images = simple_autoencoder.predict(images)
 
-  fig = plt.figure(figsize=(15, 3))
-  fig.subplots_adjust(hspace=0.4, wspace=0.4)
-
-  for i in range(n_to_show):
-      img = images[i].squeeze()
-      sub = fig.add_subplot(2, n_to_show, i+1)
-      sub.axis('off')        
-      sub.imshow(img)
-
-  for i in range(n_to_show):
-      img = reconst_images[i].squeeze()
-      sub = fig.add_subplot(2, n_to_show, i+n_to_show+1)
-      sub.axis('off')
-      sub.imshow(img)
-
-plot_compare(example_images)
+  path = path or os.path.join(MONTAGE_FOLDER, 'ae_noise.png' if add_noise else 'ae_compare.png')
+  return save_montage(interleave_rows([images, reconst_images], n_to_show), path, n_cols = n_to_show)
 
 """The first row shows images directly from the dataset and the second row shows images that have been passed through the Autoencoder. Evidently, the model has learned to encode and decode (reconstruct) fairly well. 
 
@@ -293,28 +147,16 @@ NOTE : A reason why the images lack sharpness is due to the RMSE loss as it aver
 ### DRAWBACKS
 
 #### Adding noise vectors sampled from a standard normal distribution to the image encodings
-"""
 
-plot_compare(images = example_images, add_noise = True)
-
-"""It can be observed that the images are starting to get distorted with a bit of noise added to its encodings. One possible reason could be that the model did not ensure that the space around the encoded values (latent space) was continuous.
+It can be observed that the images are starting to get distorted with a bit of noise added to its encodings. One possible reason could be that the model did not ensure that the space around the encoded values (latent space) was continuous.
 
 ### Attempting to generate images from latent vectors sampled from a standard normal distribution
 """
 
-def generate_images_from_noise(n_to_show = 10): 
+def generate_images_from_noise(decoder, n_to_show = 10, path = None):
   reconst_images = decoder.predict(np.random.normal(0,1,size=(n_to_show,Z_DIM)))
-
-  fig = plt.figure(figsize=(15, 3))
-  fig.subplots_adjust(hspace=0.4, wspace=0.4)
-
-  for i in range(n_to_show):
-      img = reconst_images[i].squeeze()
-      sub = fig.add_subplot(2, n_to_show, i+1)
-      sub.axis('off')        
-      sub.imshow(img)
-
-generate_images_from_noise()
+  return save_montage(reconst_images, path or os.path.join(MONTAGE_FOLDER, 'ae_noise_samples.png'),
+                      n_cols = min(n_to_show, MONTAGE_COLS))
 
 """It is evident that the latent vector sampled from a standard normal distribution can not be used to generate new faces. This shows that the latent vectors generated by the model are not centered/symmetrical around the origin. This also strengthens our inference that the latent space is not continuous.
 
@@ -328,176 +170,103 @@ Variational Autencoders tackle most of the problems discussed above. They are tr
 
 ### CODE
 
-#### Building the Encoder
-"""
-
-# ENCODER
-def build_vae_encoder(input_dim, output_dim, conv_filters, conv_kernel_size, 
-                  conv_strides, use_batch_norm = False, use_dropout = False):
-  
-  # Clear tensorflow session to reset layer index numbers to 0 for LeakyRelu, 
-  # BatchNormalization and Dropout.
-  # Otherwise, the names of above mentioned layers in the model 
-  # would be inconsistent
-  global K
-  K.clear_session()
-  
-  # Number of Conv layers
-  n_layers = len(conv_filters)
-
-  # Define model input
-  encoder_input = Input(shape = input_dim, name = 'encoder_input')
-  x = encoder_input
-
-  # Add convolutional layers
-  for i in range(n_layers):
-      x = Conv2D(filters = conv_filters[i], 
-                  kernel_size = conv_kernel_size[i],
-                  strides = conv_strides[i], 
-                  padding = 'same',
-                  name = 'encoder_conv_' + str(i)
-                  )(x)
-      if use_batch_norm:
-        x = BathcNormalization()(x)
-  
-      x = LeakyReLU()(x)
-
-      if use_dropout:
-        x = Dropout(rate=0.25)(x)
-
-  # Required for reshaping latent vector while building Decoder
-  shape_before_flattening = K.int_shape(x)[1:] 
-  
-  x = Flatten()(x)
-  
-  mean_mu = Dense(output_dim, name = 'mu')(x)
-  log_var = Dense(output_dim, name = 'log_var')(x)
-
-  # Defining a function for sampling
-  def sampling(args):
-    mean_mu, log_var = args
-    epsilon = K.random_normal(shape=K.shape(mean_mu), mean=0., stddev=1.) 
-    return mean_mu + K.exp(log_var/2)*epsilon   
-  
-  # Using a Keras Lambda Layer to include the sampling function as a layer 
-  # in the model
-  encoder_output = Lambda(sampling, name='encoder_output')([mean_mu, log_var])
-
-  return encoder_input, encoder_output, mean_mu, log_var, shape_before_flattening, Model(encoder_input, encoder_output)
-
-vae_encoder_input, vae_encoder_output,  mean_mu, log_var, vae_shape_before_flattening, vae_encoder  = build_vae_encoder(input_dim = INPUT_DIM,
-                                    output_dim = Z_DIM, 
-                                    conv_filters = [32, 64, 64, 64],
-                                    conv_kernel_size = [3,3,3,3],
-                                    conv_strides = [2,2,2,2])
-
-vae_encoder.summary()
-
-"""#### Building the Decoder
-Since the Decoder remains the same, the Decoder architecture of the Simple Autoencoder is reused.
-"""
+<i>build_vae</i> in <i>face_gen/models.py</i> builds the VAE encoder, which outputs mu and log_var and samples the latent vector from them. Since the Decoder remains the same, the Decoder architecture of the Simple Autoencoder is reused.
 
-vae_decoder_input, vae_decoder_output, vae_decoder = build_decoder(input_dim = Z_DIM,
-                                        shape_before_flattening = shape_before_flattening,
-                                        conv_filters = [64,64,32,3],
-                                        conv_kernel_size = [3,3,3,3],
-                                        conv_strides = [2,2,2,2]
-                                        )
-vae_decoder.summary()
+#### Attaching the Decoder to the Encoder
 
-"""#### Attaching the Decoder to the Encoder"""
+VAEModel attaches the decoder to the encoder like the Simple Autoencoder: the input to the model is the image fed to the encoder, and the term decoder(encoder_output) passes the encoder output to the input of the decoder. It also outputs mu and log_var, which the loss needs.
 
-# The input to the model will be the image fed to the encoder.
-vae_input = vae_encoder_input
+### COMPILATION AND TRAINING
 
-# Output will be the output of the decoder. The term - decoder(encoder_output) 
-# combines the model by passing the encoder output to the input of the decoder.
-vae_output = vae_decoder(vae_encoder_output)
+The loss function is a sum of RMSE and KL Divergence. A weight is assigned to the RMSE loss, known as the loss factor. The loss factor is multiplied with the RMSE loss. If we use a high loss factor, the drawbacks of a Simple Autoencoder start to appear. However, if we use a loss factor too low, the quality of the reconstructed images will be poor. Hence the loss factor is a hyperparameter that needs to be tuned.
 
-# Input to the combined model will be the input to the encoder.
-# Output of the combined model will be the output of the decoder.
-vae_model = Model(vae_input, vae_output)
+VAEModel has its own training step: a single forward pass gives the reconstruction, mu and log_var, so both terms of the loss are computed once per batch and reported as the r_loss and kl_loss metrics. The loss factor is a variable of the model, and a <i>LossFactorScheduler</i> callback can change it from epoch to epoch.
 
-vae_model.summary()
+On a machine with little memory, set ACCUMULATION_STEPS to split every batch of BATCH_SIZE images into that many micro-batches. Their gradients are accumulated before each Adam step, so the training behaves as with the whole batch while the memory use follows the size of a micro-batch.
 
-"""### COMPILATION AND TRAINING
+The <i>ValidationScorer</i> callback of <i>face_gen/evaluate.py</i> runs the held out images through the VAE in large batches at the end of every epoch and adds val_r_loss and val_kl_loss to the logs, spending at most EVAL_SECONDS on it. <i>python -m face_gen evaluate</i> scores every image of the cache the same way and writes the scores of each image to a .npy file, where the faces the VAE reconstructs worst stand out.
 
-The loss function is a sum of RMSE and KL Divergence. A weight is assigned to the RMSE loss, known as the loss factor. The loss factor is multiplied with the RMSE loss. If we use a high loss factor, the drawbacks of a Simple Autoencoder start to appear. However, if we use a loss factor too low, the quality of the reconstructed images will be poor. Hence the loss factor is a hyperparameter that needs to be tuned.
+To choose LOSS_FACTOR, Z_DIM and LEARNING_RATE without a 200-epoch run for each, <i>python -m face_gen sweep</i> trains short trials of a grid of values on a subset of the cache, several at a time, stops the trials that fall behind on both r_loss and kl_loss, and writes the results to a CSV table.
 """
 
-LEARNING_RATE = 0.0005
 N_EPOCHS = 200
 LOSS_FACTOR = 10000
+ACCUMULATION_STEPS = 1
+EVAL_SECONDS = 60
 
-def kl_loss(y_true, y_pred):
-    kl_loss =  -0.5 * K.sum(1 + log_var - K.square(mean_mu) - K.exp(log_var), axis = 1)
-    return kl_loss
+"""### RECONSTRUCTION.
+The reconstruction process is the same as that of the Simple Autoencoder.
+"""
 
-def total_loss(y_true, y_pred):
-    return LOSS_FACTOR*r_loss(y_true, y_pred) + kl_loss(y_true, y_pred)
+def plot_compare_vae(vae_model, images, path = None):
+  n_to_show = images.shape[0]
+  reconst_images = vae_model.predict(images)
 
-adam_optimizer = Adam(lr = LEARNING_RATE)
+  path = path or os.path.join(MONTAGE_FOLDER, 'vae_compare.png')
+  return save_montage(interleave_rows([images, reconst_images], n_to_show), path, n_cols = n_to_show)
 
-vae_model.compile(optimizer=adam_optimizer, loss = total_loss, metrics = [r_loss, kl_loss])
+"""### Generating new faces from random vectors sampled from a standard normal distribution."""
 
-checkpoint_vae = ModelCheckpoint(os.path.join(WEIGHTS_FOLDER, 'VAE/weights.h5'), save_weights_only = True, verbose=1)
+def vae_generate_images(vae_decoder, n_to_show=10, path=None):
+  reconst_images = vae_decoder.predict(np.random.normal(0,1,size=(n_to_show,Z_DIM)))
+  return save_montage(reconst_images, path or os.path.join(MONTAGE_FOLDER, 'vae_samples.png'),
+                      n_cols = min(n_to_show, MONTAGE_COLS))
 
-vae_model.fit_generator(data_flow, 
-                        shuffle=True, 
-                        epochs = N_EPOCHS, 
-                        initial_epoch = 0, 
-                        steps_per_epoch=NUM_IMAGES / BATCH_SIZE,
-                        callbacks=[checkpoint_vae])
+"""The VAE is evidently capable enough of producing new faces from vectors samped from a standard normal distribution. The fact that a neural network is capable of generating new faces from random noise shows how powerful it is in performing extremely complex mappings!
 
-"""### RECONSTRUCTION.
-The reconstruction process is the same as that of the Simple Autoencoder.
+### Running the tutorial
 """
 
-example_batch = next(data_flow)
-example_batch = example_batch[0]
-example_images = example_batch[:10]
+def main():
+  if not os.path.exists(DATA_ZIP):
+    download_dataset()
 
-def plot_compare_vae(images=None):
-  
-  if images is None:
-    example_batch = next(data_flow)
-    example_batch = example_batch[0]
-    images = example_batch[:10]
+  reader = ZipImageReader(DATA_ZIP)
+  print("Total number of images : " + str(len(reader)))
 
-  n_to_show = images.shape[0]
-  reconst_images = vae_model.predict(images)
+  data_flow = make_data_flow(reader, INPUT_DIM, BATCH_SIZE,
+                             use_cache = USE_CACHE,
+                             cache_folder = CACHE_FOLDER,
+                             workers = N_WORKERS,
+                             validation_split = VALIDATION_SPLIT)
 
-  fig = plt.figure(figsize=(15, 3))
-  fig.subplots_adjust(hspace=0.4, wspace=0.4)
+  # Simple Autoencoder
+  encoder, decoder, simple_autoencoder = build_autoencoder(INPUT_DIM, Z_DIM, input_rescale = INPUT_RESCALE)
+  encoder.summary()
+  decoder.summary()
+  simple_autoencoder.summary()
 
-  for i in range(n_to_show):
-      img = images[i].squeeze()
-      sub = fig.add_subplot(2, n_to_show, i+1)
-      sub.axis('off')        
-      sub.imshow(img)
+  train_autoencoder(simple_autoencoder, data_flow, N_EPOCHS_AE, WEIGHTS_FOLDER, LOG_FOLDER,
+                    learning_rate = LEARNING_RATE, input_rescale = INPUT_RESCALE)
 
-  for i in range(n_to_show):
-      img = reconst_images[i].squeeze()
-      sub = fig.add_subplot(2, n_to_show, i+n_to_show+1)
-      sub.axis('off')
-      sub.imshow(img)
+  example_images = next(data_flow)[0][:10]
+  plot_compare(simple_autoencoder, encoder, decoder, example_images)
+  plot_compare(simple_autoencoder, encoder, decoder, example_images, add_noise = True)
+  generate_images_from_noise(decoder)
 
-plot_compare_vae(images = example_images)
+  # Variational Autoencoder
+  from face_gen.models import build_vae
+  vae_encoder, vae_decoder, vae_model = build_vae(INPUT_DIM, Z_DIM, input_rescale = INPUT_RESCALE,
+                                                  accumulation_steps = ACCUMULATION_STEPS)
+  vae_encoder.summary()
+  vae_decoder.summary()
+  vae_model.summary()
 
-"""### Generating new faces from random vectors sampled from a standard normal distribution."""
+  from face_gen.evaluate import ValidationScorer
+  validation_flow = make_validation_flow(reader, INPUT_DIM, 1024, VALIDATION_SPLIT,
+                                         use_cache = USE_CACHE, cache_folder = CACHE_FOLDER)
+  train_vae(vae_model, data_flow, N_EPOCHS, WEIGHTS_FOLDER, LOG_FOLDER,
+            learning_rate = LEARNING_RATE, loss_factor = LOSS_FACTOR,
+            callbacks = [ValidationScorer(validation_flow, max_seconds = EVAL_SECONDS, verbose = 1)])
 
-def vae_generate_images(n_to_show=10):
-  reconst_images = vae_decoder.predict(np.random.normal(0,1,size=(n_to_show,Z_DIM)))
+  example_images = next(data_flow)[0][:10]
+  plot_compare_vae(vae_model, example_images)
+  vae_generate_images(vae_decoder, n_to_show = 10)
 
-  fig = plt.figure(figsize=(15, 3))
-  fig.subplots_adjust(hspace=0.4, wspace=0.4)
+  data_flow.close()
 
-  for i in range(n_to_show):
-        img = reconst_images[i].squeeze()
-        sub = fig.add_subplot(2, n_to_show, i+1)
-        sub.axis('off')        
-        sub.imshow(img)
+  print("Montages written to " + MONTAGE_FOLDER)
 
-vae_generate_images(n_to_show=10)
 
-"""The VAE is evidently capable enough of producing new faces from vectors samped from a standard normal distribution. The fact that a neural network is capable of generating new faces from random noise shows how powerful it is in performing extremely complex mappings!"""
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,46 @@
+"""Gradient accumulation: a step on K micro-batches matches the step on the whole batch."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from keras.optimizers import SGD
+
+from face_gen.models import build_vae
+
+INPUT_DIM = (32, 32, 3)
+Z_DIM = 8
+
+
+def _vae(accumulation_steps, weights = None):
+  _, _, vae_model = build_vae(INPUT_DIM, Z_DIM, accumulation_steps = accumulation_steps)
+  if weights is None:
+    # log_var close to -inf makes the sampled z equal to mu, so both steps
+    # see the same latents whatever noise they draw
+    log_var = vae_model.get_layer('log_var')
+    kernel, bias = log_var.get_weights()
+    log_var.set_weights([np.zeros_like(kernel), np.full_like(bias, -60.)])
+  else:
+    vae_model.set_weights(weights)
+  vae_model.compile(optimizer = SGD(learning_rate = 1e-5))
+  return vae_model
+
+
+@pytest.mark.parametrize('batch_size', [8, 10, 3])
+def test_accumulated_step_matches_full_batch(batch_size):
+  x = np.random.RandomState(0).randint(0, 256, size = (batch_size,) + INPUT_DIM).astype(np.uint8)
+
+  full = _vae(1)
+  weights = full.get_weights()
+  full_metrics = full.train_on_batch(x, return_dict = True)
+  full_weights = full.get_weights()
+
+  accumulated = _vae(4, weights)
+  accumulated_metrics = accumulated.train_on_batch(x, return_dict = True)
+
+  for name in ('loss', 'r_loss', 'kl_loss'):
+    assert accumulated_metrics[name] == pytest.approx(full_metrics[name], rel = 1e-4, abs = 1e-6)
+  for before, after_full, after_accumulated in zip(weights, full_weights, accumulated.get_weights()):
+    # The update, not the weights, is what the steps could disagree on
+    np.testing.assert_allclose(after_accumulated - before, after_full - before, rtol = 1e-3, atol = 1e-7)
@@ -0,0 +1,64 @@
+"""Checkpoints: a step checkpoint on the last batch of an epoch can be resumed."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from keras import backend as K
+from keras.optimizers import Adam
+
+from face_gen.callbacks import TrainingMonitor
+from face_gen.checkpoints import CheckpointManager, read_checkpoint_info
+from face_gen.models import build_vae
+from face_gen.train import fit_resumed
+
+INPUT_DIM = (32, 32, 3)
+Z_DIM = 8
+STEPS_PER_EPOCH = 4
+
+
+class _Batches(object):
+  # Endless uint8 batches, STEPS_PER_EPOCH per epoch
+  def __init__(self, batch_size = 2):
+    self.rng = np.random.RandomState(0)
+    self.batch_size = batch_size
+
+  def __len__(self):
+    return STEPS_PER_EPOCH
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    return self.rng.randint(0, 256, size = (self.batch_size,) + INPUT_DIM).astype(np.uint8)
+
+
+def _fit(tmpdir, epochs, save_freq):
+  _, _, vae_model = build_vae(INPUT_DIM, Z_DIM)
+  vae_model.compile(optimizer = Adam(learning_rate = 1e-4))
+  checkpoint = CheckpointManager(str(tmpdir.join('ckpt')), save_freq = save_freq, verbose = 0)
+  monitor = TrainingMonitor(str(tmpdir.join('steps.csv')))
+  fit_resumed(vae_model, _Batches(), epochs, checkpoint, monitor)
+  return vae_model, checkpoint
+
+
+def test_step_checkpoint_on_the_last_batch_starts_the_next_epoch(tmpdir):
+  # save_freq divides the epoch, so the last checkpoint falls on its last batch
+  _, checkpoint = _fit(tmpdir, 1, save_freq = 2)
+  info = read_checkpoint_info(checkpoint.latest())
+  assert (info['epoch'], info['epoch_step'], info['step']) == (1, 0, STEPS_PER_EPOCH)
+
+  vae_model, _ = _fit(tmpdir, 2, save_freq = 2)
+  assert int(K.get_value(vae_model.optimizer.iterations)) == 2 * STEPS_PER_EPOCH
+
+
+def test_resume_from_a_checkpoint_at_the_end_of_an_epoch(tmpdir):
+  # As written before the checkpoints on the last batch were moved to the next epoch
+  vae_model, checkpoint = _fit(tmpdir, 1, save_freq = 'epoch')
+  checkpoint.set_model(vae_model)
+  checkpoint.save(0, STEPS_PER_EPOCH)
+  checkpoint.on_train_end()
+
+  vae_model, _ = _fit(tmpdir, 2, save_freq = 'epoch')
+  assert int(K.get_value(vae_model.optimizer.iterations)) == 2 * STEPS_PER_EPOCH
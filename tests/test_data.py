@@ -0,0 +1,127 @@
+"""Cache iterators: every shuffle mode covers the images once per epoch, and the
+training, validation and worker ranges cover the cache without overlapping."""
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+from face_gen.data import CACHE_FILENAMES, CACHE_INDEX, CachedDataset, CacheIterator, partition_range, split_range
+
+N = 103
+IMAGE_SHAPE = (2, 2, 3)
+
+
+@pytest.fixture
+def dataset(tmpdir):
+  # Two shards, every image filled with its own index
+  folder = str(tmpdir)
+  shard_sizes = [60, N - 60]
+  for i, size in enumerate(shard_sizes):
+    start = sum(shard_sizes[:i])
+    images = np.broadcast_to(np.arange(start, start + size, dtype = np.uint8)[:, None, None, None],
+                             (size,) + IMAGE_SHAPE)
+    np.save(os.path.join(folder, 'shard_%05d.npy' % i), np.ascontiguousarray(images))
+  with open(os.path.join(folder, CACHE_FILENAMES), 'w') as f:
+    f.write('\n'.join('%06d.jpg' % i for i in range(N)))
+  with open(os.path.join(folder, CACHE_INDEX), 'w') as f:
+    json.dump({'image_shape': list(IMAGE_SHAPE), 'shard_sizes': shard_sizes}, f)
+  return CachedDataset(folder)
+
+
+def _epoch(data_flow):
+  # The image indices of one epoch, batch by batch
+  return [next(data_flow)[:, 0, 0, 0].tolist() for _ in range(len(data_flow))]
+
+
+@pytest.mark.parametrize('shuffle', [False, 'batch', 'window', True])
+def test_every_shuffle_visits_every_image_once_per_epoch(dataset, shuffle):
+  data_flow = CacheIterator(dataset, batch_size = 10, shuffle = shuffle, seed = 0, rescale = None,
+                            class_mode = None, shuffle_window = 25)
+  for _ in range(3):
+    batches = _epoch(data_flow)
+    assert sorted(sum(batches, [])) == list(range(N))
+    assert [len(batch) for batch in batches].count(10) == N // 10
+
+
+def test_no_shuffle_is_in_order(dataset):
+  data_flow = CacheIterator(dataset, batch_size = 10, shuffle = False, rescale = None, class_mode = None)
+  assert sum(_epoch(data_flow), []) == list(range(N))
+
+
+def test_batch_shuffle_keeps_the_contents_of_the_batches(dataset):
+  data_flow = CacheIterator(dataset, batch_size = 10, shuffle = 'batch', seed = 0, rescale = None,
+                            class_mode = None)
+  first, second = _epoch(data_flow), _epoch(data_flow)
+  assert first != second
+  assert sorted(map(sorted, first)) == sorted(map(sorted, second))
+
+
+def test_window_shuffle_visits_the_windows_one_after_the_other(dataset):
+  data_flow = CacheIterator(dataset, batch_size = 5, shuffle = 'window', seed = 0, rescale = None,
+                            class_mode = None, shuffle_window = 25)
+  first, second = _epoch(data_flow), _epoch(data_flow)
+  # The batches change from epoch to epoch
+  assert sorted(map(sorted, first)) != sorted(map(sorted, second))
+  # The windows are visited one after the other, so a batch reads from at
+  # most two of them (the short last window shifts the batch boundaries)
+  for batch in first + second:
+    assert len(set(i // 25 for i in batch)) <= 2
+  windows = [i // 25 for batch in first for i in batch]
+  assert sum(a != b for a, b in zip(windows, windows[1:])) == N // 25
+
+
+def test_window_is_the_default_shuffle(dataset):
+  assert CacheIterator(dataset).shuffle == 'window'
+
+
+def test_seeded_shuffles_repeat(dataset):
+  flows = [CacheIterator(dataset, batch_size = 10, shuffle = True, seed = 3, rescale = None, class_mode = None)
+           for _ in range(2)]
+  assert _epoch(flows[0]) == _epoch(flows[1])
+
+
+@pytest.mark.parametrize('n, validation_split', [(N, 0.), (N, 0.1), (N, 0.5), (10, 0.04)])
+def test_split_range_covers_the_images_once(n, validation_split):
+  training = split_range(n, validation_split, 'training')
+  assert split_range(n, validation_split, None) == (0, n)
+  if training[1] == n:
+    with pytest.raises(ValueError):
+      split_range(n, validation_split, 'validation')
+    return
+  validation = split_range(n, validation_split, 'validation')
+  assert training[0] == 0
+  assert training[0] + training[1] == validation[0]
+  assert validation[0] + validation[1] == n
+
+
+def test_split_range_checks_its_arguments():
+  with pytest.raises(ValueError):
+    split_range(N, 0.1, 'test')
+  with pytest.raises(ValueError):
+    split_range(N, 1., 'training')
+
+
+@pytest.mark.parametrize('n, count', [(N, 1), (N, 4), (N, 7), (5, 5)])
+def test_partition_range_is_disjoint_and_equal(n, count):
+  ranges = [partition_range(n, (index, count)) for index in range(count)]
+  assert len(set(size for _, size in ranges)) == 1
+  covered = np.concatenate([np.arange(start, start + size) for start, size in ranges])
+  assert len(np.unique(covered)) == len(covered)
+  assert covered.min() == 0 and len(covered) == n - n % count
+  assert partition_range(n, None) == (0, n)
+
+
+def test_partitioned_iterators_split_the_training_images(dataset):
+  flows = [CacheIterator(dataset, batch_size = 4, shuffle = 'window', seed = rank, rescale = None,
+                         class_mode = None, partition = (rank, 3), validation_split = 0.1, subset = 'training')
+           for rank in range(3)]
+  seen = [set(sum(_epoch(data_flow), [])) for data_flow in flows]
+  assert all(not a & b for i, a in enumerate(seen) for b in seen[i + 1:])
+
+  validation = CacheIterator(dataset, batch_size = 4, shuffle = False, rescale = None, class_mode = None,
+                             validation_split = 0.1, subset = 'validation')
+  held_out = set(sum(_epoch(validation), []))
+  assert held_out == set(range(N - 10, N))
+  assert all(not images & held_out for images in seen)
@@ -0,0 +1,72 @@
+"""Latent index: the chunked search and the IVF index against brute force."""
+
+import numpy as np
+import pytest
+
+from face_gen.latent_index import IVFIndex, LatentIndex, _search
+
+Z_DIM = 16
+
+
+def _latents(n, seed = 0):
+  # Clustered, like the latents of a trained encoder, so the IVF cells mean something
+  rng = np.random.RandomState(seed)
+  centers = rng.normal(scale = 4., size = (20, Z_DIM))
+  return (centers[rng.randint(len(centers), size = n)] + rng.normal(size = (n, Z_DIM))).astype(np.float32)
+
+
+def _brute_force(latents, queries, k):
+  distances = ((queries[:, None] - latents[None]) ** 2).sum(-1)
+  rows = np.argsort(distances, axis = 1, kind = 'stable')[:, :k]
+  return np.take_along_axis(distances, rows, axis = 1), rows
+
+
+@pytest.mark.parametrize('chunk_size', [1000, 64, 7])
+def test_search_matches_brute_force(chunk_size):
+  latents = _latents(1000)
+  queries = _latents(25, seed = 1)
+  norms = np.einsum('ij,ij->i', latents, latents)
+
+  distances, rows = _search(latents, norms, queries, 10, chunk_size)
+  expected_distances, expected_rows = _brute_force(latents, queries, 10)
+
+  np.testing.assert_array_equal(rows, expected_rows)
+  np.testing.assert_allclose(distances, expected_distances, rtol = 1e-4, atol = 1e-3)
+
+
+def test_search_with_k_larger_than_the_latents():
+  latents = _latents(5)
+  distances, rows = _search(latents, np.einsum('ij,ij->i', latents, latents), latents[:2], 10, 2)
+  assert rows.shape == (2, 5)
+  assert list(rows[:, 0]) == [0, 1]
+  assert (np.diff(distances, axis = 1) >= 0).all()
+
+
+def test_neighbours_leave_out_the_query_image():
+  latents = _latents(200)
+  index = LatentIndex(latents, ['img/%03d.jpg' % i for i in range(200)], chunk_size = 50)
+
+  neighbours = index.neighbours('003.jpg', k = 5)
+  _, expected = _brute_force(latents, latents[3:4], 6)
+  assert [name for name, _ in neighbours] == ['img/%03d.jpg' % i for i in expected[0] if i != 3][:5]
+
+
+def test_ivf_recall_against_brute_force(tmpdir):
+  latents = _latents(4000)
+  queries = _latents(50, seed = 1)
+  index = LatentIndex(latents, [str(i) for i in range(len(latents))])
+  ivf = IVFIndex.build(index, n_lists = 32, n_probe = 8)
+
+  _, rows = ivf.query(queries, k = 10)
+  _, expected = _brute_force(latents, queries, 10)
+  recall = np.mean([len(set(r) & set(e)) / 10. for r, e in zip(rows, expected)])
+  assert recall >= 0.9
+
+  # Probing every cell is an exhaustive search
+  ivf.n_probe = 32
+  _, rows = ivf.query(queries, k = 10)
+  np.testing.assert_array_equal(np.sort(rows, axis = 1), np.sort(expected, axis = 1))
+
+  ivf.save(str(tmpdir))
+  loaded = IVFIndex.load(index, str(tmpdir), n_probe = 32)
+  np.testing.assert_array_equal(loaded.query(queries, k = 10)[1], rows)
@@ -0,0 +1,92 @@
+"""Montage: tiled grids match a per-image loop, and streamed PNGs decode to the same grid."""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from face_gen.montage import PNGStripWriter, interleave_rows, stream_montage, tile_images
+
+IMAGE_SHAPE = (5, 4, 3)
+
+
+def _images(n, seed = 0):
+  return np.random.RandomState(seed).randint(0, 256, size = (n,) + IMAGE_SHAPE).astype(np.uint8)
+
+
+@pytest.mark.parametrize('n, n_cols', [(12, 4), (10, 4), (3, 5), (1, 1)])
+def test_tile_images_places_every_image_in_its_cell(n, n_cols):
+  images = _images(n)
+  h, w, _ = IMAGE_SHAPE
+  padding = 2
+  grid = tile_images(images, n_cols, padding = padding, pad_value = 7)
+
+  n_rows = (n + n_cols - 1) // n_cols
+  assert grid.shape == (n_rows * (h + padding), n_cols * (w + padding), 3)
+  for i in range(n_rows * n_cols):
+    row, col = divmod(i, n_cols)
+    cell = grid[row * (h + padding):(row + 1) * (h + padding), col * (w + padding):(col + 1) * (w + padding)]
+    if i < n:
+      np.testing.assert_array_equal(cell[:h, :w], images[i])
+      assert (cell[h:] == 7).all() and (cell[:, w:] == 7).all()
+    else:
+      assert (cell == 7).all()
+
+
+def test_tile_images_scales_float_images():
+  images = np.zeros((2,) + IMAGE_SHAPE, dtype = np.float32)
+  images[1] = 1.
+  grid = tile_images(images, 2, padding = 0)
+  assert grid.dtype == np.uint8
+  assert (grid[:, :4] == 0).all() and (grid[:, 4:] == 255).all()
+
+
+def test_interleave_rows_alternates_the_rows_of_the_batches():
+  originals, reconstructions = _images(7, seed = 1), _images(7, seed = 2)
+  n_cols = 3
+  ordered = interleave_rows([originals, reconstructions], n_cols)
+
+  # 3 rows of each batch, the last ones padded with white images
+  assert ordered.shape == (18,) + IMAGE_SHAPE
+  for row in range(3):
+    for col in range(n_cols):
+      i = row * n_cols + col
+      expected = [originals, reconstructions]
+      for b in range(2):
+        image = ordered[(2 * row + b) * n_cols + col]
+        if i < 7:
+          np.testing.assert_array_equal(image, expected[b][i])
+        else:
+          assert (image == 255).all()
+
+
+@pytest.mark.parametrize('channels', [1, 3])
+def test_png_strip_writer_round_trips(tmpdir, channels):
+  image = np.random.RandomState(0).randint(0, 256, size = (9, 6, channels)).astype(np.uint8)
+  path = str(tmpdir.join('strips.png'))
+  with PNGStripWriter(path, width = 6, height = 9, channels = channels) as png:
+    # Strips of uneven heights
+    for start, stop in ((0, 4), (4, 5), (5, 9)):
+      png.write(image[start:stop])
+
+  decoded = np.asarray(Image.open(path))
+  np.testing.assert_array_equal(decoded, image.squeeze(-1) if channels == 1 else image)
+
+
+def test_png_strip_writer_checks_the_row_count(tmpdir):
+  path = str(tmpdir.join('short.png'))
+  png = PNGStripWriter(path, width = 2, height = 3)
+  png.write(np.zeros((2, 2, 3), dtype = np.uint8))
+  with pytest.raises(ValueError):
+    png.write(np.zeros((2, 2, 3), dtype = np.uint8))
+  with pytest.raises(ValueError):
+    png.close()
+
+
+def test_stream_montage_matches_tile_images(tmpdir):
+  images = _images(23)
+  path = str(tmpdir.join('grid.png'))
+  # Batch sizes that do not line up with the rows of the grid
+  batches = (images[start:start + 5] for start in range(0, 25, 5))
+  stream_montage(batches, path, n_images = 23, n_cols = 4, image_shape = IMAGE_SHAPE)
+
+  np.testing.assert_array_equal(np.asarray(Image.open(path)), tile_images(images, 4))
@@ -0,0 +1,155 @@
+"""MicroBatcher: concurrent requests are batched together and get their own rows back.
+The HTTP handler answers bad requests with 400."""
+
+import http.client
+import io
+import json
+import threading
+from concurrent.futures import wait
+
+import numpy as np
+import pytest
+
+from face_gen.serve import MicroBatcher, make_server
+
+
+class _Recorder(object):
+  # Doubles the rows, and remembers the size of every batch
+  def __init__(self, gate = None):
+    self.batch_sizes = []
+    self.gate = gate
+
+  def __call__(self, rows):
+    if self.gate is not None:
+      self.gate.wait(timeout = 10)
+    self.batch_sizes.append(len(rows))
+    return rows * 2
+
+
+def test_requests_get_their_own_rows():
+  fn = _Recorder()
+  batcher = MicroBatcher(fn, max_batch = 64, max_wait = 0.05)
+  try:
+    requests = [np.arange(i, i + n) for i, n in enumerate([1, 3, 2, 5, 1, 4])]
+    futures = [batcher.submit(rows) for rows in requests]
+    for rows, future in zip(requests, futures):
+      np.testing.assert_array_equal(future.result(timeout = 10), rows * 2)
+  finally:
+    batcher.close()
+
+  # Submitted within max_wait, so they share batches
+  assert sum(fn.batch_sizes) == 16
+  assert len(fn.batch_sizes) < len(requests)
+  assert batcher.stats()['requests'] == len(requests)
+
+
+def test_batches_hold_whole_requests_up_to_max_batch():
+  # The worker is held on the first batch, so the rest queue up behind it
+  gate = threading.Event()
+  fn = _Recorder(gate)
+  batcher = MicroBatcher(fn, max_batch = 8, max_wait = 0.01)
+  try:
+    futures = [batcher.submit(np.full(3, i)) for i in range(6)]
+    gate.set()
+    for i, future in enumerate(futures):
+      np.testing.assert_array_equal(future.result(timeout = 10), np.full(3, 2 * i))
+  finally:
+    batcher.close()
+
+  # A request of 3 rows is never split, so a batch holds at most 2 of them
+  assert sum(fn.batch_sizes) == 18
+  assert all(size in (3, 6) for size in fn.batch_sizes)
+
+
+def test_errors_reach_every_request_of_the_batch():
+  def fail(rows):
+    raise ValueError('bad rows')
+
+  batcher = MicroBatcher(fail, max_batch = 64, max_wait = 0.05)
+  try:
+    futures = [batcher.submit(np.zeros(2)) for _ in range(3)]
+    wait(futures, timeout = 10)
+    for future in futures:
+      with pytest.raises(ValueError, match = 'bad rows'):
+        future.result()
+  finally:
+    batcher.close()
+
+
+def test_a_failed_batch_does_not_stop_the_batcher():
+  def check(rows):
+    if (rows < 0).any():
+      raise ValueError('negative rows')
+    return rows
+
+  batcher = MicroBatcher(check, max_batch = 64, max_wait = 0.)
+  try:
+    with pytest.raises(ValueError):
+      batcher(np.full(2, -1))
+    np.testing.assert_array_equal(batcher(np.arange(2)), np.arange(2))
+  finally:
+    batcher.close()
+
+
+def test_submit_after_close_fails():
+  batcher = MicroBatcher(lambda rows: rows)
+  batcher.close()
+  with pytest.raises(RuntimeError):
+    batcher.submit(np.zeros(1))
+
+
+class _Service(object):
+  # Stands in for InferenceService, without a model
+  z_dim = 4
+  input_dim = (8, 8, 3)
+
+  def decoder(self, z):
+    return np.zeros((len(z),) + self.input_dim, dtype = np.uint8)
+
+  def encoder(self, images):
+    return np.zeros((len(images), self.z_dim), dtype = np.float32)
+
+  def generate(self, n, seed = None, start = 0):
+    return self.decoder(np.zeros((n, self.z_dim)))
+
+  def stats(self):
+    return {}
+
+
+@pytest.fixture
+def server():
+  server = make_server(_Service(), port = 0)
+  thread = threading.Thread(target = server.serve_forever, daemon = True)
+  thread.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+
+def _post(server, path, body, content_type):
+  connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout = 10)
+  try:
+    connection.request('POST', path, body, {'Content-Type': content_type})
+    response = connection.getresponse()
+    return response.status, response.read()
+  finally:
+    connection.close()
+
+
+@pytest.mark.parametrize('body', [b'{"n": 2', b'[1, 2]', b'\xff'])
+def test_bad_json_bodies_get_400(server, body):
+  status, response = _post(server, '/generate', body, 'application/json')
+  assert status == 400
+  assert 'error' in json.loads(response)
+
+
+def test_json_body_sets_the_parameters(server):
+  status, response = _post(server, '/generate', b'{"n": 2}', 'application/json')
+  assert status == 200
+  assert np.load(io.BytesIO(response)).shape == (2, 8, 8, 3)
+
+
+def test_undecodable_image_gets_400(server):
+  status, response = _post(server, '/encode', b'not an image', 'image/jpeg')
+  assert status == 400
+  assert 'Cannot decode' in json.loads(response)['error']